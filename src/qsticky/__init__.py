@@ -4,6 +4,9 @@ __version__ = "1.3"
 __author__ = "Feasuro"
 __all__ = [
     'notes',
+    'model',
     'data',
     'preferences',
+    'theme',
+    'asyncqt',
 ]
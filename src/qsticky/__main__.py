@@ -1,7 +1,9 @@
 """ Application entry point module, parses commandline input. """
 import sys
 import os
+import hashlib
 import logging
+from functools import partial
 
 from PyQt6.QtCore import QCommandLineParser, QCommandLineOption
 
@@ -14,10 +16,20 @@ class ArgumentParser(QCommandLineParser):
     """ Command-line argument parser for QSticky. """
     tr = lambda obj, string: NoteApplication.translate(type(obj).__name__, string)
     default_dir = os.getenv('XDG_DATA_HOME', default=os.path.expanduser('~/.local/share'))
+    data_dir = os.path.join(default_dir, 'qsticky')
+    cache_dir = os.path.join(os.getenv('XDG_CACHE_HOME', default=os.path.expanduser('~/.cache')), 'qsticky')
     def __init__(self) -> None:
         super().__init__()
         self.connector = data.NoStorage
         self.params = {}
+        self.cache_file = None
+        self.snapshot_file = None
+        self.replica_file = None
+        self.listening = False
+        self.workspace = data.WORKSPACE
+        self.batch_size = NoteApplication.BATCH
+        self.hidden_windows = NoteApplication.HIDDEN
+        self.snapshot_name = 'snapshot.bin'
         self.setApplicationDescription(self.tr('Show sticky notes on your desktop.'))
         self.addHelpOption()
         self.addVersionOption()
@@ -33,7 +45,7 @@ class ArgumentParser(QCommandLineParser):
         self.addOption(QCommandLineOption(
             ['t', 'type'],
             self.tr('The database engine to connect with.\ndefault: sqlite'),
-            'sqlite|none|postgre|mysql',
+            'sqlite|journal|none|postgre|mysql',
             'sqlite'
         ))
         self.addOption(QCommandLineOption(
@@ -42,6 +54,48 @@ class ArgumentParser(QCommandLineParser):
             'file',
             os.path.join(self.default_dir, 'qsticky.db')
         ))
+        self.addOption(QCommandLineOption(
+            ['sqlite-profile'],
+            self.tr('SQLite performance profile. safe - rollback journal, wal - write-ahead log, '
+                    'fast - write-ahead log with less frequent disk synchronization.\ndefault: safe'),
+            'safe|wal|fast',
+            'safe'
+        ))
+        self.addOption(QCommandLineOption(
+            ['split-bodies'],
+            self.tr('Move note texts to a separate table, so startup reads less data.')
+        ))
+        self.addOption(QCommandLineOption(
+            ['zstd'],
+            self.tr('Compress large notes with zstd instead of zlib, '
+                    'only clients with the zstandard package can read them.')
+        ))
+        self.addOption(QCommandLineOption(
+            ['journal-file'],
+            self.tr('Journal file path, for notes kept on network file systems.\ndefault: ~/.local/share/qsticky.journal'),
+            'file',
+            os.path.join(self.default_dir, 'qsticky.journal')
+        ))
+        self.addOption(QCommandLineOption(
+            ['w', 'workspace'],
+            self.tr('The set of notes to show, other notes stay in the database.\ndefault: default'),
+            'name',
+            data.WORKSPACE
+        ))
+        self.addOption(QCommandLineOption(
+            ['batch-size'],
+            self.tr('Number of note windows created at once, before the application handles other events.'
+                    '\ndefault: {}').format(NoteApplication.BATCH),
+            'number',
+            str(NoteApplication.BATCH)
+        ))
+        self.addOption(QCommandLineOption(
+            ['hidden-windows'],
+            self.tr('Number of windows of hidden notes kept to show them again quickly, the least recently '
+                    'hidden ones are freed over it to save memory.\ndefault: {}').format(NoteApplication.HIDDEN),
+            'number',
+            str(NoteApplication.HIDDEN)
+        ))
         self.addOption(QCommandLineOption(
             ['o', 'host'],
             self.tr('The hostname or IP address of the database server.\ndefault: UNIX socket connection.'),
@@ -70,11 +124,44 @@ class ArgumentParser(QCommandLineParser):
             self.tr('The password to authenticate with.\ndefault: an empty string'),
             'password'
         ))
+        self.addOption(QCommandLineOption(
+            ['replica'],
+            self.tr('Keep a local copy of notes stored on the database server. Changes are saved '
+                    'locally and synchronized in background, also after working offline.')
+        ))
+        self.addOption(QCommandLineOption(
+            ['sync-interval'],
+            self.tr('Seconds between synchronizations of the local copy with the server.\ndefault: 30'),
+            'seconds',
+            '30'
+        ))
+        self.addOption(QCommandLineOption(
+            ['pool-size'],
+            self.tr('The maximum number of connections to the database server.\ndefault: 2'),
+            'number',
+            '2'
+        ))
+        self.addOption(QCommandLineOption(
+            ['idle-timeout'],
+            self.tr('Seconds after which an unused connection is replaced with a new one.\ndefault: 600'),
+            'seconds',
+            '600'
+        ))
+        self.addOption(QCommandLineOption(
+            ['connect-timeout'],
+            self.tr('Seconds to wait for a connection to the database server.\ndefault: 10'),
+            'seconds',
+            '10'
+        ))
 
     def process(self, app: NoteApplication) -> None:
         """ Process command-line arguments. """
         super().process(app)
         self.setup_logging()
+        self.setup_workspace()
+        self.setup_windows()
+        self.setup_compression()
+        self.setup_pool()
         self.setup_connection()
 
     def setup_logging(self) -> None:
@@ -86,71 +173,227 @@ class ArgumentParser(QCommandLineParser):
         else:
             logging.basicConfig()
 
+    def setup_workspace(self) -> None:
+        """ Choose the workspace of notes shown, each workspace gets its own snapshot. """
+        if not (workspace := self.value('workspace').strip()):
+            logger.error(f'{type(self).__name__}::Empty workspace name, using {data.WORKSPACE}')
+            workspace = data.WORKSPACE
+        self.workspace = workspace
+        if workspace != data.WORKSPACE:
+            self.snapshot_name = f'snapshot-{hashlib.sha1(workspace.encode()).hexdigest()[:16]}.bin'
+
+    def setup_windows(self) -> None:
+        """ Choose the number of note windows created at once and of hidden ones kept. """
+        try:
+            self.batch_size = int(self.value('batch-size'))
+        except ValueError:
+            self.batch_size = 0
+        if self.batch_size < 1:
+            logger.error(f'{type(self).__name__}::Invalid batch size {self.value("batch-size")}, '
+                         f'using {NoteApplication.BATCH}')
+            self.batch_size = NoteApplication.BATCH
+        try:
+            self.hidden_windows = int(self.value('hidden-windows'))
+        except ValueError:
+            self.hidden_windows = -1
+        if self.hidden_windows < 0:
+            logger.error(f'{type(self).__name__}::Invalid number of windows {self.value("hidden-windows")}, '
+                         f'using {NoteApplication.HIDDEN}')
+            self.hidden_windows = NoteApplication.HIDDEN
+
+    def setup_pool(self) -> None:
+        """ Choose the number of connections to the database server, their timeouts and the interval
+        of synchronizations of the local copy. """
+        try:
+            self.pool_size = int(self.value('pool-size'))
+        except ValueError:
+            self.pool_size = 0
+        if self.pool_size < 2:
+            # Startup streams notes on one connection while writes need another
+            logger.error(f'{type(self).__name__}::Invalid pool size {self.value("pool-size")}, '
+                         f'at least 2 connections are needed, using 2')
+            self.pool_size = 2
+        try:
+            self.idle_timeout = float(self.value('idle-timeout'))
+        except ValueError:
+            self.idle_timeout = 0.0
+        if not self.idle_timeout > 0:
+            logger.error(f'{type(self).__name__}::Invalid idle timeout {self.value("idle-timeout")}, using 600')
+            self.idle_timeout = 600.0
+        try:
+            self.connect_timeout = int(self.value('connect-timeout'))
+        except ValueError:
+            self.connect_timeout = 0
+        if self.connect_timeout < 1:
+            logger.error(f'{type(self).__name__}::Invalid connect timeout {self.value("connect-timeout")}, '
+                         f'using 10')
+            self.connect_timeout = 10
+        try:
+            self.sync_interval = float(self.value('sync-interval'))
+        except ValueError:
+            self.sync_interval = 0.0
+        if not 0 < self.sync_interval < float('inf'):
+            logger.error(f'{type(self).__name__}::Invalid sync interval {self.value("sync-interval")}, using 30')
+            self.sync_interval = 30.0
+
+    def setup_compression(self) -> None:
+        """ Choose the codec of large note texts compressed in databases. """
+        if not self.isSet('zstd'):
+            return
+        if data.codec.has_zstd:
+            data.codec.CODEC = data.codec.ZSTD
+        else:
+            logger.error(f'{type(self).__name__}::The zstandard package is not installed, using zlib')
+
     def setup_connection(self) -> None:
         """ Choose apropriate StorageConnector and connect to the specified database. """
         logger.debug(f'{type(self).__name__}::Specified: {self.optionNames()}')
         match self.value('type'):
 
             case 'sqlite':
-                for opt in ['host', 'port', 'dbname', 'user', 'password']:
+                for opt in ['journal-file', 'host', 'port', 'dbname', 'user', 'password', 'replica',
+                            'sync-interval', 'pool-size', 'idle-timeout', 'connect-timeout']:
                     if self.isSet(opt):
                         logger.warning(f'{type(self).__name__}::Ignoring option --{opt} {self.value(opt)}')
                 self.params['db'] = self.value('sqlite-db')
+                if (profile := self.value('sqlite-profile')) in data.SQLiteConnector.PROFILES:
+                    self.params['profile'] = profile
+                else:
+                    logger.error(f'Not recognized SQLite profile: {profile}')
+                self.params['split_bodies'] = self.isSet('split-bodies')
                 self.connector = data.SQLiteConnector
+                self.snapshot_file = self.cache_path(self.snapshot_name, 'db')
+
+            case 'journal':
+                for opt in ['sqlite-db', 'sqlite-profile', 'split-bodies', 'zstd', 'host', 'port', 'dbname', 'user',
+                            'password', 'replica', 'sync-interval', 'pool-size', 'idle-timeout', 'connect-timeout']:
+                    if self.isSet(opt):
+                        logger.warning(f'{type(self).__name__}::Ignoring option --{opt} {self.value(opt)}')
+                self.params['path'] = self.value('journal-file')
+                self.connector = data.JournalConnector
+                self.snapshot_file = self.cache_path(self.snapshot_name, 'path')
 
             case 'postgre':
-                if self.isSet('sqlite-db'):
-                    logger.warning(f'{type(self).__name__}::Ignoring option --sqlite-db {self.value('f')}')
+                for opt in ['sqlite-db', 'sqlite-profile', 'journal-file']:
+                    if self.isSet(opt):
+                        logger.warning(f'{type(self).__name__}::Ignoring option --{opt} {self.value(opt)}')
                 self.params = {
                     'host': self.value('host'),
                     'port': self.value('port'),
                     'dbname': self.value('dbname'),
                     'user': self.value('user'),
-                    'password': self.value('password')
+                    'password': self.value('password'),
+                    'pool_size': self.pool_size,
+                    'idle_timeout': self.idle_timeout,
+                    'connect_timeout': self.connect_timeout,
+                    'split_bodies': self.isSet('split-bodies')
                 }
                 if not data.has_postgre:
                     logger.error('PostgreSQL database driver is not installed.')
                 else:
                     self.connector = data.PostgreSQLConnector
+                    self.listening = True
+                    self.cache_file = self.cache_path('preferences.json', 'host', 'port', 'dbname', 'user')
+                    self.snapshot_file = self.cache_path(self.snapshot_name, 'host', 'port', 'dbname', 'user')
+                    if self.isSet('replica'):
+                        self.replica_file = self.cache_path('replica.db', 'host', 'port', 'dbname', 'user',
+                                                            directory=self.data_dir)
 
             case 'mysql':
-                if self.isSet('sqlite-db'):
-                    logger.warning(f'{type(self).__name__}::Ignoring option --sqlite-db {self.value('f')}')
+                for opt in ['sqlite-db', 'sqlite-profile', 'journal-file', 'pool-size']:
+                    if self.isSet(opt):
+                        logger.warning(f'{type(self).__name__}::Ignoring option --{opt} {self.value(opt)}')
                 self.params = {
                     'host': self.value('host'),
                     'port': int(self.value('port')) if self.isSet('port') else 3306,
                     'database': self.value('dbname'),
                     'user': self.value('user'),
-                    'password': self.value('password')
+                    'password': self.value('password'),
+                    'idle_timeout': self.idle_timeout,
+                    'connect_timeout': self.connect_timeout,
+                    'split_bodies': self.isSet('split-bodies')
                 }
                 if not data.has_mysql:
                     logger.error('MySQL database driver is not installed.')
                 else:
                     self.connector = data.MySQLConnector
+                    self.cache_file = self.cache_path('preferences.json', 'host', 'port', 'database', 'user')
+                    self.snapshot_file = self.cache_path(self.snapshot_name, 'host', 'port', 'database', 'user')
+                    if self.isSet('replica'):
+                        self.replica_file = self.cache_path('replica.db', 'host', 'port', 'database', 'user',
+                                                            directory=self.data_dir)
 
             case 'none':
-                for opt in ['sqlite-db', 'host', 'port', 'dbname', 'user', 'password']:
+                for opt in ['sqlite-db', 'sqlite-profile', 'journal-file', 'split-bodies', 'zstd', 'host', 'port',
+                            'dbname', 'user', 'password', 'replica', 'sync-interval', 'pool-size', 'idle-timeout',
+                            'connect-timeout']:
                     if self.isSet(opt):
                         logger.warning(f'{type(self).__name__}::Ignoring option --{opt} {self.value(opt)}')
 
             case _:
                 logger.error(f'Not recognized storage type: {self.value('type')}')
 
+    def cache_path(self, name: str, *keys: str, directory: str|None = None) -> str:
+        """ Return path of a cache file kept separately for each storage location.
+
+        Args:
+            name (str): The cache file name.
+            *keys (str): Names of connection parameters identifying the storage location.
+            directory (str, optional): The base directory. Defaults to None - cache_dir. """
+        target = ':'.join([self.value('type'), *(os.path.abspath(self.params[key]) if key in ('db', 'path')
+                                                  else str(self.params[key]) for key in keys)])
+        return os.path.join(directory or self.cache_dir, hashlib.sha1(target.encode()).hexdigest()[:16], name)
+
     def connect(self) -> data.StorageConnector:
         """ Connect to the specified database and return the StorageConnector. """
         try:
+            if self.replica_file is not None:
+                os.makedirs(os.path.dirname(self.replica_file), exist_ok=True)
+                return data.ReplicaConnector(self.replica_file, partial(self.connector, **self.params),
+                                             self.sync_interval)
             return self.connector(**self.params)
         except Exception as error:
             logger.error(f'{type(self).__name__}::Error connecting to database: {error}')
             return data.NoStorage()
 
+    def listener(self) -> 'data.ChangeListener|None':
+        """ Return a listener of changes made by other clients, if the database supports it. """
+        if not self.listening:
+            return None
+        return data.ChangeListener(**{key: self.params[key] for key in
+                                      ('host', 'port', 'dbname', 'user', 'password', 'connect_timeout')})
+
 def main() -> int:
     """ Main function used to run the program. """
     app = NoteApplication(sys.argv)
     parser = ArgumentParser()
     parser.process(app)
-    NoteWidget.db = parser.connect()
-    app.start()
+    app.workspace = parser.workspace
+    app.BATCH = parser.batch_size
+    app.HIDDEN = parser.hidden_windows
+    if parser.snapshot_file is not None:
+        app.restore(data.Snapshot(parser.snapshot_file))
+    connector = parser.connect()
+    queue = data.WriteBehindQueue(connector)
+    queue.writer.failed.connect(app.storage_failed)
+    queue.writer.written.connect(app.storage_written)
+    NoteWidget.db = data.PreferencesCache(queue, parser.cache_file)
+    if isinstance(connector, data.ReplicaConnector):
+        connector.syncer.notes_pulled.connect(lambda rows, deleted: app.refresh([row[0] for row in rows], deleted))
+        connector.syncer.preferences_pulled.connect(app.refresh_preferences)
+    if (listener := parser.listener()) is not None:
+        if isinstance(connector, data.ReplicaConnector):
+            listener.notes_changed.connect(connector.refresh)
+            listener.preferences_changed.connect(connector.refresh)
+            listener.reconnected.connect(connector.refresh)
+        else:
+            listener.notes_changed.connect(app.refresh)
+            listener.preferences_changed.connect(app.refresh_preferences)
+            listener.reconnected.connect(app.refresh_all)
+        app.aboutToQuit.connect(listener.stop)
+    NoteWidget.aio = data.ThreadedConnector(NoteWidget.db)
+    app.aboutToQuit.connect(NoteWidget.db.close)
+    app.start(not isinstance(connector, data.NoStorage))
     return app.exec()
 
 if __name__ == '__main__':
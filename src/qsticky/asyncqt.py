@@ -0,0 +1,110 @@
+""" Integration of asyncio coroutines with the Qt event loop.
+
+Storage coroutines run in an asyncio event loop on a separate thread. GUI code runs
+as Task coroutines in the Qt thread and awaits their results without blocking repaints. """
+import asyncio
+import logging
+from concurrent.futures import Future
+
+from PyQt6.QtCore import QObject, QThread, Qt
+from PyQt6.QtCore import pyqtSignal as Signal
+
+logger = logging.getLogger(__name__)
+
+class Deferred:
+    """ Awaitable result of a coroutine submitted to the EventLoop, usable in Task coroutines. """
+    def __init__(self, future: Future) -> None:
+        """ Wrap the future.
+
+        Args:
+            future (Future): Future result of the submitted coroutine. """
+        self.future = future
+
+    def __await__(self):
+        if not self.future.done():
+            yield self.future
+        return self.future.result()
+
+
+class EventLoop(QThread):
+    """ Thread running an asyncio event loop. """
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.loop = asyncio.new_event_loop()
+
+    def run(self) -> None:
+        """ Run the asyncio event loop until stopped. """
+        logger.debug('EventLoop::Started')
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+        self.loop.run_until_complete(self.loop.shutdown_asyncgens())
+        self.loop.close()
+        logger.debug('EventLoop::Stopped')
+
+    def submit(self, coro) -> Deferred:
+        """ Schedule the coroutine in the asyncio event loop.
+
+        Args:
+            coro (coroutine): The coroutine to run.
+
+        Returns:
+            Deferred: Awaitable result of the coroutine. """
+        return Deferred(asyncio.run_coroutine_threadsafe(coro, self.loop))
+
+    def stop(self) -> None:
+        """ Stop the asyncio event loop and wait for the thread to finish. """
+        if self.isRunning():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.wait()
+
+
+class Task(QObject):
+    """ Coroutine running in the Qt thread, resumed when awaited Deferred results are ready.
+
+    Signals:
+        finished (object): Emitted with the value returned by the coroutine.
+        failed (Exception): Emitted with the exception raised by the coroutine. """
+    finished = Signal(object)
+    failed = Signal(Exception)
+    resumed = Signal()
+    running = set()     # keeps references to unfinished tasks
+
+    def __init__(self, coro, *args, **kwargs) -> None:
+        """ Start running the coroutine.
+
+        Args:
+            coro (coroutine): The coroutine to run, may await Deferred objects only. """
+        super().__init__(*args, **kwargs)
+        self.coro = coro
+        self.resumed.connect(self.step, Qt.ConnectionType.QueuedConnection)
+        self.running.add(self)
+        self.step()
+
+    def step(self) -> None:
+        """ Run the coroutine until it awaits a result or finishes. """
+        try:
+            future = self.coro.send(None)
+        except StopIteration as stop:
+            self.running.discard(self)
+            self.finished.emit(stop.value)
+        except Exception as error:
+            logger.error(f'Task::{self.coro.__qualname__} failed: {error!r}')
+            self.running.discard(self)
+            self.failed.emit(error)
+        else:
+            if not isinstance(future, Future):
+                self.coro.close()
+                self.running.discard(self)
+                raise TypeError(f'Task::{self.coro.__qualname__} awaited {future!r}, expected Deferred')
+            future.add_done_callback(lambda _: self.resumed.emit())
+
+
+def spawn(coro) -> Task:
+    """ Run the coroutine in the Qt thread.
+
+    Args:
+        coro (coroutine): The coroutine to run, may await Deferred objects only.
+
+    Returns:
+        Task: The running task. """
+    return Task(coro)
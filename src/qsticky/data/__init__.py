@@ -1,6 +1,12 @@
 """ Subpackage with classes that perform tasks related to storing notes. """
-from .abstract import StorageConnector, NoStorage, DataBaseConnector
+from .abstract import FIELDS, COLUMNS, WORKSPACE, StorageConnector, NoStorage, DataBaseConnector
 from .sqlite import SQLiteConnector
+from .journal import JournalConnector
+from .writebehind import WriteBehindQueue
+from .cache import PreferencesCache
+from .snapshot import Snapshot
+from .replica import ReplicaConnector
+from .asynchronous import AsyncStorageConnector, ThreadedConnector
 
 try:
     import psycopg2
@@ -8,7 +14,7 @@ except ImportError:
     has_postgre = False
 else:
     has_postgre = True
-    from .psql import PostgreSQLConnector
+    from .psql import PostgreSQLConnector, ChangeListener
 
 try:
     import MySQLdb
@@ -21,6 +27,13 @@ else:
 __all__ = [
     "abstract",
     "sqlite",
+    "journal",
     "psql",
     "mysql",
+    "writebehind",
+    "cache",
+    "snapshot",
+    "replica",
+    "codec",
+    "asynchronous",
 ]
@@ -1,12 +1,36 @@
 """ Defines helper classes for storing and retrieving NoteWidget state information. """
 import logging
+import re
 from abc import ABC, abstractmethod
+from collections.abc import Iterator
 from functools import wraps
 from contextlib import closing
 
-from PyQt6.QtWidgets import QMessageBox
+from PyQt6.QtCore import QThread
+from PyQt6.QtWidgets import QApplication, QMessageBox
+
+from qsticky.data import codec
 
 logger = logging.getLogger(__package__)
+# Groups of note fields that change independently
+FIELDS = {
+    'text': ('text',),
+    'geometry': ('xpos', 'ypos', 'width', 'height'),
+    'style': ('bgcolor', 'font', 'fcolor'),
+}
+# Order of note fields in retrieved rows, after the id
+COLUMNS = ('text', *FIELDS['geometry'], *FIELDS['style'])
+# Workspace of notes saved without one
+WORKSPACE = 'default'
+
+def search_words(query: str) -> list[str]:
+    """ Return the words of a search query, stripped of punctuation and case. """
+    return re.findall(r'\w+', query.casefold())
+
+def matches(text: str, words: list[str]) -> bool:
+    """ Check if every word begins some word of the text, the way full-text indexes match prefixes. """
+    tokens = set(re.findall(r'\w+', text.casefold()))
+    return all(any(token.startswith(word) for token in tokens) for word in words)
 
 class StorageConnector(ABC):
     """ An abstract class for note-storing functionality. """
@@ -16,8 +40,81 @@ class StorageConnector(ABC):
         raise NotImplementedError
 
     @abstractmethod
-    def retrieve(self) -> list[tuple]:
-        """ Return a list of all stored notes. """
+    def retrieve(self, rowids: list[int]|None = None, workspace: str|None = None) -> list[tuple]:
+        """ Return a list of stored notes.
+
+        Args:
+            rowids (list[int], optional): The Id numbers of the notes. Defaults to None - all notes.
+            workspace (str, optional): Return only notes of the workspace. Defaults to None - any.
+
+        Returns:
+            list[tuple]: Tuples of id, text, xpos, ypos, width, height, bgcolor, font, fcolor. """
+        raise NotImplementedError
+
+    @abstractmethod
+    def retrieve_meta(self, workspace: str|None = None) -> list[tuple]:
+        """ Return a list of all stored notes without text.
+
+        Args:
+            workspace (str, optional): Return only notes of the workspace. Defaults to None - any.
+
+        Returns:
+            list[tuple]: Tuples of id, xpos, ypos, width, height, bgcolor, font, fcolor. """
+        raise NotImplementedError
+
+    @abstractmethod
+    def retrieve_bodies(self, rowids: list[int]|None = None, workspace: str|None = None) -> list[tuple]:
+        """ Return texts of stored notes.
+
+        Args:
+            rowids (list[int], optional): The Id numbers of the notes. Defaults to None - all notes.
+            workspace (str, optional): Return only notes of the workspace. Defaults to None - any.
+
+        Returns:
+            list[tuple]: Tuples of id, text. """
+        raise NotImplementedError
+
+    @abstractmethod
+    def retrieve_workspaces(self, rowids: list[int]|None = None) -> list[tuple]:
+        """ Return workspaces of stored notes.
+
+        Args:
+            rowids (list[int], optional): The Id numbers of the notes. Defaults to None - all notes.
+
+        Returns:
+            list[tuple]: Tuples of id, workspace. """
+        raise NotImplementedError
+
+    @abstractmethod
+    def changes_since(self, token: int|None = None) -> tuple[list[tuple], list[int]|None, int]:
+        """ Return notes changed and deleted since the token was issued.
+
+        Args:
+            token (int, optional): The token returned by the previous call. Defaults to None - all notes.
+
+        Returns:
+            tuple[list[tuple], list[int]|None, int]: Rows of changed notes (see retrieve), the Id numbers
+                of deleted notes and the token for the next call. Deleted notes are None if the token
+                is too old to know them, rows then hold all notes. """
+        raise NotImplementedError
+
+    @abstractmethod
+    def search(self, query: str) -> list[int]:
+        """ Find notes containing all words of the query, as words or their beginnings.
+
+        Args:
+            query (str): The searched words.
+
+        Returns:
+            list[int]: The Id numbers of found notes. """
+        raise NotImplementedError
+
+    @abstractmethod
+    def new_id(self) -> int:
+        """ Reserve an id for a new note, not used by any note stored before nor reserved by another client.
+
+        Returns:
+            int: The Id number. """
         raise NotImplementedError
 
     @abstractmethod
@@ -25,7 +122,8 @@ class StorageConnector(ABC):
         """ Save a note in the storage.
 
         Args:
-            note (dict): Dictionary of note parameters.
+            note (dict): Dictionary of note parameters. A new note is put in its 'workspace',
+                if given, or WORKSPACE; saving an existing one keeps its workspace.
 
         Returns:
             bool: True if note saved successfully, False otherwise. """
@@ -36,7 +134,7 @@ class StorageConnector(ABC):
         """ Update note record in the storage.
 
         Args:
-            note (dict): Dictionary of note parameters.
+            note (dict): Dictionary of note id and parameters of changed field groups (see FIELDS).
 
         Returns:
             bool: True if note updated successfully, False otherwise. """
@@ -53,6 +151,39 @@ class StorageConnector(ABC):
             bool: True if note deleted successfully, False otherwise. """
         raise NotImplementedError
 
+    @abstractmethod
+    def save_many(self, notes: list[dict]) -> bool:
+        """ Save many notes in the storage at once.
+
+        Args:
+            notes (list[dict]): List of dictionaries of note parameters.
+
+        Returns:
+            bool: True if all notes saved successfully, False otherwise. """
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_many(self, notes: list[dict]) -> bool:
+        """ Update many note records in the storage at once.
+
+        Args:
+            notes (list[dict]): List of dictionaries of note id and changed parameters.
+
+        Returns:
+            bool: True if all notes updated successfully, False otherwise. """
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_many(self, rowids: list[int]) -> bool:
+        """ Delete many note records from the storage at once.
+
+        Args:
+            rowids (list[int]): The Id numbers of the notes.
+
+        Returns:
+            bool: True if all notes deleted successfully, False otherwise. """
+        raise NotImplementedError
+
     @abstractmethod
     def get_preferences(self) -> tuple:
         """ Retrieve the application global preferences.
@@ -72,22 +203,77 @@ class StorageConnector(ABC):
             bool: True if preferences saved successfully, False otherwise. """
         raise NotImplementedError
 
+    def iter_notes(self, batch_size: int = 100, workspace: str|None = None) -> Iterator[list[tuple]]:
+        """ Yield stored notes in batches, so they can be used before all of them are read.
+
+        Args:
+            batch_size (int, optional): The number of notes in a batch. Defaults to 100.
+            workspace (str, optional): Yield only notes of the workspace, most recently changed first.
+                Defaults to None - any.
+
+        Yields:
+            list[tuple]: Tuples of id, text, xpos, ypos, width, height, bgcolor, font, fcolor. """
+        rows = self.retrieve(workspace=workspace)
+        for start in range(0, len(rows), batch_size):
+            yield rows[start:start + batch_size]
+
+    def commit(self) -> None:
+        """ Make the writes done so far durable, for connectors deferring them. """
+
+    def close(self) -> None:
+        """ Release the storage resources. """
+
 
 class NoStorage(StorageConnector):
     """ Defines a dummy connector for no storage functionality. """
     def __init__(self) -> None:
         logger.warning(f'NoStorage::Running in memory')
+        self.free = []      # ids of deleted notes, to be reused
+        self.next = 0
+
+    def retrieve(self, rowids: list[int]|None = None, workspace: str|None = None) -> list[tuple]:
+        return []
 
-    def retrieve(self) -> list[tuple]:
+    def retrieve_meta(self, workspace: str|None = None) -> list[tuple]:
         return []
 
+    def retrieve_bodies(self, rowids: list[int]|None = None, workspace: str|None = None) -> list[tuple]:
+        return []
+
+    def retrieve_workspaces(self, rowids: list[int]|None = None) -> list[tuple]:
+        return []
+
+    def changes_since(self, token: int|None = None) -> tuple[list[tuple], list[int]|None, int]:
+        return [], [], 0
+
+    def search(self, query: str) -> list[int]:
+        return []
+
+    def new_id(self) -> int:
+        if self.free:
+            return self.free.pop()
+        self.next += 1
+        return self.next - 1
+
     def save(self, note: dict) -> bool:
-        return True
+        return self.save_many([note])
 
     def update(self, note: dict) -> bool:
         return True
 
     def delete(self, rowid: int) -> bool:
+        return self.delete_many([rowid])
+
+    def save_many(self, notes: list[dict]) -> bool:
+        # Ids of notes kept by the application, e.g. restored from snapshot, are not handed out
+        self.next = max([self.next, *(note['id'] + 1 for note in notes)])
+        return True
+
+    def update_many(self, notes: list[dict]) -> bool:
+        return True
+
+    def delete_many(self, rowids: list[int]) -> bool:
+        self.free.extend(rowid for rowid in rowids if rowid < self.next)
         return True
 
     def get_preferences(self) -> tuple:
@@ -98,7 +284,27 @@ class NoStorage(StorageConnector):
 
 
 class DataBaseConnector(StorageConnector):
-    """ Defines aa abstract connector for SQL databases. """
+    """ Defines aa abstract connector for SQL databases.
+
+    SQL dictionary values are statements or tuples of statements executed in one transaction.
+
+    Class Attributes:
+        SQL (dict): SQL statements by key.
+        SQL_SPLIT (dict): Statements replacing the SQL ones, when note texts are kept in separate
+            note_bodies table.
+        RETRY (frozenset): Keys of idempotent SQL statements, safe to repeat after reconnecting.
+        TOMBSTONES (int): The number of newest tombstones of deleted notes kept for replicas. """
+    SQL = {}
+    SQL_SPLIT = {}
+    RETRY = frozenset({
+        'init', 'retrieve', 'retrieve_note', 'retrieve_meta', 'retrieve_bodies', 'retrieve_body', 'upsert', 'update',
+        'update_text', 'update_geometry', 'update_style', 'delete', 'pref_init', 'pref_upsert',
+        'pref_get', 'bodies_exist', 'compress_exist', 'compress_scan', 'changes', 'rev_exist', 'revision_init',
+        'search', 'index_scan', 'index_text', 'search_exist', 'retrieve_in', 'retrieve_meta_in', 'retrieve_bodies_in',
+        'retrieve_workspaces', 'retrieve_workspace', 'workspace_exist', 'ids_init', 'new_id', 'horizon', 'prune',
+    })
+    TOMBSTONES = 1000
+
     @abstractmethod
     def execute_sql(self, statement: str, values:dict|int={}) -> 'cursor':
         """ Execute SQL statement on the database.
@@ -115,22 +321,248 @@ class DataBaseConnector(StorageConnector):
             ValueError: If the provided argument is invalid. """
         raise NotImplementedError
 
-    def retrieve(self) -> list:
-        with closing(self.execute_sql('retrieve')) as cursor:
+    @abstractmethod
+    def execute_many(self, batch: list[tuple[str, list[dict|int]]]) -> bool:
+        """ Execute SQL statements for sequences of values in a single transaction.
+
+        Args:
+            batch (list[tuple]): Pairs of the key of SQL statement and a list of dictionaries
+                representing the SQL statement values or note ids.
+
+        Returns:
+            bool: True if the transaction was committed.
+
+        Raises:
+            ValueError: If the provided argument is invalid. """
+        raise NotImplementedError
+
+    def statements(self, statement: str) -> tuple[str, ...]:
+        """ Return SQL statements of the key.
+
+        Raises:
+            ValueError: If there is no such key. """
+        if statement not in self.SQL:
+            raise ValueError(f"Invalid SQL key argument: {statement}")
+        if isinstance(sql := self.SQL[statement], str):
+            return (sql,)
+        return sql
+
+    def init_schema(self, split_bodies: bool) -> None:
+        """ Create tables and choose the statements fitting the layout of database.
+
+        Args:
+            split_bodies (bool): Move note texts to separate note_bodies table if not done yet. """
+        self.execute_sql('init')
+        self.execute_sql('pref_init')
+        with closing(self.execute_sql('rev_exist')) as cursor:
+            revisions = cursor.fetchone() is not None
+        if not revisions:
+            self.execute_sql('rev_init')
+        self.execute_sql('revision_init')
+        self.execute_sql('prune', {'keep': self.TOMBSTONES})
+        self.execute_sql('ids_init')
+        with closing(self.execute_sql('workspace_exist')) as cursor:
+            workspaces = cursor.fetchone() is not None
+        if not workspaces:
+            self.execute_sql('workspace_init')
+        with closing(self.execute_sql('bodies_exist')) as cursor:
+            split = cursor.fetchone() is not None
+        if split:
+            self.SQL = {**self.SQL, **self.SQL_SPLIT}
+        with closing(self.execute_sql('compress_exist')) as cursor:
+            compressing = cursor.fetchone() is not None
+        if not compressing:
+            self.execute_sql('compress_init')
+            self.compress_all()
+        if split_bodies and not split:
+            logger.info(f'{type(self).__name__}::Moving note texts to note_bodies table')
+            self.execute_sql('bodies_init')
+            self.SQL = {**self.SQL, **self.SQL_SPLIT}
+        with closing(self.execute_sql('search_exist')) as cursor:
+            searchable = cursor.fetchone() is not None
+        if not searchable:
+            logger.info(f'{type(self).__name__}::Building full-text index')
+            self.execute_sql('search_init')
+        self.index_all()
+
+    def compress_all(self) -> None:
+        """ Compress large texts of notes stored before compression was supported. """
+        with closing(self.execute_sql('compress_scan', {'size': codec.THRESHOLD})) as cursor:
+            rows = cursor.fetchall()
+        notes = [note for rowid, text in rows if (note := self.pack({'id': rowid, 'text': text}))['body']]
+        logger.info(f'{type(self).__name__}::Compressing {len(notes)} large notes')
+        if notes:
+            self.execute_many([('update_text', notes)])
+
+    def index_all(self) -> None:
+        """ Store words of texts compressed before they were kept for the full-text index. """
+        with closing(self.execute_sql('index_scan')) as cursor:
+            rows = cursor.fetchall()
+        notes = []
+        for rowid, body in rows:
+            if (text := self.decode(rowid, '', body)) and (text := codec.words(text)):
+                notes.append({'id': rowid, 'text': text})
+        if notes:
+            logger.info(f'{type(self).__name__}::Indexing {len(notes)} compressed notes')
+            self.execute_many([('index_text', notes)])
+
+    def decode(self, rowid: int, text: str, body: bytes|None) -> str|None:
+        """ Return the note text, None if it can't be decompressed (see codec.decode), so one note
+        e.g. compressed with zstd by another client doesn't fail reading all of them. """
+        try:
+            return codec.decode(text, body)
+        except ValueError as error:
+            logger.warning(f'{type(self).__name__}::Skipping note {rowid}: {error}')
+            return None
+
+    @staticmethod
+    def pack(note: dict) -> dict:
+        """ Return the note with large text compressed into body (see codec.encode) and the workspace
+        of a new note filled in. """
+        if 'text' not in note:
+            return note
+        text, body = codec.encode(note['text'])
+        return {'workspace': WORKSPACE, **note, 'text': text, 'body': body}
+
+    @staticmethod
+    def update_statements(note: dict) -> list[str]:
+        """ Return keys of SQL statements updating the changed field groups of a note. """
+        groups = [group for group, fields in FIELDS.items() if fields[0] in note]
+        if groups == ['text', 'geometry']:
+            return ['update']
+        return [f'update_{group}' for group in groups]
+
+    def fetch(self, statement: str, note: str|None, rowids: list[int]|None, workspace: str|None) -> list:
+        """ Return rows of all notes, of notes in the workspace or of the notes with given ids.
+
+        Args:
+            statement (str): Key of the statement selecting all notes, suffixed '_in' for a workspace.
+            note (str): Key of the statement selecting a note by id and optional workspace. """
+        if rowids is not None:
+            rows = []
+            for rowid in rowids:
+                with closing(self.execute_sql(note, {'id': rowid, 'workspace': workspace})) as cursor:
+                    rows.extend(cursor.fetchall())
+            return rows
+        if workspace is not None:
+            statement, values = f'{statement}_in', {'workspace': workspace}
+        else:
+            values = {}
+        with closing(self.execute_sql(statement, values)) as cursor:
             return cursor.fetchall()
 
+    def retrieve(self, rowids: list[int]|None = None, workspace: str|None = None) -> list:
+        rows = self.fetch('retrieve', 'retrieve_note', rowids, workspace)
+        return [(row[0], text, *row[2:-1]) for row in rows
+                if (text := self.decode(row[0], row[1], row[-1])) is not None]
+
+    def retrieve_meta(self, workspace: str|None = None) -> list:
+        return self.fetch('retrieve_meta', None, None, workspace)
+
+    def iter_notes(self, batch_size: int = 100, workspace: str|None = None) -> Iterator[list[tuple]]:
+        if workspace is not None:
+            batches = self.stream('retrieve_in', {'workspace': workspace}, batch_size)
+        else:
+            batches = self.stream('retrieve', {}, batch_size)
+        for rows in batches:
+            yield [(row[0], text, *row[2:-1]) for row in rows
+                   if (text := self.decode(row[0], row[1], row[-1])) is not None]
+
+    def stream(self, statement: str, values: dict, batch_size: int) -> Iterator[list[tuple]]:
+        """ Yield rows of the query in batches, without reading all of them at once.
+
+        Args:
+            statement (str): Key of the SQL query.
+            values (dict): Values of the query parameters.
+            batch_size (int): The number of rows in a batch.
+
+        Yields:
+            list[tuple]: The rows. """
+        with closing(self.execute_sql(statement, values)) as cursor:
+            while rows := cursor.fetchmany(batch_size):
+                yield rows
+
+    def retrieve_bodies(self, rowids: list[int]|None = None, workspace: str|None = None) -> list:
+        rows = self.fetch('retrieve_bodies', 'retrieve_body', rowids, workspace)
+        return [(row[0], text) for row in rows if (text := self.decode(*row)) is not None]
+
+    def retrieve_workspaces(self, rowids: list[int]|None = None) -> list:
+        return self.fetch('retrieve_workspaces', 'retrieve_workspace', rowids, None)
+
+    def changes_since(self, token: int|None = None) -> tuple[list, list|None, int]:
+        rev = -1 if token is None else token
+        with closing(self.execute_sql('changes', {'rev': rev})) as cursor:
+            rows = cursor.fetchall()
+        # Read after the changes, so tombstones pruned meanwhile are either read or reported missing
+        with closing(self.execute_sql('horizon')) as cursor:
+            (horizon,) = cursor.fetchone()
+        if token is not None and token < horizon:
+            notes, _, token = self.changes_since()
+            return notes, None, token
+        # Rows end with revision, tombstone flag; the body comes before them
+        token = max([max(rev, 0), *(row[-2] for row in rows)])
+        notes = [(row[0], text, *row[2:-3]) for row in rows
+                 if not row[-1] and (text := self.decode(row[0], row[1], row[-3])) is not None]
+        return notes, [row[0] for row in rows if row[-1]], token
+
+    def search(self, query: str) -> list[int]:
+        if not (words := search_words(query)):
+            return []
+        # Compressed notes are found by their words kept in the text column
+        with closing(self.execute_sql('search', {'query': self.search_terms(words)})) as cursor:
+            return sorted({row[0] for row in cursor.fetchall()})
+
+    @staticmethod
+    @abstractmethod
+    def search_terms(words: list[str]) -> str:
+        """ Return the full-text query matching notes containing all words or their beginnings. """
+        raise NotImplementedError
+
+    def new_id(self) -> int:
+        with closing(self.execute_sql('new_id')) as cursor:
+            return cursor.fetchone()[0]
+
     def save(self, note: dict) -> bool:
-        with closing(self.execute_sql('upsert', note)) as cursor:
+        with closing(self.execute_sql('upsert', self.pack(note))) as cursor:
             return bool(cursor)
 
     def update(self, note: dict) -> bool:
-        with closing(self.execute_sql('update', note)) as cursor:
-            return bool(cursor)
+        if not (statements := self.update_statements(note)):
+            logger.debug(f'{type(self).__name__}::Note {note["id"]} unchanged, skipping update')
+            return True
+        note = self.pack(note)
+        if len(statements) == 1:
+            with closing(self.execute_sql(statements[0], note)) as cursor:
+                return bool(cursor)
+        return self.execute_many([(statement, [note]) for statement in statements])
 
     def delete(self, rowid: int) -> bool:
         with closing(self.execute_sql('delete', rowid)) as cursor:
             return bool(cursor)
 
+    def save_many(self, notes: list[dict]) -> bool:
+        if not notes:
+            return True
+        return self.execute_many([('upsert', [self.pack(note) for note in notes])])
+
+    def update_many(self, notes: list[dict]) -> bool:
+        if not (batch := self.update_batch(notes)):
+            return True
+        return self.execute_many(batch)
+
+    def update_batch(self, notes: list[dict]) -> list[tuple[str, list[dict]]]:
+        """ Return the notes grouped by SQL statements updating them, see execute_many. """
+        batch = {}
+        for note in map(self.pack, notes):
+            for statement in self.update_statements(note):
+                batch.setdefault(statement, []).append(note)
+        return list(batch.items())
+
+    def delete_many(self, rowids: list[int]) -> bool:
+        if not rowids:
+            return True
+        return self.execute_many([('delete', list(rowids))])
+
     def get_preferences(self) -> tuple:
         with closing(self.execute_sql('pref_get')) as cursor:
             return cursor.fetchone()
@@ -139,6 +571,14 @@ class DataBaseConnector(StorageConnector):
         with closing(self.execute_sql('pref_upsert', preferences)) as cursor:
             return bool(cursor)
 
+    def close(self) -> None:
+        logger.info(f'{type(self).__name__}::Closing connection')
+        self.conn.close()
+
+    def reconnect(self) -> None:
+        """ Drop broken database connections, so the next statement uses a new one. """
+        raise NotImplementedError
+
 
 class HandleError:
     """ Decorator class for catching and logging database errors. """
@@ -156,6 +596,9 @@ class HandleError:
                 return func(obj, *args, **kwargs)
             except self.error as e:
                 logger.error(f'{type(obj).__name__}.{func.__name__} failed! Args: {args} Kwargs: {kwargs2}')
+                # Dialogs are allowed in GUI thread only, workers report errors by themselves
+                if (app := QApplication.instance()) is None or QThread.currentThread() is not app.thread():
+                    raise
                 QMessageBox.critical(
                     None,
                     'Error',
@@ -166,3 +609,23 @@ Args: {args} Kwargs: {kwargs2}
                 )
                 raise
         return wrapper
+
+
+class Retry:
+    """ Decorator class repeating idempotent SQL statements once after a lost connection. """
+    def __init__(self, error):
+        self.error = error
+
+    def __call__(self, func):
+        @wraps(func)
+        def wrapper(obj: DataBaseConnector, statement: str|list, *args, **kwargs):
+            try:
+                return func(obj, statement, *args, **kwargs)
+            except self.error as e:
+                keys = [statement] if isinstance(statement, str) else [key for key, _ in statement]
+                if not obj.RETRY.issuperset(keys):
+                    raise
+                logger.warning(f'{type(obj).__name__}.{func.__name__} lost connection, retrying: {e}')
+                obj.reconnect()
+                return func(obj, statement, *args, **kwargs)
+        return wrapper
@@ -0,0 +1,152 @@
+""" Defines asynchronous counterparts of storage connectors.
+For use from coroutines running in an asyncio event loop. """
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+
+from qsticky.data.abstract import StorageConnector
+
+logger = logging.getLogger(__package__)
+
+class AsyncStorageConnector(ABC):
+    """ An abstract class for asynchronous note-storing functionality.
+    Methods mirror the ones of StorageConnector. """
+    @abstractmethod
+    async def retrieve(self, rowids: list[int]|None = None, workspace: str|None = None) -> list[tuple]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def retrieve_meta(self, workspace: str|None = None) -> list[tuple]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def retrieve_bodies(self, rowids: list[int]|None = None, workspace: str|None = None) -> list[tuple]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def retrieve_workspaces(self, rowids: list[int]|None = None) -> list[tuple]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def next_batch(self, batches: Iterator[list[tuple]]) -> list[tuple]:
+        """ Return the next batch of the iterator, e.g. StorageConnector.iter_notes, an empty list at its end. """
+        raise NotImplementedError
+
+    @abstractmethod
+    async def changes_since(self, token: int|None = None) -> tuple[list[tuple], list[int]|None, int]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def search(self, query: str) -> list[int]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def new_id(self) -> int:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def save(self, note: dict) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def update(self, note: dict) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def delete(self, rowid: int) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def save_many(self, notes: list[dict]) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def update_many(self, notes: list[dict]) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def delete_many(self, rowids: list[int]) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_preferences(self) -> tuple:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def save_preferences(self, preferences: dict) -> bool:
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        """ Release the storage resources. """
+
+
+class ThreadedConnector(AsyncStorageConnector):
+    """ Asynchronous connector running methods of a blocking StorageConnector in a worker thread. """
+    def __init__(self, connector: StorageConnector) -> None:
+        """ Initialize the worker thread.
+
+        Args:
+            connector (StorageConnector): The blocking connector. """
+        self.connector = connector
+        # One worker, so the connector is never used concurrently
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=type(connector).__name__)
+
+    async def call(self, method: str, *args):
+        """ Call the connector method in the worker thread and return its result. """
+        logger.debug(f'{type(self).__name__}.{method}{args}')
+        func = getattr(self.connector, method)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def retrieve(self, rowids: list[int]|None = None, workspace: str|None = None) -> list[tuple]:
+        return await self.call('retrieve', rowids, workspace)
+
+    async def retrieve_meta(self, workspace: str|None = None) -> list[tuple]:
+        return await self.call('retrieve_meta', workspace)
+
+    async def retrieve_bodies(self, rowids: list[int]|None = None, workspace: str|None = None) -> list[tuple]:
+        return await self.call('retrieve_bodies', rowids, workspace)
+
+    async def retrieve_workspaces(self, rowids: list[int]|None = None) -> list[tuple]:
+        return await self.call('retrieve_workspaces', rowids)
+
+    async def next_batch(self, batches: Iterator[list[tuple]]) -> list[tuple]:
+        return await asyncio.get_running_loop().run_in_executor(self.executor, next, batches, [])
+
+    async def changes_since(self, token: int|None = None) -> tuple[list[tuple], list[int]|None, int]:
+        return await self.call('changes_since', token)
+
+    async def search(self, query: str) -> list[int]:
+        return await self.call('search', query)
+
+    async def new_id(self) -> int:
+        return await self.call('new_id')
+
+    async def save(self, note: dict) -> bool:
+        return await self.call('save', note)
+
+    async def update(self, note: dict) -> bool:
+        return await self.call('update', note)
+
+    async def delete(self, rowid: int) -> bool:
+        return await self.call('delete', rowid)
+
+    async def save_many(self, notes: list[dict]) -> bool:
+        return await self.call('save_many', notes)
+
+    async def update_many(self, notes: list[dict]) -> bool:
+        return await self.call('update_many', notes)
+
+    async def delete_many(self, rowids: list[int]) -> bool:
+        return await self.call('delete_many', rowids)
+
+    async def get_preferences(self) -> tuple:
+        return await self.call('get_preferences')
+
+    async def save_preferences(self, preferences: dict) -> bool:
+        return await self.call('save_preferences', preferences)
+
+    async def close(self) -> None:
+        """ Wait for running calls and stop the worker thread, the connector stays open. """
+        await asyncio.get_running_loop().run_in_executor(None, self.executor.shutdown)
@@ -0,0 +1,162 @@
+""" Defines a storage connector wrapper caching global preferences.
+Spares the database round trip when opening the preferences dialog or creating a note. """
+import json
+import logging
+import os
+import threading
+from collections.abc import Iterator
+
+from qsticky.data.abstract import StorageConnector
+
+logger = logging.getLogger(__package__)
+
+class PreferencesCache(StorageConnector):
+    """ Storage connector wrapper keeping global preferences in memory and in a local file.
+
+    Preferences are looked up in memory, then in the file and only then in the database.
+    The file may be outdated, e.g. changed by another client meanwhile, so preferences read from it
+    serve until refresh reads them from the database. Saving writes through to the database and
+    refreshes both cache tiers. """
+    def __init__(self, connector: StorageConnector, path: str|None = None) -> None:
+        """ Initialize the cache.
+
+        Args:
+            connector (StorageConnector): The connector storing the preferences.
+            path (str, optional): The cache file path. Defaults to None - memory only. """
+        self.connector = connector
+        self.path = path
+        self.lock = threading.Lock()
+        self.preferences = None
+        self.cached = False     # preferences may be cached as None if never saved
+        self.verified = False   # cached preferences were read from the database or saved
+
+    def retrieve(self, rowids: list[int]|None = None, workspace: str|None = None) -> list[tuple]:
+        return self.connector.retrieve(rowids, workspace)
+
+    def retrieve_meta(self, workspace: str|None = None) -> list[tuple]:
+        return self.connector.retrieve_meta(workspace)
+
+    def retrieve_bodies(self, rowids: list[int]|None = None, workspace: str|None = None) -> list[tuple]:
+        return self.connector.retrieve_bodies(rowids, workspace)
+
+    def retrieve_workspaces(self, rowids: list[int]|None = None) -> list[tuple]:
+        return self.connector.retrieve_workspaces(rowids)
+
+    def iter_notes(self, batch_size: int = 100, workspace: str|None = None) -> Iterator[list[tuple]]:
+        return self.connector.iter_notes(batch_size, workspace)
+
+    def changes_since(self, token: int|None = None) -> tuple[list[tuple], list[int]|None, int]:
+        return self.connector.changes_since(token)
+
+    def search(self, query: str) -> list[int]:
+        return self.connector.search(query)
+
+    def new_id(self) -> int:
+        return self.connector.new_id()
+
+    def save(self, note: dict) -> bool:
+        return self.connector.save(note)
+
+    def update(self, note: dict) -> bool:
+        return self.connector.update(note)
+
+    def delete(self, rowid: int) -> bool:
+        return self.connector.delete(rowid)
+
+    def save_many(self, notes: list[dict]) -> bool:
+        return self.connector.save_many(notes)
+
+    def update_many(self, notes: list[dict]) -> bool:
+        return self.connector.update_many(notes)
+
+    def delete_many(self, rowids: list[int]) -> bool:
+        return self.connector.delete_many(rowids)
+
+    def get_preferences(self) -> tuple:
+        with self.lock:
+            if self.cached:
+                return self.preferences
+            if (pref := self.load()) is None:
+                logger.debug(f'{type(self).__name__}::Cache miss, querying database')
+                if pref := self.connector.get_preferences():
+                    self.store(pref)
+                self.verified = True
+            self.preferences, self.cached = pref, True
+            return pref
+
+    def refresh(self) -> bool:
+        """ Replace preferences read from the cache file by the ones in the database.
+
+        Returns:
+            bool: True if they changed. """
+        with self.lock:
+            if self.verified:
+                return False
+            pref = self.connector.get_preferences()
+            changed = not self.cached or pref != self.preferences
+            if changed:
+                logger.debug(f'{type(self).__name__}::Cache file was outdated')
+                if pref:
+                    self.store(pref)
+                else:
+                    self.discard()
+            self.preferences, self.cached, self.verified = pref, True, True
+            return changed
+
+    def save_preferences(self, preferences: dict) -> bool:
+        with self.lock:
+            self.cached = False
+            if not (saved := self.connector.save_preferences(preferences)):
+                self.discard()
+                return saved
+            pref = (preferences['checked'], preferences['bgcolor'], preferences['font'], preferences['fcolor'])
+            self.store(pref)
+            self.preferences, self.cached, self.verified = pref, True, True
+            return saved
+
+    def invalidate(self) -> None:
+        """ Forget cached preferences, e.g. after they were changed by another client. """
+        logger.debug(f'{type(self).__name__}::Invalidated')
+        with self.lock:
+            self.cached = False
+            self.discard()
+
+    def load(self) -> tuple|None:
+        """ Read preferences from the cache file, None if there are none. """
+        if self.path is None:
+            return None
+        try:
+            with open(self.path, encoding='utf-8') as file:
+                return tuple(json.load(file))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, TypeError) as error:
+            logger.warning(f'{type(self).__name__}::Ignoring cache file {self.path}: {error}')
+            return None
+
+    def store(self, pref: tuple) -> None:
+        """ Write preferences to the cache file. """
+        if self.path is None:
+            return
+        temp = f'{self.path}.tmp'
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(temp, 'w', encoding='utf-8') as file:
+                json.dump(list(pref), file)
+            os.replace(temp, self.path)
+        except OSError as error:
+            logger.warning(f'{type(self).__name__}::Could not write cache file {self.path}: {error}')
+
+    def discard(self) -> None:
+        """ Remove the cache file. """
+        if self.path is None:
+            return
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        except OSError as error:
+            logger.warning(f'{type(self).__name__}::Could not remove cache file {self.path}: {error}')
+
+    def close(self) -> None:
+        self.connector.close()
@@ -0,0 +1,75 @@
+""" Defines functions compressing large note texts for storage.
+Compressed texts are stored in the body column, prefixed with one byte naming the codec. The text column
+of a compressed note holds its distinct words instead, so full-text indexes find the note.
+New texts are compressed with zlib unless CODEC is set to ZSTD: texts compressed with zstd can be read
+only by clients with the zstandard package, so it's chosen when all clients sharing the storage have it. """
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    has_zstd = False
+else:
+    has_zstd = True
+
+THRESHOLD = 16 * 1024   # size of UTF-8 encoded text worth compressing
+WORDS = 60 * 1024       # size of words of compressed text kept, fits TEXT column of MySQL
+ZLIB = b'z'
+ZSTD = b's'
+CODEC = ZLIB            # codec of texts compressed from now on
+
+def encode(text: str) -> tuple[str, bytes|None]:
+    """ Compress the text if it's large.
+
+    Args:
+        text (str): The note text.
+
+    Returns:
+        tuple: Text for the text column, its words if compressed, and compressed body or None. """
+    data = text.encode()
+    if len(data) <= THRESHOLD:
+        return text, None
+    if CODEC == ZSTD and has_zstd:
+        body = ZSTD + zstandard.ZstdCompressor().compress(data)
+    else:
+        body = ZLIB + zlib.compress(data)
+    if len(body) >= len(data):
+        return text, None
+    return words(text), body
+
+def words(text: str) -> str:
+    """ Return distinct words of the text in order of appearance, the ones past WORDS bytes left out.
+
+    Args:
+        text (str): The note text. """
+    data = ' '.join(dict.fromkeys(text.split())).encode()
+    if len(data) > WORDS:
+        data = data[:WORDS + 1].rsplit(b' ', 1)[0]
+    return data.decode(errors='ignore')
+
+def decode(text: str, body: bytes|None) -> str:
+    """ Return the note text, decompressing the body if present.
+
+    Args:
+        text (str): The value of text column.
+        body (bytes|None): The value of body column.
+
+    Raises:
+        ValueError: If the body can't be decompressed. """
+    if body is None:
+        return text
+    body = bytes(body)
+    codec, data = body[:1], body[1:]
+    if codec == ZLIB:
+        try:
+            return zlib.decompress(data).decode()
+        except zlib.error as error:
+            raise ValueError(f'Corrupted note compressed with zlib: {error}') from error
+    if codec == ZSTD:
+        if not has_zstd:
+            raise ValueError('Note compressed with zstd, the zstandard package is not installed.')
+        try:
+            return zstandard.ZstdDecompressor().decompress(data).decode()
+        except zstandard.ZstdError as error:
+            raise ValueError(f'Corrupted note compressed with zstd: {error}') from error
+    raise ValueError(f'Unknown note compression: {codec}')
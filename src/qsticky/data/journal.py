@@ -0,0 +1,294 @@
+""" Defines class of append-only journal connector.
+For storing NoteWidget instances in a local log file, where SQLite locking is slow or unreliable. """
+import json
+import logging
+import os
+import struct
+import io
+import threading
+import zlib
+
+try:
+    import fcntl
+except ImportError:     # not available on Windows
+    fcntl = None
+
+from qsticky.data.abstract import COLUMNS, WORKSPACE, StorageConnector, HandleError, search_words, matches
+
+logger = logging.getLogger(__package__)
+
+class JournalConnector(StorageConnector):
+    """ A connector appending every change as a record to a log file.
+
+    The file starts with MAGIC, each record is a HEADER of payload length and CRC32 checksum
+    followed by JSON payload. The state of notes is rebuilt by replaying the records when the file
+    is opened; a torn record left by a crash is cut off. Once the file grows past the threshold, it's
+    rewritten in background with one record per note and per tombstone of a deleted note.
+    Records carry increasing revisions, the tokens of changes_since. The journal is used by one
+    process at a time, it holds a lock of the file with '.lock' suffix while it's open.
+
+    Class Attributes:
+        TOMBSTONES (int): The number of newest tombstones kept when compacting. """
+    MAGIC = b'QSJ1'
+    HEADER = struct.Struct('<II')
+    TOMBSTONES = 1000
+
+    @HandleError(OSError)
+    def __init__(self, path: str, threshold: int = 1024 * 1024) -> None:
+        """ Open the journal file and rebuild the state of notes.
+
+        Args:
+            path (str): The path of the journal file.
+            threshold (int, optional): Size in bytes after which the file is compacted, if it's
+                also twice the size of live data. Defaults to 1 MiB. """
+        self.path = path
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.notes = {}
+        self.preferences = None
+        self.rev = 0                # revision of the last record
+        self.revs = {}              # revisions of the last change of notes
+        self.tombstones = {}        # revisions of deletion of notes
+        self.horizon = 0            # revision of the newest pruned tombstone
+        self.last = -1              # the highest id of notes saved, deleted or reserved
+        self.compactor = None
+        self.compacting = None      # records appended during compaction
+        self.live = 0               # size of records needed to rebuild the state
+        self.lockfile = self.acquire()
+        self.replay()
+        self.file = open(self.path, 'ab')
+        logger.info(f'JournalConnector::Opened - {path}')
+
+    def acquire(self) -> io.TextIOWrapper:
+        """ Lock the lock file of the journal, failing if another process holds it.
+        Compaction replaces the journal file, so a lock of the journal file itself would be lost. """
+        lockfile = open(f'{self.path}.lock', 'a')
+        if fcntl is not None:
+            try:
+                fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lockfile.close()
+                raise OSError(f'Journal file is used by another process: {self.path}') from None
+        return lockfile
+
+    def replay(self) -> None:
+        """ Rebuild the state of notes from the journal file. """
+        try:
+            with open(self.path, 'rb') as file:
+                data = file.read()
+        except FileNotFoundError:
+            data = b''
+        if not data:
+            with open(self.path, 'wb') as file:
+                file.write(self.MAGIC)
+                file.flush()
+                os.fsync(file.fileno())
+            return
+        if not data.startswith(self.MAGIC):
+            raise OSError(f'Not a qsticky journal file: {self.path}')
+        offset, count = len(self.MAGIC), 0
+        while offset + self.HEADER.size <= len(data):
+            length, checksum = self.HEADER.unpack_from(data, offset)
+            payload = data[offset + self.HEADER.size:offset + self.HEADER.size + length]
+            if len(payload) < length or zlib.crc32(payload) != checksum:
+                break
+            self.apply(json.loads(payload))
+            offset += self.HEADER.size + length
+            count += 1
+        if offset < len(data):
+            logger.warning(f'JournalConnector::Cutting off {len(data) - offset} bytes of incomplete record')
+            with open(self.path, 'r+b') as file:
+                file.truncate(offset)
+                os.fsync(file.fileno())
+        self.live = sum(len(self.encode(record)) for record in self.snapshot())
+        logger.debug(f'JournalConnector::Replayed {count} records, {len(self.notes)} notes')
+
+    def apply(self, record: dict) -> None:
+        """ Apply a journal record to the state of notes. """
+        rev = self.rev = max(self.rev, record.get('rev', self.rev + 1))
+        match record['op']:
+            case 'save':
+                old = self.notes.get(record['note']['id'], {})
+                self.notes[record['note']['id']] = {'workspace': old.get('workspace', WORKSPACE), **record['note']}
+                self.last = max(self.last, record['note']['id'])
+                self.revs[record['note']['id']] = rev
+                self.tombstones.pop(record['note']['id'], None)
+            case 'update':
+                if (note := self.notes.get(record['note']['id'])) is not None:
+                    note.update(record['note'])
+                    self.revs[note['id']] = rev
+            case 'delete':
+                if self.notes.pop(record['id'], None) is not None:
+                    self.revs.pop(record['id'], None)
+                    self.tombstones[record['id']] = rev
+            case 'tombstone':
+                self.tombstones[record['id']] = rev
+                self.last = max(self.last, record['id'])
+            case 'horizon':
+                self.horizon = max(self.horizon, record['rev'])
+                self.last = max(self.last, record['last'])
+            case 'preferences':
+                self.preferences = record['preferences']
+
+    def snapshot(self) -> list[dict]:
+        """ Return records rebuilding the current state of notes. """
+        records = [{'op': 'save', 'note': note, 'rev': self.revs[rowid]} for rowid, note in self.notes.items()]
+        records += [{'op': 'tombstone', 'id': rowid, 'rev': rev} for rowid, rev in self.tombstones.items()]
+        if self.horizon:
+            # Keeps ids of pruned tombstones from being reused
+            records.append({'op': 'horizon', 'rev': self.horizon, 'last': self.last})
+        records.sort(key=lambda record: record['rev'])
+        if self.preferences is not None:
+            records.append({'op': 'preferences', 'preferences': self.preferences})
+        return records
+
+    def encode(self, record: dict) -> bytes:
+        """ Return the record framed with its length and checksum. """
+        payload = json.dumps(record, separators=(',', ':')).encode()
+        return self.HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+    @HandleError(OSError)
+    def append(self, records: list[dict]) -> bool:
+        """ Apply records and append them durably to the journal file.
+
+        Args:
+            records (list[dict]): The journal records.
+
+        Returns:
+            bool: True if records were written. """
+        if not records:
+            return True
+        with self.lock:
+            for rev, record in enumerate(records, self.rev + 1):
+                record['rev'] = rev
+            data = b''.join(self.encode(record) for record in records)
+            self.file.write(data)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            for record in records:
+                self.apply(record)
+            if self.compacting is not None:
+                self.compacting.append(data)
+            size = self.file.tell()
+            if size > self.threshold and size > 2 * self.live and self.compactor is None:
+                self.compactor = threading.Thread(target=self.compact, name='JournalCompactor')
+                self.compactor.start()
+        return True
+
+    def compact(self) -> None:
+        """ Rewrite the journal file with a record per note (run in background thread). """
+        temp = f'{self.path}.compact'
+        with self.lock:
+            self.prune()
+            records = [self.encode(record) for record in self.snapshot()]
+            self.compacting = []
+        try:
+            with open(temp, 'wb') as file:
+                file.write(self.MAGIC)
+                file.writelines(records)
+                live = file.tell()
+                with self.lock:
+                    # Records appended meanwhile are already on top of the snapshot state
+                    file.writelines(self.compacting)
+                    file.flush()
+                    os.fsync(file.fileno())
+                    os.replace(temp, self.path)
+                    self.file.close()
+                    self.file = open(self.path, 'ab')
+                    self.live = live
+            logger.info(f'JournalConnector::Compacted to {live} bytes')
+        except OSError as error:
+            logger.error(f'JournalConnector::Compaction failed: {error}')
+        finally:
+            with self.lock:
+                self.compactor = None
+                self.compacting = None
+
+    def prune(self) -> None:
+        """ Forget all but the newest tombstones (call with lock held). """
+        if len(self.tombstones) > self.TOMBSTONES:
+            self.horizon = sorted(self.tombstones.values(), reverse=True)[self.TOMBSTONES]
+            self.tombstones = {rowid: rev for rowid, rev in self.tombstones.items() if rev > self.horizon}
+
+    def row(self, note: dict) -> tuple:
+        """ Return the note as retrieved row. """
+        return (note['id'], *(note[column] for column in COLUMNS))
+
+    def select(self, rowids: list[int]|None, workspace: str|None) -> list[dict]:
+        """ Return the notes with given ids, or all most recently changed first, in the workspace if given
+        (call with lock held). """
+        if rowids is None:
+            rowids = sorted(self.notes, key=lambda rowid: self.revs.get(rowid, 0), reverse=True)
+        return [note for rowid in rowids if (note := self.notes.get(rowid)) is not None
+                and workspace in (None, note['workspace'])]
+
+    def retrieve(self, rowids: list[int]|None = None, workspace: str|None = None) -> list[tuple]:
+        with self.lock:
+            return [self.row(note) for note in self.select(rowids, workspace)]
+
+    def retrieve_meta(self, workspace: str|None = None) -> list[tuple]:
+        with self.lock:
+            return [(note['id'], *self.row(note)[2:]) for note in self.select(None, workspace)]
+
+    def retrieve_bodies(self, rowids: list[int]|None = None, workspace: str|None = None) -> list[tuple]:
+        with self.lock:
+            return [(note['id'], note['text']) for note in self.select(rowids, workspace)]
+
+    def retrieve_workspaces(self, rowids: list[int]|None = None) -> list[tuple]:
+        with self.lock:
+            return [(note['id'], note['workspace']) for note in self.select(rowids, None)]
+
+    def changes_since(self, token: int|None = None) -> tuple[list[tuple], list[int]|None, int]:
+        with self.lock:
+            if token is None or token < self.horizon:
+                notes = [self.row(note) for _, note in sorted(self.notes.items())]
+                return notes, None if token is not None else [], self.rev
+            notes = [self.row(self.notes[rowid]) for rowid, rev in sorted(self.revs.items()) if rev > token]
+            return notes, [rowid for rowid, rev in self.tombstones.items() if rev > token], self.rev
+
+    def search(self, query: str) -> list[int]:
+        if not (words := search_words(query)):
+            return []
+        with self.lock:
+            return [rowid for rowid, note in sorted(self.notes.items()) if matches(note['text'], words)]
+
+    def new_id(self) -> int:
+        with self.lock:
+            self.last += 1
+            return self.last
+
+    def save(self, note: dict) -> bool:
+        return self.save_many([note])
+
+    def update(self, note: dict) -> bool:
+        return self.update_many([note])
+
+    def delete(self, rowid: int) -> bool:
+        return self.delete_many([rowid])
+
+    def save_many(self, notes: list[dict]) -> bool:
+        return self.append([{'op': 'save', 'note': {k: v for k, v in note.items()
+                                                     if k in ('id', 'workspace') or k in COLUMNS}}
+                            for note in notes])
+
+    def update_many(self, notes: list[dict]) -> bool:
+        return self.append([{'op': 'update', 'note': {k: v for k, v in note.items() if k == 'id' or k in COLUMNS}}
+                            for note in notes if len(note) > 1])
+
+    def delete_many(self, rowids: list[int]) -> bool:
+        return self.append([{'op': 'delete', 'id': rowid} for rowid in rowids])
+
+    def get_preferences(self) -> tuple:
+        with self.lock:
+            if (pref := self.preferences) is None:
+                return None
+            return (pref['checked'], pref['bgcolor'], pref['font'], pref['fcolor'])
+
+    def save_preferences(self, preferences: dict) -> bool:
+        return self.append([{'op': 'preferences', 'preferences': dict(preferences)}])
+
+    def close(self) -> None:
+        if (compactor := self.compactor) is not None:
+            compactor.join()
+        self.file.close()
+        self.lockfile.close()
@@ -1,15 +1,63 @@
 """ Defines class of MySQL connector.
 For storing NoteWidget instances in MySQL database. """
 import logging
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import closing
 
 import MySQLdb
+import MySQLdb.cursors
 
-from qsticky.data.abstract import DataBaseConnector, HandleError
+from qsticky.data.abstract import DataBaseConnector, HandleError, Retry
 
 logger = logging.getLogger(__package__)
 
+class Result:
+    """ Rows of a statement fetched while the connection was locked, read like a cursor.
+
+    Attributes:
+        rows (list[tuple]): The rows not read yet.
+        lastrowid (int): The value set by LAST_INSERT_ID(), see cursor.lastrowid. """
+
+    def __init__(self, cursor: MySQLdb.cursors.Cursor) -> None:
+        """ Read all rows of the cursor.
+
+        Args:
+            cursor (Cursor): The cursor of the executed statement. """
+        self.rows = list(cursor.fetchall()) if cursor.description is not None else []
+        self.lastrowid = cursor.lastrowid
+
+    def fetchone(self) -> tuple|None:
+        """ Return the next row, None if all were read. """
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchmany(self, size: int) -> list[tuple]:
+        """ Return the next rows, up to size of them. """
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def fetchall(self) -> list[tuple]:
+        """ Return the remaining rows. """
+        rows, self.rows = self.rows, []
+        return rows
+
+    def close(self) -> None:
+        """ Discard the remaining rows. """
+        self.rows = []
+
+
 class MySQLConnector(DataBaseConnector):
-    """ MySQL database connector class. """
+    """ MySQL database connector class.
+
+    Writes are committed before they are reported done, statements of a batch in one transaction,
+    reads end their transaction at once.
+    Notes written by them get the next revision just before the commit, so the row of revision
+    counter is locked only while committing and revisions grow in commit order.
+
+    Class Attributes:
+        REVISED (frozenset): Keys of SQL statements writing notes, which need a new revision. """
+    REVISED = frozenset({'upsert', 'update', 'update_text', 'update_geometry', 'update_style', 'delete'})
     SQL = {
         'init': '''CREATE TABLE IF NOT EXISTS notes (
             id      INTEGER     PRIMARY KEY,
@@ -20,20 +68,84 @@ class MySQLConnector(DataBaseConnector):
             height  INTEGER     NOT NULL,
             bgcolor TEXT        NOT NULL,
             font    TEXT        NOT NULL,
-            fcolor  TEXT        NOT NULL);''',
+            fcolor  TEXT        NOT NULL,
+            body    LONGBLOB    NULL,
+            rev     BIGINT      NOT NULL    DEFAULT 0,
+            INDEX notes_rev (rev));''',
+
+        'retrieve': 'SELECT id, text, xpos, ypos, width, height, bgcolor, font, fcolor, body FROM notes;',
+
+        'retrieve_note': '''SELECT id, text, xpos, ypos, width, height, bgcolor, font, fcolor, body
+            FROM notes WHERE id = %(id)s AND (%(workspace)s IS NULL OR workspace = %(workspace)s);''',
+
+        'retrieve_in': '''SELECT id, text, xpos, ypos, width, height, bgcolor, font, fcolor, body
+            FROM notes WHERE workspace = %(workspace)s ORDER BY rev DESC;''',
+
+        'retrieve_meta': 'SELECT id, xpos, ypos, width, height, bgcolor, font, fcolor FROM notes;',
+
+        'retrieve_meta_in': '''SELECT id, xpos, ypos, width, height, bgcolor, font, fcolor
+            FROM notes WHERE workspace = %(workspace)s ORDER BY rev DESC;''',
+
+        'retrieve_bodies': 'SELECT id, text, body FROM notes;',
+
+        'retrieve_body': '''SELECT id, text, body FROM notes
+            WHERE id = %(id)s AND (%(workspace)s IS NULL OR workspace = %(workspace)s);''',
+
+        'retrieve_bodies_in': 'SELECT id, text, body FROM notes WHERE workspace = %(workspace)s;',
+
+        'retrieve_workspaces': 'SELECT id, workspace FROM notes;',
 
-        'retrieve': 'SELECT * FROM notes;',
+        'retrieve_workspace': 'SELECT id, workspace FROM notes WHERE id = %(id)s;',
 
-        'upsert': '''INSERT INTO notes(id, text, xpos, ypos, width, height, bgcolor, font, fcolor)
-            VALUES(%(id)s, %(text)s, %(xpos)s, %(ypos)s, %(width)s, %(height)s, %(bgcolor)s, %(font)s, %(fcolor)s)
+        # Revisions are given at commit, see stamp
+        'upsert': (
+            '''INSERT INTO notes(id, text, xpos, ypos, width, height, bgcolor, font, fcolor, body, workspace)
+            VALUES(%(id)s, %(text)s, %(xpos)s, %(ypos)s, %(width)s, %(height)s, %(bgcolor)s, %(font)s, %(fcolor)s, %(body)s,
+            %(workspace)s)
             ON DUPLICATE KEY UPDATE
-            text = %(text)s, xpos = %(xpos)s, ypos = %(ypos)s, width = %(width)s, height = %(height)s,
-            bgcolor = %(bgcolor)s, font = %(font)s, fcolor = %(fcolor)s;''',
+            text = VALUES(text), xpos = VALUES(xpos), ypos = VALUES(ypos), width = VALUES(width),
+            height = VALUES(height), bgcolor = VALUES(bgcolor), font = VALUES(font), fcolor = VALUES(fcolor),
+            body = VALUES(body);''',
+            'DELETE FROM note_tombstones WHERE id = %(id)s;',
+        ),
 
-        'update': '''UPDATE notes SET text = %(text)s, xpos = %(xpos)s, ypos = %(ypos)s,
+        'update': '''UPDATE notes SET text = %(text)s, body = %(body)s, xpos = %(xpos)s, ypos = %(ypos)s,
             width = %(width)s, height = %(height)s WHERE id = %(id)s;''',
 
-        'delete': 'DELETE FROM notes WHERE id = %(id)s;',
+        'update_text': 'UPDATE notes SET text = %(text)s, body = %(body)s WHERE id = %(id)s;',
+
+        'update_geometry': '''UPDATE notes SET xpos = %(xpos)s, ypos = %(ypos)s,
+            width = %(width)s, height = %(height)s WHERE id = %(id)s;''',
+
+        'update_style': '''UPDATE notes SET bgcolor = %(bgcolor)s, font = %(font)s,
+            fcolor = %(fcolor)s WHERE id = %(id)s;''',
+
+        'delete': (
+            '''INSERT INTO note_tombstones(id, rev) SELECT id, 0 FROM notes WHERE id = %(id)s
+            ON DUPLICATE KEY UPDATE rev = VALUES(rev);''',
+            'DELETE FROM notes WHERE id = %(id)s;',
+        ),
+
+        # LAST_INSERT_ID() keeps the new value of the counter for the session
+        'stamp': (
+            'UPDATE revision SET value = LAST_INSERT_ID(value + 1) WHERE id = 0;',
+            'UPDATE notes SET rev = LAST_INSERT_ID() WHERE id IN %(ids)s;',
+            'UPDATE note_tombstones SET rev = LAST_INSERT_ID() WHERE id IN %(ids)s;',
+        ),
+
+        'changes': '''SELECT id, text, xpos, ypos, width, height, bgcolor, font, fcolor, body, rev, 0
+            FROM notes WHERE rev > %(rev)s
+            UNION ALL SELECT id, '', 0, 0, 0, 0, '', '', '', NULL, rev, 1
+            FROM note_tombstones WHERE rev > %(rev)s;''',
+
+        'horizon': 'SELECT value FROM revision WHERE id = 1;',
+
+        # All but the newest tombstones are dropped, tokens older than them are answered with all notes
+        'prune': (
+            '''UPDATE revision SET value = COALESCE((SELECT rev FROM note_tombstones
+            ORDER BY rev DESC LIMIT 1 OFFSET %(keep)s), value) WHERE id = 1;''',
+            'DELETE FROM note_tombstones WHERE rev <= (SELECT value FROM revision WHERE id = 1);',
+        ),
 
         'pref_init': '''CREATE TABLE IF NOT EXISTS preferences (
             id      INTEGER     PRIMARY KEY,
@@ -48,10 +160,140 @@ class MySQLConnector(DataBaseConnector):
             checked = %(checked)s, bgcolor = %(bgcolor)s, font = %(font)s, fcolor = %(fcolor)s;''',
 
         'pref_get': 'SELECT checked, bgcolor, font, fcolor FROM preferences WHERE id = 0;',
+
+        'bodies_exist': "SHOW TABLES LIKE 'note_bodies';",
+
+        'bodies_init': (
+            '''CREATE TABLE IF NOT EXISTS note_bodies (
+            id      INTEGER     PRIMARY KEY,
+            text    MEDIUMTEXT  NOT NULL,
+            body    LONGBLOB    NULL);''',
+            'INSERT INTO note_bodies(id, text, body) SELECT id, text, body FROM notes;',
+            "UPDATE notes SET text = '', body = NULL;",
+        ),
+
+        'compress_exist': "SHOW COLUMNS FROM notes LIKE 'body';",
+
+        'compress_init': 'ALTER TABLE notes ADD COLUMN body LONGBLOB;',
+
+        'compress_scan': 'SELECT id, text FROM notes WHERE LENGTH(text) > %(size)s;',
+
+        'rev_exist': "SHOW COLUMNS FROM notes LIKE 'rev';",
+
+        'rev_init': 'ALTER TABLE notes ADD COLUMN rev BIGINT NOT NULL DEFAULT 0, ADD INDEX notes_rev (rev);',
+
+        # The workspace column is added to new and old databases alike
+        'workspace_exist': "SHOW COLUMNS FROM notes LIKE 'workspace';",
+
+        'workspace_init': '''ALTER TABLE notes ADD COLUMN workspace VARCHAR(255) NOT NULL DEFAULT 'default',
+            ADD INDEX notes_workspace (workspace);''',
+
+        # Row 0 holds the last revision, row 1 the last one of pruned tombstones
+        'revision_init': (
+            '''CREATE TABLE IF NOT EXISTS revision (
+            id      INTEGER     PRIMARY KEY,
+            value   BIGINT      NOT NULL);''',
+            'INSERT IGNORE INTO revision(id, value) VALUES(0, 0);',
+            'INSERT IGNORE INTO revision(id, value) VALUES(1, 0);',
+            '''CREATE TABLE IF NOT EXISTS note_tombstones (
+            id      INTEGER     PRIMARY KEY,
+            rev     BIGINT      NOT NULL,
+            INDEX note_tombstones_rev (rev));''',
+        ),
+
+        # The last reserved id, new ids are also above ids saved without reserving them
+        'ids_init': (
+            '''CREATE TABLE IF NOT EXISTS note_ids (
+            id      INTEGER     PRIMARY KEY,
+            value   INTEGER     NOT NULL);''',
+            'INSERT IGNORE INTO note_ids(id, value) VALUES(0, -1);',
+        ),
+
+        # The reserved id is returned as the cursor's lastrowid
+        'new_id': '''UPDATE note_ids SET value = LAST_INSERT_ID(GREATEST(value, (SELECT COALESCE(MAX(id), -1) FROM notes),
+            (SELECT COALESCE(MAX(id), -1) FROM note_tombstones)) + 1) WHERE id = 0;''',
+
+        'search': 'SELECT id FROM notes WHERE MATCH(text) AGAINST(%(query)s IN BOOLEAN MODE);',
+
+        'index_scan': "SELECT id, body FROM notes WHERE body IS NOT NULL AND text = '';",
+
+        'index_text': 'UPDATE notes SET text = %(text)s WHERE id = %(id)s;',
+
+        'search_exist': "SHOW INDEX FROM notes WHERE Key_name = 'notes_search';",
+
+        'search_init': 'ALTER TABLE notes ADD FULLTEXT INDEX notes_search (text);',
+    }
+
+    SQL_SPLIT = {
+        'retrieve': '''SELECT notes.id, COALESCE(note_bodies.text, ''), xpos, ypos, width, height,
+            bgcolor, font, fcolor, note_bodies.body FROM notes LEFT JOIN note_bodies ON note_bodies.id = notes.id;''',
+
+        'retrieve_note': '''SELECT notes.id, COALESCE(note_bodies.text, ''), xpos, ypos, width, height,
+            bgcolor, font, fcolor, note_bodies.body FROM notes LEFT JOIN note_bodies ON note_bodies.id = notes.id
+            WHERE notes.id = %(id)s AND (%(workspace)s IS NULL OR workspace = %(workspace)s);''',
+
+        'retrieve_in': '''SELECT notes.id, COALESCE(note_bodies.text, ''), xpos, ypos, width, height,
+            bgcolor, font, fcolor, note_bodies.body FROM notes LEFT JOIN note_bodies ON note_bodies.id = notes.id
+            WHERE workspace = %(workspace)s ORDER BY notes.rev DESC;''',
+
+        'retrieve_bodies': 'SELECT id, text, body FROM note_bodies;',
+
+        'retrieve_body': '''SELECT note_bodies.id, note_bodies.text, note_bodies.body
+            FROM note_bodies JOIN notes ON notes.id = note_bodies.id
+            WHERE note_bodies.id = %(id)s AND (%(workspace)s IS NULL OR workspace = %(workspace)s);''',
+
+        'retrieve_bodies_in': '''SELECT note_bodies.id, note_bodies.text, note_bodies.body
+            FROM note_bodies JOIN notes ON notes.id = note_bodies.id WHERE workspace = %(workspace)s;''',
+
+        'upsert': (
+            '''INSERT INTO notes(id, text, xpos, ypos, width, height, bgcolor, font, fcolor, workspace)
+            VALUES(%(id)s, '', %(xpos)s, %(ypos)s, %(width)s, %(height)s, %(bgcolor)s, %(font)s, %(fcolor)s,
+            %(workspace)s)
+            ON DUPLICATE KEY UPDATE
+            xpos = VALUES(xpos), ypos = VALUES(ypos), width = VALUES(width), height = VALUES(height),
+            bgcolor = VALUES(bgcolor), font = VALUES(font), fcolor = VALUES(fcolor);''',
+            '''INSERT INTO note_bodies(id, text, body) VALUES(%(id)s, %(text)s, %(body)s)
+            ON DUPLICATE KEY UPDATE text = VALUES(text), body = VALUES(body);''',
+            *SQL['upsert'][1:],
+        ),
+
+        'update': (
+            SQL['update_geometry'],
+            '''INSERT INTO note_bodies(id, text, body) VALUES(%(id)s, %(text)s, %(body)s)
+            ON DUPLICATE KEY UPDATE text = VALUES(text), body = VALUES(body);''',
+        ),
+
+        'update_text': '''INSERT INTO note_bodies(id, text, body) VALUES(%(id)s, %(text)s, %(body)s)
+            ON DUPLICATE KEY UPDATE text = VALUES(text), body = VALUES(body);''',
+
+        'delete': (*SQL['delete'], 'DELETE FROM note_bodies WHERE id = %(id)s;'),
+
+        'changes': '''SELECT notes.id, COALESCE(note_bodies.text, ''), xpos, ypos, width, height,
+            bgcolor, font, fcolor, note_bodies.body, rev, 0
+            FROM notes LEFT JOIN note_bodies ON note_bodies.id = notes.id WHERE rev > %(rev)s
+            UNION ALL SELECT id, '', 0, 0, 0, 0, '', '', '', NULL, rev, 1
+            FROM note_tombstones WHERE rev > %(rev)s;''',
+
+        'compress_exist': "SHOW COLUMNS FROM note_bodies LIKE 'body';",
+
+        'compress_init': 'ALTER TABLE note_bodies ADD COLUMN body LONGBLOB;',
+
+        'compress_scan': 'SELECT id, text FROM note_bodies WHERE LENGTH(text) > %(size)s;',
+
+        'search': 'SELECT id FROM note_bodies WHERE MATCH(text) AGAINST(%(query)s IN BOOLEAN MODE);',
+
+        'index_scan': "SELECT id, body FROM note_bodies WHERE body IS NOT NULL AND text = '';",
+
+        'index_text': 'UPDATE note_bodies SET text = %(text)s WHERE id = %(id)s;',
+
+        'search_exist': "SHOW INDEX FROM note_bodies WHERE Key_name = 'note_bodies_search';",
+
+        'search_init': 'ALTER TABLE note_bodies ADD FULLTEXT INDEX note_bodies_search (text);',
     }
 
     @HandleError(MySQLdb.Error)
-    def __init__(self, host: str, port: int, database: str, user: str, password: str) -> None:
+    def __init__(self, host: str, port: int, database: str, user: str, password: str,
+                 idle_timeout: float = 600.0, connect_timeout: int = 10, split_bodies: bool = False) -> None:
         """ Initialize the database connection.
 
         Args:
@@ -59,26 +301,179 @@ class MySQLConnector(DataBaseConnector):
             port (str): The port of the MySQL server.
             dbname (str): The name of the database.
             user (str): The username for database access.
-            password (str): The password for database access. """
-        self.conn = MySQLdb.connect(
-            host=host,
-            port=port,
-            database=database,
-            user=user,
-            password=password
-        )
+            password (str): The password for database access.
+            idle_timeout (float, optional): Seconds of idleness after which the connection is
+                checked before use. Lowered to fit the server's wait_timeout. Defaults to 600.
+            connect_timeout (int, optional): Seconds to wait for a connection. Defaults to 10.
+            split_bodies (bool, optional): Keep note texts in separate table. Defaults to False. """
+        self.params = {
+            'host': host,
+            'port': port,
+            'database': database,
+            'user': user,
+            'password': password,
+            'connect_timeout': connect_timeout,
+        }
+        self.lock = threading.RLock()
+        self.uncommitted = []   # (statement, values) pairs of the open transaction
+        self.connect()
         logger.info(f"MySQLConnector::Connected to - {self.conn.get_server_info()} at {self.conn.get_host_info()}")
-        self.execute_sql('init')
-        self.execute_sql('pref_init')
+        self.cursor.execute('SELECT @@wait_timeout;')
+        (wait_timeout,) = self.cursor.fetchone()
+        self.keepalive = min(idle_timeout, 0.8 * wait_timeout)
+        logger.debug(f"MySQLConnector::Server wait_timeout {wait_timeout}s, checking connection after {self.keepalive}s")
+        self.init_schema(split_bodies)
+        self.commit()
+
+    def connect(self) -> None:
+        """ Open a new connection to the server. """
+        self.conn = MySQLdb.connect(**self.params)
+        self.cursor = self.conn.cursor()
+        self.used = time.monotonic()
+
+    def reconnect(self) -> None:
+        """ Open a new connection and repeat statements of the lost transaction. """
+        with self.lock:
+            try:
+                self.cursor.close()
+                self.conn.close()
+            except MySQLdb.Error:
+                pass
+            self.connect()
+            logger.info(f'{type(self).__name__}::Reconnected')
+            if not self.RETRY.issuperset(statement for statement, _ in self.uncommitted):
+                logger.error(f'{type(self).__name__}::Lost {len(self.uncommitted)} uncommitted statements')
+                self.uncommitted.clear()
+            self.replay()
+
+    def replay(self) -> None:
+        """ Execute statements of the open transaction again. """
+        for statement, values in self.uncommitted:
+            for sql in self.statements(statement):
+                self.cursor.executemany(sql, values)
+
+    def ping(self) -> None:
+        """ Check the connection if it was idle for long, reconnect if it is lost. """
+        if time.monotonic() - self.used > self.keepalive:
+            try:
+                self.conn.ping()
+            except MySQLdb.OperationalError as error:
+                logger.info(f'{type(self).__name__}::Connection lost while idle: {error}')
+                self.reconnect()
+
+    def execute(self, statement: str, values: list[dict]) -> None:
+        """ Execute statement in the open transaction, writes are kept for the commit. """
+        for sql in self.statements(statement):
+            if len(values) == 1:
+                self.cursor.execute(sql, values[0])
+            else:
+                self.cursor.executemany(sql, values)
+        self.used = time.monotonic()
+        if self.cursor.description is None:     # not a query
+            self.uncommitted.append((statement, values))
+
+    def abort(self, start: int, error: MySQLdb.Error) -> None:
+        """ Undo statements of the open transaction executed since start, keep the earlier ones. """
+        del self.uncommitted[start:]
+        if not isinstance(error, MySQLdb.OperationalError):  # connection is still usable
+            self.conn.rollback()
+            self.replay()
 
     @HandleError(MySQLdb.Error)
-    def execute_sql(self, statement: str, values:dict|int={}):# -> MySQLdb.cursors.Cursor:
-        if statement not in self.SQL:
-            raise ValueError(f"Invalid SQL key argument: {statement}")
+    def commit(self) -> None:
+        """ Commit the open transaction. """
+        with self.lock:
+            if not self.uncommitted:
+                return
+            try:
+                self.stamp()
+                self.conn.commit()
+            except MySQLdb.OperationalError as error:
+                logger.warning(f'{type(self).__name__}.commit lost connection, retrying: {error}')
+                self.reconnect()
+                self.stamp()
+                self.conn.commit()
+            self.uncommitted.clear()
+
+    def stamp(self) -> None:
+        """ Give notes written in the open transaction the next revision. """
+        ids = {value['id'] for statement, values in self.uncommitted if statement in self.REVISED for value in values}
+        if ids:
+            for sql in self.statements('stamp'):
+                self.cursor.execute(sql, {'ids': tuple(ids)})
+
+    def close(self) -> None:
+        self.commit()
+        logger.info(f'{type(self).__name__}::Closing connection')
+        with self.lock:
+            self.cursor.close()
+            self.conn.close()
+
+    def stream(self, statement: str, values: dict, batch_size: int) -> Iterator[list[tuple]]:
+        # Results of a server-side cursor block its connection until read, so it gets its own one
+        (sql,) = self.statements(statement)
+        self.commit()
+        conn = MySQLdb.connect(**self.params)
+        try:
+            cursor = conn.cursor(MySQLdb.cursors.SSCursor)
+            cursor.execute(sql, values)
+            while rows := cursor.fetchmany(batch_size):
+                yield rows
+            cursor.close()
+        finally:
+            conn.close()
+
+    def new_id(self) -> int:
+        # Committed by execute_sql, so the row lock of the counter is released and the id isn't replayed
+        with closing(self.execute_sql('new_id')) as cursor:
+            return cursor.lastrowid
+
+    @staticmethod
+    def search_terms(words: list[str]) -> str:
+        # Words shorter than innodb_ft_min_token_size and stopwords are not indexed
+        return ' '.join(f'+{word}*' for word in words)
+
+    @HandleError(MySQLdb.Error)
+    @Retry(MySQLdb.OperationalError)
+    def execute_sql(self, statement: str, values:dict|int={}) -> Result:
+        self.statements(statement)  # validate the key
         if isinstance(values, int):
             values = {'id': values} # convert to dict to pass as statement value
 
-        cursor = self.conn.cursor()
-        cursor.execute(self.SQL[statement], values)
-        self.conn.commit()
-        return cursor
+        with self.lock:
+            self.ping()
+            start = len(self.uncommitted)
+            try:
+                self.execute(statement, [values])
+                result = Result(self.cursor)
+                if self.uncommitted:
+                    # Committed before returning, so a failed commit fails the write and callers retry it
+                    self.commit()
+                else:
+                    # Autocommit is off, the transaction of a read would keep its snapshot and locks
+                    self.conn.rollback()
+            except MySQLdb.Error as error:
+                self.abort(start, error)
+                raise
+            return result
+
+    @HandleError(MySQLdb.Error)
+    @Retry(MySQLdb.OperationalError)
+    def execute_many(self, batch: list[tuple[str, list[dict|int]]]) -> bool:
+        for statement, _ in batch:
+            self.statements(statement)  # validate the key
+
+        with self.lock:
+            self.ping()
+            start = len(self.uncommitted)
+            try:
+                for statement, values in batch:
+                    self.execute(
+                        statement,
+                        [{'id': value} if isinstance(value, int) else value for value in values]
+                    )
+            except MySQLdb.Error as error:
+                self.abort(start, error)
+                raise
+            self.commit()
+        return True
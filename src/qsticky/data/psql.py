@@ -1,12 +1,81 @@
 """ Defines class of PostgreSQL connector.
 For storing NoteWidget instances in PostgreSQL database. """
+import json
 import logging
+import time
+import uuid
+from collections.abc import Iterator
+from contextlib import closing, contextmanager
 
 import psycopg2
+import psycopg2.extras
+import psycopg2.pool
+from PyQt6.QtCore import QObject, QThread, QTimer, QSocketNotifier
+from PyQt6.QtCore import pyqtSignal as Signal
 
-from qsticky.data.abstract import DataBaseConnector, HandleError
+from qsticky.data.abstract import DataBaseConnector, HandleError, Retry
 
 logger = logging.getLogger(__package__)
+# Application name of connections of this process, to tell own change notifications apart
+CLIENT = f'qsticky-{uuid.uuid4().hex[:12]}'
+CHANNEL = 'qsticky'
+
+class ConnectionPool(psycopg2.pool.ThreadedConnectionPool):
+    """ Thread-safe pool of connections, checked for health and recycled when idle.
+
+    Class Attributes:
+        CHECK_AFTER (float): Seconds of idleness after which a connection is pinged before use. """
+    CHECK_AFTER = 30.0
+
+    def __init__(self, minconn: int, maxconn: int, idle_timeout: float, **kwargs) -> None:
+        """ Initialize the pool.
+
+        Args:
+            minconn (int): The number of connections kept open.
+            maxconn (int): The maximum number of connections.
+            idle_timeout (float): Seconds after which an unused connection is closed and replaced.
+            **kwargs: Connection parameters passed to psycopg2.connect. """
+        self.idle_timeout = idle_timeout
+        self.released = {}  # id of connection -> time of its return to the pool
+        super().__init__(minconn, maxconn, **kwargs)
+
+    def getconn(self, key=None) -> psycopg2.extensions.connection:
+        """ Get a healthy connection, replacing closed, broken and idle ones. """
+        while True:
+            conn = super().getconn(key)
+            idle = time.monotonic() - self.released.pop(id(conn), time.monotonic())
+            if conn.closed:
+                logger.info(f'{type(self).__name__}::Replacing closed connection')
+            elif idle > self.idle_timeout:
+                logger.debug(f'{type(self).__name__}::Recycling connection idle for {idle:.0f}s')
+            elif idle > self.CHECK_AFTER and not self.check(conn):
+                logger.info(f'{type(self).__name__}::Replacing broken connection')
+            else:
+                return conn
+            super().putconn(conn, key, close=True)
+
+    def putconn(self, conn, key=None, close=False) -> None:
+        """ Return the connection to the pool, closing it if it is broken. """
+        super().putconn(conn, key, close or bool(conn.closed))
+        if not conn.closed:
+            self.released[id(conn)] = time.monotonic()
+
+    def expire(self) -> None:
+        """ Mark idle connections as expired, so they are replaced when requested. """
+        for key in list(self.released):
+            self.released[key] = float('-inf')
+
+    @staticmethod
+    def check(conn) -> bool:
+        """ Ping the server over the connection. """
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1;')
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
 
 class PostgreSQLConnector(DataBaseConnector):
     """ PostgreSQL database connector class. """
@@ -20,20 +89,83 @@ class PostgreSQLConnector(DataBaseConnector):
             height  INTEGER     NOT NULL,
             bgcolor TEXT        NOT NULL,
             font    TEXT        NOT NULL,
-            fcolor  TEXT        NOT NULL);''',
+            fcolor  TEXT        NOT NULL,
+            body    BYTEA       NULL,
+            rev     BIGINT      NOT NULL    DEFAULT 0);''',
+
+        'retrieve': 'SELECT id, text, xpos, ypos, width, height, bgcolor, font, fcolor, body FROM notes;',
+
+        'retrieve_note': '''SELECT id, text, xpos, ypos, width, height, bgcolor, font, fcolor, body
+            FROM notes WHERE id = %(id)s AND (%(workspace)s IS NULL OR workspace = %(workspace)s);''',
 
-        'retrieve': 'SELECT * FROM notes;',
+        'retrieve_in': '''SELECT id, text, xpos, ypos, width, height, bgcolor, font, fcolor, body
+            FROM notes WHERE workspace = %(workspace)s ORDER BY rev DESC;''',
 
-        'upsert': '''INSERT INTO notes(id, text, xpos, ypos, width, height, bgcolor, font, fcolor)
-            VALUES(%(id)s, %(text)s, %(xpos)s, %(ypos)s, %(width)s, %(height)s, %(bgcolor)s, %(font)s, %(fcolor)s)
+        'retrieve_meta': 'SELECT id, xpos, ypos, width, height, bgcolor, font, fcolor FROM notes;',
+
+        'retrieve_meta_in': '''SELECT id, xpos, ypos, width, height, bgcolor, font, fcolor
+            FROM notes WHERE workspace = %(workspace)s ORDER BY rev DESC;''',
+
+        'retrieve_bodies': 'SELECT id, text, body FROM notes;',
+
+        'retrieve_body': '''SELECT id, text, body FROM notes
+            WHERE id = %(id)s AND (%(workspace)s IS NULL OR workspace = %(workspace)s);''',
+
+        'retrieve_bodies_in': 'SELECT id, text, body FROM notes WHERE workspace = %(workspace)s;',
+
+        'retrieve_workspaces': 'SELECT id, workspace FROM notes;',
+
+        'retrieve_workspace': 'SELECT id, workspace FROM notes WHERE id = %(id)s;',
+
+        # Revisions are ids of writing transactions over the base kept in row 0 of revision table, so writers
+        # don't wait for each other. Transactions commit out of their order, see changes_since.
+        'upsert': (
+            '''INSERT INTO notes(id, text, xpos, ypos, width, height, bgcolor, font, fcolor, body, rev, workspace)
+            VALUES(%(id)s, %(text)s, %(xpos)s, %(ypos)s, %(width)s, %(height)s, %(bgcolor)s, %(font)s, %(fcolor)s, %(body)s,
+            (SELECT value FROM revision WHERE id = 0) + txid_current(), %(workspace)s)
             ON CONFLICT(id) DO UPDATE
             SET text = %(text)s, xpos = %(xpos)s, ypos = %(ypos)s, width = %(width)s, height = %(height)s,
-            bgcolor = %(bgcolor)s, font = %(font)s, fcolor = %(fcolor)s;''',
+            bgcolor = %(bgcolor)s, font = %(font)s, fcolor = %(fcolor)s, body = %(body)s, rev = EXCLUDED.rev;''',
+            'DELETE FROM note_tombstones WHERE id = %(id)s;',
+        ),
+
+        'update': '''UPDATE notes SET text = %(text)s, body = %(body)s, xpos = %(xpos)s, ypos = %(ypos)s,
+            width = %(width)s, height = %(height)s, rev = (SELECT value FROM revision WHERE id = 0) + txid_current()
+            WHERE id = %(id)s;''',
+
+        'update_text': '''UPDATE notes SET text = %(text)s, body = %(body)s,
+            rev = (SELECT value FROM revision WHERE id = 0) + txid_current() WHERE id = %(id)s;''',
+
+        'update_geometry': '''UPDATE notes SET xpos = %(xpos)s, ypos = %(ypos)s, width = %(width)s, height = %(height)s,
+            rev = (SELECT value FROM revision WHERE id = 0) + txid_current() WHERE id = %(id)s;''',
+
+        'update_style': '''UPDATE notes SET bgcolor = %(bgcolor)s, font = %(font)s, fcolor = %(fcolor)s,
+            rev = (SELECT value FROM revision WHERE id = 0) + txid_current() WHERE id = %(id)s;''',
+
+        'delete': (
+            '''INSERT INTO note_tombstones(id, rev)
+            SELECT id, (SELECT value FROM revision WHERE id = 0) + txid_current() FROM notes WHERE id = %(id)s
+            ON CONFLICT(id) DO UPDATE SET rev = EXCLUDED.rev;''',
+            'DELETE FROM notes WHERE id = %(id)s;',
+        ),
+
+        'changes': '''SELECT id, text, xpos, ypos, width, height, bgcolor, font, fcolor, body, rev, 0
+            FROM notes WHERE rev > %(rev)s
+            UNION ALL SELECT id, '', 0, 0, 0, 0, '', '', '', NULL, rev, 1
+            FROM note_tombstones WHERE rev > %(rev)s;''',
 
-        'update': '''UPDATE notes SET text = %(text)s, xpos = %(xpos)s, ypos = %(ypos)s,
-            width = %(width)s, height = %(height)s WHERE id = %(id)s;''',
+        'horizon': 'SELECT value FROM revision WHERE id = 1;',
 
-        'delete': 'DELETE FROM notes WHERE id = %(id)s;',
+        # The last revision of transactions all finished, xmin is the oldest one still running
+        'settled': '''SELECT (SELECT value FROM revision WHERE id = 0)
+            + txid_snapshot_xmin(txid_current_snapshot()) - 1;''',
+
+        # All but the newest tombstones are dropped, tokens older than them are answered with all notes
+        'prune': (
+            '''UPDATE revision SET value = COALESCE((SELECT rev FROM note_tombstones
+            ORDER BY rev DESC LIMIT 1 OFFSET %(keep)s), value) WHERE id = 1;''',
+            'DELETE FROM note_tombstones WHERE rev <= (SELECT value FROM revision WHERE id = 1);',
+        ),
 
         'pref_init': '''CREATE TABLE IF NOT EXISTS preferences (
             id      INTEGER     PRIMARY KEY,
@@ -48,44 +180,452 @@ class PostgreSQLConnector(DataBaseConnector):
             SET checked = %(checked)s, bgcolor = %(bgcolor)s, font = %(font)s, fcolor = %(fcolor)s''',
 
         'pref_get': 'SELECT checked, bgcolor, font, fcolor FROM preferences WHERE id = 0;',
+
+        'bodies_exist': '''SELECT 1 FROM information_schema.tables
+            WHERE table_schema = current_schema() AND table_name = 'note_bodies';''',
+
+        'bodies_init': (
+            '''CREATE TABLE IF NOT EXISTS note_bodies (
+            id      INTEGER     PRIMARY KEY,
+            text    TEXT        NOT NULL,
+            body    BYTEA       NULL);''',
+            'INSERT INTO note_bodies(id, text, body) SELECT id, text, body FROM notes;',
+            "UPDATE notes SET text = '', body = NULL;",
+        ),
+
+        'compress_exist': '''SELECT 1 FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = 'notes' AND column_name = 'body';''',
+
+        'compress_init': 'ALTER TABLE notes ADD COLUMN IF NOT EXISTS body BYTEA;',
+
+        'compress_scan': 'SELECT id, text FROM notes WHERE OCTET_LENGTH(text) > %(size)s;',
+
+        'rev_exist': '''SELECT 1 FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = 'notes' AND column_name = 'rev';''',
+
+        'rev_init': 'ALTER TABLE notes ADD COLUMN IF NOT EXISTS rev BIGINT NOT NULL DEFAULT 0;',
+
+        # The workspace column is added to new and old databases alike
+        'workspace_exist': '''SELECT 1 FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = 'notes' AND column_name = 'workspace';''',
+
+        'workspace_init': (
+            "ALTER TABLE notes ADD COLUMN IF NOT EXISTS workspace TEXT NOT NULL DEFAULT 'default';",
+            'CREATE INDEX IF NOT EXISTS notes_workspace ON notes(workspace);',
+        ),
+
+        # Row 0 holds the base of revisions, the last one of the counter used before, row 1 the last one
+        # of pruned tombstones
+        'revision_init': (
+            '''CREATE TABLE IF NOT EXISTS note_tombstones (
+            id      INTEGER     PRIMARY KEY,
+            rev     BIGINT      NOT NULL);''',
+            '''CREATE TABLE IF NOT EXISTS revision (
+            id      INTEGER     PRIMARY KEY,
+            value   BIGINT      NOT NULL);''',
+            '''INSERT INTO revision(id, value) SELECT 0, GREATEST((SELECT COALESCE(MAX(rev), 0) FROM notes),
+            (SELECT COALESCE(MAX(rev), 0) FROM note_tombstones)) ON CONFLICT DO NOTHING;''',
+            'INSERT INTO revision(id, value) VALUES(1, 0) ON CONFLICT DO NOTHING;',
+            'CREATE INDEX IF NOT EXISTS notes_rev ON notes(rev);',
+            'CREATE INDEX IF NOT EXISTS note_tombstones_rev ON note_tombstones(rev);',
+        ),
+
+        # The last reserved id, new ids are also above ids saved without reserving them
+        'ids_init': (
+            '''CREATE TABLE IF NOT EXISTS note_ids (
+            id      INTEGER     PRIMARY KEY,
+            value   INTEGER     NOT NULL);''',
+            'INSERT INTO note_ids(id, value) VALUES(0, -1) ON CONFLICT DO NOTHING;',
+        ),
+
+        'new_id': '''UPDATE note_ids SET value = GREATEST(value, (SELECT COALESCE(MAX(id), -1) FROM notes),
+            (SELECT COALESCE(MAX(id), -1) FROM note_tombstones)) + 1 WHERE id = 0 RETURNING value;''',
+
+        # The expression must match the one of the notes_search index
+        'search': "SELECT id FROM notes WHERE to_tsvector('simple', text) @@ to_tsquery('simple', %(query)s);",
+
+        'index_scan': "SELECT id, body FROM notes WHERE body IS NOT NULL AND text = '';",
+
+        'index_text': 'UPDATE notes SET text = %(text)s WHERE id = %(id)s;',
+
+        'search_exist': "SELECT 1 FROM pg_indexes WHERE schemaname = current_schema() AND indexname = 'notes_search';",
+
+        'search_init': (
+            "CREATE INDEX IF NOT EXISTS notes_search ON notes USING GIN (to_tsvector('simple', text));",
+            'CREATE INDEX IF NOT EXISTS notes_large ON notes(id) WHERE body IS NOT NULL;',
+        ),
+
+        # Triggers are replaced only if one is missing, DROP TRIGGER locks the table exclusively
+        'notify_exist': '''SELECT 1 FROM pg_trigger WHERE tgname = 'qsticky_notify'
+            AND tgrelid IN ('notes'::regclass, 'preferences'::regclass) HAVING COUNT(*) = 2;''',
+
+        'notify_init': (
+            f'''CREATE OR REPLACE FUNCTION qsticky_notify() RETURNS trigger AS $$
+            BEGIN
+                PERFORM pg_notify('{CHANNEL}', json_build_object(
+                    'client', current_setting('application_name'),
+                    'table', TG_TABLE_NAME,
+                    'op', TG_OP,
+                    'id', CASE WHEN TG_OP = 'DELETE' THEN OLD.id ELSE NEW.id END)::text);
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;''',
+            'DROP TRIGGER IF EXISTS qsticky_notify ON notes;',
+            '''CREATE TRIGGER qsticky_notify AFTER INSERT OR UPDATE OR DELETE ON notes
+            FOR EACH ROW EXECUTE PROCEDURE qsticky_notify();''',
+            'DROP TRIGGER IF EXISTS qsticky_notify ON preferences;',
+            '''CREATE TRIGGER qsticky_notify AFTER INSERT OR UPDATE OR DELETE ON preferences
+            FOR EACH ROW EXECUTE PROCEDURE qsticky_notify();''',
+        ),
     }
 
+    SQL_SPLIT = {
+        'retrieve': '''SELECT notes.id, COALESCE(note_bodies.text, ''), xpos, ypos, width, height,
+            bgcolor, font, fcolor, note_bodies.body FROM notes LEFT JOIN note_bodies ON note_bodies.id = notes.id;''',
+
+        'retrieve_note': '''SELECT notes.id, COALESCE(note_bodies.text, ''), xpos, ypos, width, height,
+            bgcolor, font, fcolor, note_bodies.body FROM notes LEFT JOIN note_bodies ON note_bodies.id = notes.id
+            WHERE notes.id = %(id)s AND (%(workspace)s IS NULL OR workspace = %(workspace)s);''',
+
+        'retrieve_in': '''SELECT notes.id, COALESCE(note_bodies.text, ''), xpos, ypos, width, height,
+            bgcolor, font, fcolor, note_bodies.body FROM notes LEFT JOIN note_bodies ON note_bodies.id = notes.id
+            WHERE workspace = %(workspace)s ORDER BY notes.rev DESC;''',
+
+        'retrieve_bodies': 'SELECT id, text, body FROM note_bodies;',
+
+        'retrieve_body': '''SELECT note_bodies.id, note_bodies.text, note_bodies.body
+            FROM note_bodies JOIN notes ON notes.id = note_bodies.id
+            WHERE note_bodies.id = %(id)s AND (%(workspace)s IS NULL OR workspace = %(workspace)s);''',
+
+        'retrieve_bodies_in': '''SELECT note_bodies.id, note_bodies.text, note_bodies.body
+            FROM note_bodies JOIN notes ON notes.id = note_bodies.id WHERE workspace = %(workspace)s;''',
+
+        'upsert': (
+            '''INSERT INTO notes(id, text, xpos, ypos, width, height, bgcolor, font, fcolor, rev, workspace)
+            VALUES(%(id)s, '', %(xpos)s, %(ypos)s, %(width)s, %(height)s, %(bgcolor)s, %(font)s, %(fcolor)s,
+            (SELECT value FROM revision WHERE id = 0) + txid_current(), %(workspace)s)
+            ON CONFLICT(id) DO UPDATE
+            SET xpos = %(xpos)s, ypos = %(ypos)s, width = %(width)s, height = %(height)s,
+            bgcolor = %(bgcolor)s, font = %(font)s, fcolor = %(fcolor)s, rev = EXCLUDED.rev;''',
+            '''INSERT INTO note_bodies(id, text, body) VALUES(%(id)s, %(text)s, %(body)s)
+            ON CONFLICT(id) DO UPDATE SET text = %(text)s, body = %(body)s;''',
+            'DELETE FROM note_tombstones WHERE id = %(id)s;',
+        ),
+
+        'update': (
+            SQL['update_geometry'],
+            '''INSERT INTO note_bodies(id, text, body) VALUES(%(id)s, %(text)s, %(body)s)
+            ON CONFLICT(id) DO UPDATE SET text = %(text)s, body = %(body)s;''',
+        ),
+
+        'update_text': (
+            '''INSERT INTO note_bodies(id, text, body) VALUES(%(id)s, %(text)s, %(body)s)
+            ON CONFLICT(id) DO UPDATE SET text = %(text)s, body = %(body)s;''',
+            'UPDATE notes SET rev = (SELECT value FROM revision WHERE id = 0) + txid_current() WHERE id = %(id)s;',
+        ),
+
+        'delete': (*SQL['delete'], 'DELETE FROM note_bodies WHERE id = %(id)s;'),
+
+        'changes': '''SELECT notes.id, COALESCE(note_bodies.text, ''), xpos, ypos, width, height,
+            bgcolor, font, fcolor, note_bodies.body, rev, 0
+            FROM notes LEFT JOIN note_bodies ON note_bodies.id = notes.id WHERE rev > %(rev)s
+            UNION ALL SELECT id, '', 0, 0, 0, 0, '', '', '', NULL, rev, 1
+            FROM note_tombstones WHERE rev > %(rev)s;''',
+
+        'compress_exist': '''SELECT 1 FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = 'note_bodies' AND column_name = 'body';''',
+
+        'compress_init': 'ALTER TABLE note_bodies ADD COLUMN IF NOT EXISTS body BYTEA;',
+
+        'compress_scan': 'SELECT id, text FROM note_bodies WHERE OCTET_LENGTH(text) > %(size)s;',
+
+        'search': "SELECT id FROM note_bodies WHERE to_tsvector('simple', text) @@ to_tsquery('simple', %(query)s);",
+
+        'index_scan': "SELECT id, body FROM note_bodies WHERE body IS NOT NULL AND text = '';",
+
+        'index_text': 'UPDATE note_bodies SET text = %(text)s WHERE id = %(id)s;',
+
+        'search_exist': """SELECT 1 FROM pg_indexes
+            WHERE schemaname = current_schema() AND indexname = 'note_bodies_search';""",
+
+        'search_init': (
+            "CREATE INDEX IF NOT EXISTS note_bodies_search ON note_bodies USING GIN (to_tsvector('simple', text));",
+            'CREATE INDEX IF NOT EXISTS note_bodies_large ON note_bodies(id) WHERE body IS NOT NULL;',
+        ),
+
+        'notify_exist': '''SELECT 1 FROM pg_trigger WHERE tgname = 'qsticky_notify'
+            AND tgrelid IN ('notes'::regclass, 'preferences'::regclass, 'note_bodies'::regclass) HAVING COUNT(*) = 3;''',
+
+        'notify_init': (
+            *SQL['notify_init'],
+            'DROP TRIGGER IF EXISTS qsticky_notify ON note_bodies;',
+            '''CREATE TRIGGER qsticky_notify AFTER INSERT OR UPDATE OR DELETE ON note_bodies
+            FOR EACH ROW EXECUTE PROCEDURE qsticky_notify();''',
+        ),
+    }
+    RETRY = DataBaseConnector.RETRY | {'settled'}
+
     @HandleError(psycopg2.Error)
-    def __init__(self, host: str, port: str, dbname: str, user: str, password: str) -> None:
-        """ Initialize the database connection.
+    def __init__(self, host: str, port: str, dbname: str, user: str, password: str,
+                 pool_size: int = 2, idle_timeout: float = 600.0, connect_timeout: int = 10,
+                 split_bodies: bool = False) -> None:
+        """ Initialize the database connection pool.
 
         Args:
             host (str): The host of the PostgreSQL server.
             port (str): The port of the PostgreSQL server.
             dbname (str): The name of the database.
             user (str): The username for database access.
-            password (str): The password for database access. """
-        self.conn = psycopg2.connect(
+            password (str): The password for database access.
+            pool_size (int, optional): The maximum number of connections, notes are streamed
+                at startup with 2 or more. Defaults to 2.
+            idle_timeout (float, optional): Seconds after which an unused connection is replaced.
+                Defaults to 600.
+            connect_timeout (int, optional): Seconds to wait for a connection. Defaults to 10.
+            split_bodies (bool, optional): Keep note texts in separate table. Defaults to False. """
+        self.pool = ConnectionPool(
+            1,
+            pool_size,
+            idle_timeout,
             host=host,
             port=port,
             dbname=dbname,
             user=user,
-            password=password
+            password=password,
+            connect_timeout=connect_timeout,
+            application_name=CLIENT
         )
 
-        with self.conn.cursor() as cursor:
+        with self.connection() as conn, conn.cursor() as cursor:
             cursor.execute("SELECT version();")
             query = cursor.fetchone()
-        logger.info(f"PostgreSQLConnector::Connected to - {query[0]}")
-        logger.debug("PostgreSQLConnector::server information:")
-        logger.debug(self.conn.get_dsn_parameters())
-        self.execute_sql('init')
-        self.execute_sql('pref_init')
+            conn.rollback()
+            logger.info(f"PostgreSQLConnector::Connected to - {query[0]}")
+            logger.debug("PostgreSQLConnector::server information:")
+            logger.debug(conn.get_dsn_parameters())
+        self.init_schema(split_bodies)
+
+    def init_schema(self, split_bodies: bool) -> None:
+        super().init_schema(split_bodies)
+        # Change notifications are optional, creating triggers requires ownership of tables
+        try:
+            with self.connection() as conn:
+                with conn.cursor() as cursor:
+                    (sql,) = self.statements('notify_exist')
+                    cursor.execute(sql)
+                    if cursor.fetchone() is None:
+                        logger.info(f'{type(self).__name__}::Creating change notification triggers')
+                        for sql in self.statements('notify_init'):
+                            cursor.execute(sql)
+                conn.commit()
+        except psycopg2.Error as error:
+            logger.warning(f'{type(self).__name__}::Change notifications not available: {error}')
+
+    @contextmanager
+    def connection(self):
+        """ Borrow a connection from the pool, rolling back on errors. """
+        conn = self.pool.getconn()
+        try:
+            yield conn
+        except psycopg2.Error:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            self.pool.putconn(conn)
+
+    def close(self) -> None:
+        logger.info(f'{type(self).__name__}::Closing connections')
+        self.pool.closeall()
+
+    def reconnect(self) -> None:
+        self.pool.expire()
 
+    @staticmethod
+    def search_terms(words: list[str]) -> str:
+        return ' & '.join(f"'{word}':*" for word in words)
+
+    def changes_since(self, token: int|None = None) -> tuple[list, list|None, int]:
+        # A revision read may be followed by a lower one committed later, so the next token is the last
+        # revision of transactions finished before reading. Changes newer than it are read again next time.
+        with closing(self.execute_sql('settled')) as cursor:
+            (settled,) = cursor.fetchone()
+        notes, gone, _ = super().changes_since(token)
+        return notes, gone, settled if token is None or gone is None else max(token, settled)
+
+    def stream(self, statement: str, values: dict, batch_size: int) -> Iterator[list[tuple]]:
+        # A named cursor keeps the result on the server, its connection is borrowed until the end.
+        # Writes meanwhile need another connection of the pool, with a single one rows are read at once.
+        if self.pool.maxconn < 2:
+            yield from super().stream(statement, values, batch_size)
+            return
+        conn, cursor = self.declare(statement, values, batch_size)
+        try:
+            while rows := cursor.fetchmany(batch_size):
+                yield rows
+        except psycopg2.Error as error:
+            logger.error(f'{type(self).__name__}.stream failed! Statement: {statement} Error: {error}')
+            raise
+        finally:
+            if not conn.closed:
+                cursor.close()
+                conn.rollback()
+            self.pool.putconn(conn)
+
+    @HandleError(psycopg2.Error)
+    @Retry((psycopg2.OperationalError, psycopg2.InterfaceError))
+    def declare(self, statement: str, values: dict, batch_size: int) -> tuple:
+        """ Run the query with a named cursor, which keeps the result on the server.
+
+        Args:
+            statement (str): Key of the SQL query.
+            values (dict): Values of the query parameters.
+            batch_size (int): The number of rows fetched at once.
+
+        Returns:
+            tuple: The connection borrowed from the pool, to be returned after reading, and the cursor. """
+        (sql,) = self.statements(statement)
+        conn = self.pool.getconn()
+        try:
+            cursor = conn.cursor(name='qsticky_stream')
+            cursor.itersize = batch_size
+            cursor.execute(sql, values)
+        except psycopg2.Error:
+            if not conn.closed:
+                conn.rollback()
+            self.pool.putconn(conn)
+            raise
+        return conn, cursor
 
     @HandleError(psycopg2.Error)
+    @Retry((psycopg2.OperationalError, psycopg2.InterfaceError))
     def execute_sql(self, statement: str, values:dict|int={}) -> psycopg2.extensions.cursor:
-        if statement not in self.SQL:
-            raise ValueError(f"Invalid SQL key argument: {statement}")
+        statements = self.statements(statement)
         if isinstance(values, int):
             values = {'id': values} # convert to dict to pass as statement value
 
-        cursor = self.conn.cursor()
-        cursor.execute(self.SQL[statement], values)
-        self.conn.commit()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            for sql in statements:
+                cursor.execute(sql, values)
+            conn.commit()
         return cursor
+
+    @HandleError(psycopg2.Error)
+    @Retry((psycopg2.OperationalError, psycopg2.InterfaceError))
+    def execute_many(self, batch: list[tuple[str, list[dict|int]]]) -> bool:
+        batch = [(self.statements(statement), values) for statement, values in batch]
+
+        with self.connection() as conn:
+            with conn.cursor() as cursor:
+                for statements, values in batch:
+                    values = [{'id': value} if isinstance(value, int) else value for value in values]
+                    for sql in statements:
+                        psycopg2.extras.execute_batch(cursor, sql, values)
+            conn.commit()
+        return True
+
+
+class ChangeListener(QObject):
+    """ Receiver of notifications about changes made by other clients, sent by database triggers.
+
+    Runs in its own thread, woken up by a socket notifier when notifications arrive.
+
+    Signals:
+        notes_changed (list, list): Emitted with ids of changed notes and ids of deleted notes.
+        preferences_changed: Emitted when global preferences were changed.
+        reconnected: Emitted when listening resumed after a lost connection, changes made
+            meanwhile were missed. """
+    notes_changed = Signal(list, list)
+    preferences_changed = Signal()
+    reconnected = Signal()
+    RETRY_AFTER = 30.0
+
+    def __init__(self, host: str, port: str, dbname: str, user: str, password: str,
+                 connect_timeout: int = 10) -> None:
+        """ Start listening in a separate thread.
+
+        Args:
+            host (str): The host of the PostgreSQL server.
+            port (str): The port of the PostgreSQL server.
+            dbname (str): The name of the database.
+            user (str): The username for database access.
+            password (str): The password for database access.
+            connect_timeout (int, optional): Seconds to wait for a connection. Defaults to 10. """
+        super().__init__()
+        self.params = {'host': host, 'port': port, 'dbname': dbname, 'user': user,
+                       'password': password, 'connect_timeout': connect_timeout}
+        self.conn = None
+        self.notifier = None
+        self.lost = False
+        self.thread = QThread()
+        self.moveToThread(self.thread)
+        self.thread.started.connect(self.listen)
+        self.thread.start()
+
+    def listen(self) -> None:
+        """ Connect to the server and subscribe to change notifications. """
+        try:
+            self.conn = psycopg2.connect(application_name=f'{CLIENT}-listener', **self.params)
+            self.conn.autocommit = True
+            with self.conn.cursor() as cursor:
+                cursor.execute(f'LISTEN {CHANNEL};')
+        except psycopg2.Error as error:
+            logger.warning(f'{type(self).__name__}::Could not listen, retrying later: {error}')
+            self.drop()
+            QTimer.singleShot(int(self.RETRY_AFTER * 1000), self.listen)
+            return
+        logger.info(f'{type(self).__name__}::Listening for changes')
+        self.notifier = QSocketNotifier(self.conn.fileno(), QSocketNotifier.Type.Read, self)
+        self.notifier.activated.connect(self.receive)
+        if self.lost:
+            self.lost = False
+            self.reconnected.emit()
+
+    def receive(self) -> None:
+        """ Read arrived notifications and report changes. """
+        try:
+            self.conn.poll()
+        except psycopg2.Error as error:
+            logger.warning(f'{type(self).__name__}::Lost connection: {error}')
+            self.drop()
+            self.lost = True
+            QTimer.singleShot(int(self.RETRY_AFTER * 1000), self.listen)
+            return
+        changed, deleted, preferences = set(), set(), False
+        while self.conn.notifies:
+            payload = json.loads(self.conn.notifies.pop(0).payload)
+            if payload['client'] == CLIENT:
+                continue
+            match payload['table'], payload['op']:
+                case 'preferences', _:
+                    preferences = True
+                case 'notes', 'DELETE':
+                    deleted.add(payload['id'])
+                    changed.discard(payload['id'])
+                case _, 'DELETE':
+                    pass    # text deleted together with its note
+                case _:
+                    changed.add(payload['id'])
+                    deleted.discard(payload['id'])
+        logger.debug(f'{type(self).__name__}::Changed {changed}, deleted {deleted}, preferences {preferences}')
+        if changed or deleted:
+            self.notes_changed.emit(sorted(changed), sorted(deleted))
+        if preferences:
+            self.preferences_changed.emit()
+
+    def drop(self) -> None:
+        """ Stop watching the socket and close the connection. """
+        if self.notifier is not None:
+            self.notifier.setEnabled(False)
+            self.notifier.deleteLater()
+            self.notifier = None
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def stop(self) -> None:
+        """ Stop the listener thread and close the connection. """
+        self.thread.quit()
+        self.thread.wait()
+        self.drop()
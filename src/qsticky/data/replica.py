@@ -0,0 +1,408 @@
+""" Defines an offline-first connector replicating a database server in a local SQLite file.
+Reads and writes stay on local disk, changes are synchronized with the server in background. """
+import json
+import logging
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import closing
+from itertools import groupby
+
+from PyQt6.QtCore import QThread
+from PyQt6.QtCore import pyqtSignal as Signal
+
+from qsticky.data.abstract import FIELDS, COLUMNS, WORKSPACE, StorageConnector
+from qsticky.data.sqlite import SQLiteConnector
+
+logger = logging.getLogger(__package__)
+
+class ReplicaStore(SQLiteConnector):
+    """ A SQLite connector recording every local write in an outbox table in the same transaction. """
+    SQL = {
+        **SQLiteConnector.SQL,
+
+        'outbox_init': '''CREATE TABLE IF NOT EXISTS outbox (
+            seq     INTEGER     PRIMARY KEY AUTOINCREMENT,
+            op      TEXT        NOT NULL,
+            record  TEXT        NOT NULL);''',
+
+        'outbox_push': 'INSERT INTO outbox(op, record) VALUES(:op, :record);',
+
+        'outbox_take': 'SELECT seq, op, record FROM outbox ORDER BY seq LIMIT :limit;',
+
+        'outbox_done': 'DELETE FROM outbox WHERE seq <= :seq;',
+
+        # Ids reserved on the server for new notes, kept for notes created offline
+        'reserved_init': 'CREATE TABLE IF NOT EXISTS reserved_ids (id INTEGER PRIMARY KEY);',
+
+        'reserved_add': 'INSERT OR IGNORE INTO reserved_ids(id) VALUES(:id);',
+
+        'reserved_count': 'SELECT COUNT(*) FROM reserved_ids;',
+
+        'reserved_next': 'SELECT MIN(id) FROM reserved_ids WHERE id NOT IN (SELECT id FROM notes);',
+
+        'reserved_done': 'DELETE FROM reserved_ids WHERE id = :id OR id IN (SELECT id FROM notes);',
+    }
+
+    def init_schema(self, split_bodies: bool) -> None:
+        super().init_schema(split_bodies)
+        self.execute_sql('outbox_init')
+        self.execute_sql('reserved_init')
+
+    @staticmethod
+    def outbox(operation: str, records: list) -> tuple[str, list[dict]]:
+        """ Return the batch entry queueing records for the server, see execute_many. """
+        return ('outbox_push', [{'op': operation, 'record': json.dumps(record)} for record in records])
+
+    def save(self, note: dict) -> bool:
+        return self.save_many([note])
+
+    def update(self, note: dict) -> bool:
+        return self.update_many([note])
+
+    def delete(self, rowid: int) -> bool:
+        return self.delete_many([rowid])
+
+    def save_many(self, notes: list[dict]) -> bool:
+        if not notes:
+            return True
+        return self.execute_many([('upsert', [self.pack(note) for note in notes]), self.outbox('save', notes)])
+
+    def update_many(self, notes: list[dict]) -> bool:
+        if not (batch := self.update_batch(notes)):
+            return True
+        return self.execute_many([*batch, self.outbox('update', [note for note in notes if len(note) > 1])])
+
+    def delete_many(self, rowids: list[int]) -> bool:
+        if not rowids:
+            return True
+        return self.execute_many([('delete', list(rowids)), self.outbox('delete', rowids)])
+
+    def save_preferences(self, preferences: dict) -> bool:
+        return self.execute_many([('pref_upsert', [preferences]), self.outbox('preferences', [preferences])])
+
+    def take(self, limit: int) -> list[tuple[int, str, object]]:
+        """ Return the oldest queued writes as tuples of sequence number, operation and record. """
+        with closing(self.execute_sql('outbox_take', {'limit': limit})) as cursor:
+            return [(seq, op, json.loads(record)) for seq, op, record in cursor.fetchall()]
+
+    def done(self, seq: int) -> None:
+        """ Remove queued writes up to the sequence number, once the server stored them. """
+        self.execute_sql('outbox_done', {'seq': seq})
+
+    def reserve(self, rowids: list[int]) -> None:
+        """ Keep ids reserved on the server for new notes. """
+        self.execute_many([('reserved_add', rowids)])
+
+    def reserved(self) -> int:
+        """ Return the number of reserved ids. """
+        with closing(self.execute_sql('reserved_count')) as cursor:
+            return cursor.fetchone()[0]
+
+    def take_id(self) -> int|None:
+        """ Return a reserved id not taken by a note, None if there is none, and forget it. """
+        with closing(self.execute_sql('reserved_next')) as cursor:
+            (rowid,) = cursor.fetchone()
+        if rowid is not None:
+            self.execute_sql('reserved_done', rowid)
+        return rowid
+
+    def merge(self, notes: list[dict], rowids: list[int], preferences: dict|None) -> None:
+        """ Store changes pulled from the server, bypassing the outbox. """
+        batch = [('upsert', [self.pack(note) for note in notes]), ('delete', list(rowids))]
+        if preferences is not None:
+            batch.append(('pref_upsert', [preferences]))
+        self.execute_many(batch)
+
+
+class Syncer(QThread):
+    """ Worker thread synchronizing the replica with the server.
+
+    Signals:
+        notes_pulled (list, list): Emitted with rows of notes changed and ids of notes deleted
+            by other clients.
+        preferences_pulled: Emitted when global preferences were changed by another client. """
+    notes_pulled = Signal(list, list)
+    preferences_pulled = Signal()
+
+    def __init__(self, replica: 'ReplicaConnector') -> None:
+        super().__init__()
+        self.replica = replica
+
+    def run(self) -> None:
+        """ Synchronize until the replica is closed. """
+        logger.debug('Syncer::Started')
+        while self.replica.wait():
+            self.replica.sync()
+        self.replica.sync(pull=False)
+        logger.debug('Syncer::Stopped')
+
+
+class ReplicaConnector(StorageConnector):
+    """ Storage connector serving notes from a local replica of the database server.
+
+    Local writes are queued in a durable outbox and pushed to the server when it's reachable,
+    then changes of other clients are pulled. Fields changed both locally and remotely keep
+    the local value, as it's pushed later. New notes get ids reserved on the server in advance,
+    kept in the replica for notes created offline. Other ids could be taken by notes of other clients.
+
+    Class Attributes:
+        BATCH (int): The number of queued writes pushed at once.
+        RESERVE (int): The number of ids kept reserved.
+        WAIT (float): Seconds to wait for a reservation while online, when no id is left. """
+    BATCH = 100
+    RESERVE = 10
+    WAIT = 5.0
+
+    def __init__(self, path: str, remote, interval: float = 30.0) -> None:
+        """ Open the replica and start synchronizing.
+
+        Args:
+            path (str): The path of the replica SQLite database file.
+            remote (callable): Returns a new StorageConnector of the database server.
+            interval (float, optional): Seconds between pulls and reconnection attempts.
+                Defaults to 30. """
+        self.store = ReplicaStore(path)
+        self.factory = remote
+        self.remote = None
+        self.interval = interval
+        self.lock = threading.Lock()    # serializes access to the replica
+        self.cond = threading.Condition()
+        self.pending = True
+        self.closing = False
+        self.pulled = 0.0
+        self.token = None       # changes_since token of the server, None until the first pull
+        self.offline = False    # the last attempt to reach the server failed
+        self.syncer = Syncer(self)
+        self.syncer.start()
+
+    def retrieve(self, rowids: list[int]|None = None, workspace: str|None = None) -> list[tuple]:
+        with self.lock:
+            return self.store.retrieve(rowids, workspace)
+
+    def retrieve_meta(self, workspace: str|None = None) -> list[tuple]:
+        with self.lock:
+            return self.store.retrieve_meta(workspace)
+
+    def retrieve_bodies(self, rowids: list[int]|None = None, workspace: str|None = None) -> list[tuple]:
+        with self.lock:
+            return self.store.retrieve_bodies(rowids, workspace)
+
+    def retrieve_workspaces(self, rowids: list[int]|None = None) -> list[tuple]:
+        with self.lock:
+            return self.store.retrieve_workspaces(rowids)
+
+    def iter_notes(self, batch_size: int = 100, workspace: str|None = None) -> Iterator[list[tuple]]:
+        batches = self.store.iter_notes(batch_size, workspace)
+        while True:
+            with self.lock:
+                if (rows := next(batches, None)) is None:
+                    return
+            yield rows
+
+    def changes_since(self, token: int|None = None) -> tuple[list[tuple], list[int]|None, int]:
+        with self.lock:
+            return self.store.changes_since(token)
+
+    def search(self, query: str) -> list[int]:
+        with self.lock:
+            return self.store.search(query)
+
+    def new_id(self) -> int:
+        with self.cond:
+            self.pending = True     # the syncer tops up reserved ids
+            self.cond.notify_all()
+            self.cond.wait_for(lambda: self.offline or self.reserved(), self.WAIT)
+        with self.lock:
+            if (rowid := self.store.take_id()) is None:
+                raise RuntimeError('No ids of new notes are reserved on the server, it was not reachable')
+            return rowid
+
+    def reserved(self) -> bool:
+        """ Return True if a reserved id is left. """
+        with self.lock:
+            return self.store.reserved() > 0
+
+    def save(self, note: dict) -> bool:
+        return self.write(self.store.save, note)
+
+    def update(self, note: dict) -> bool:
+        return self.write(self.store.update, note)
+
+    def delete(self, rowid: int) -> bool:
+        return self.write(self.store.delete, rowid)
+
+    def save_many(self, notes: list[dict]) -> bool:
+        return self.write(self.store.save_many, notes)
+
+    def update_many(self, notes: list[dict]) -> bool:
+        return self.write(self.store.update_many, notes)
+
+    def delete_many(self, rowids: list[int]) -> bool:
+        return self.write(self.store.delete_many, rowids)
+
+    def get_preferences(self) -> tuple:
+        with self.lock:
+            return self.store.get_preferences()
+
+    def save_preferences(self, preferences: dict) -> bool:
+        return self.write(self.store.save_preferences, preferences)
+
+    def write(self, method, *args) -> bool:
+        """ Write to the replica and wake up the syncer. """
+        with self.lock:
+            result = method(*args)
+        with self.cond:
+            self.pending = True
+            self.cond.notify_all()
+        return result
+
+    def wait(self) -> bool:
+        """ Wait for local writes or the next pull (called by the syncer thread).
+
+        Returns:
+            bool: False if the replica is closing, True otherwise. """
+        with self.cond:
+            self.cond.wait_for(lambda: self.closing or (self.pending and self.remote is not None),
+                               max(0.0, self.pulled + self.interval - time.monotonic()))
+            self.pending = False
+            return not self.closing
+
+    def sync(self, pull: bool = True) -> None:
+        """ Push queued writes and pull remote changes if due (called by the syncer thread).
+
+        Args:
+            pull (bool, optional): Pull remote changes. Defaults to True. """
+        try:
+            if self.remote is None:
+                if self.closing:
+                    return
+                self.remote = self.factory()
+                self.offline = False
+                logger.info(f'{type(self).__name__}::Connected to server')
+            self.push()
+            if pull:
+                self.reserve()
+            if pull and time.monotonic() - self.pulled >= self.interval:
+                self.pull()
+                self.pulled = time.monotonic()
+        except Exception as error:
+            logger.warning(f'{type(self).__name__}::Working offline: {error}')
+            self.disconnect()
+            with self.cond:
+                self.offline = True
+                self.cond.notify_all()
+            self.pulled = time.monotonic()
+
+    def push(self) -> None:
+        """ Send queued writes to the server in order. """
+        while True:
+            with self.lock:
+                if not (entries := self.store.take(self.BATCH)):
+                    return
+            for operation, group in groupby(entries, key=lambda entry: entry[1]):
+                records = [record for _, _, record in group]
+                match operation:
+                    case 'save':
+                        stored = self.remote.save_many(records)
+                    case 'update':
+                        stored = self.remote.update_many(records)
+                    case 'delete':
+                        stored = self.remote.delete_many(records)
+                    case 'preferences':
+                        stored = self.remote.save_preferences(records[-1])
+                if not stored:
+                    raise RuntimeError(f'Server refused {operation} of {len(records)} records')
+            self.remote.commit()
+            with self.lock:
+                self.store.done(entries[-1][0])
+            logger.debug(f'{type(self).__name__}::Pushed {len(entries)} writes')
+
+    def reserve(self) -> None:
+        """ Reserve ids for new notes on the server, up to RESERVE of them. """
+        with self.lock:
+            missing = self.RESERVE - self.store.reserved()
+        if missing > 0:
+            rowids = [self.remote.new_id() for _ in range(missing)]
+            with self.lock:
+                self.store.reserve(rowids)
+            with self.cond:
+                self.cond.notify_all()
+
+    def pull(self) -> None:
+        """ Store changes made on the server by other clients in the replica.
+        The first pull compares all notes, later ones only those changed since the previous,
+        unless the server no longer knows all notes deleted since then. """
+        changes, gone, token = self.remote.changes_since(self.token)
+        full = self.token is None or gone is None
+        rows = {row[0]: row for row in changes}
+        workspaces = dict(self.remote.retrieve_workspaces(None if full else list(rows)))
+        remote_pref = self.remote.get_preferences()
+        with self.lock:
+            local = {row[0]: row for row in self.store.retrieve(None if full else list(rows))}
+            # Fields written locally since the last push keep the local value
+            fields, deleted, preferences = {}, set(), False
+            for _, operation, record in self.store.take(-1):
+                match operation:
+                    case 'save' | 'update':
+                        fields.setdefault(record['id'], set()).update(record)
+                        deleted.discard(record['id'])
+                    case 'delete':
+                        deleted.add(record)
+                    case 'preferences':
+                        preferences = True
+            notes, changed = [], []
+            for rowid, row in rows.items():
+                if rowid in deleted:
+                    continue
+                own = fields.get(rowid, set())
+                mine = local.get(rowid)
+                if mine is None and own:
+                    continue
+                merged = tuple(value if mine is None or field not in own else mine[index]
+                               for index, (field, value) in enumerate(zip(('id', *COLUMNS), row)))
+                if merged != mine:
+                    notes.append({**dict(zip(('id', *COLUMNS), merged)),
+                                  'workspace': workspaces.get(rowid, WORKSPACE)})
+                    changed.append(merged)
+            if full:
+                removed = [rowid for rowid in local if rowid not in rows and rowid not in fields]
+            else:
+                removed = [row[0] for row in self.store.retrieve(gone) if row[0] not in fields]
+            pref = None
+            if not preferences and remote_pref and tuple(remote_pref) != tuple(self.store.get_preferences() or ()):
+                pref = dict(zip(('checked', *FIELDS['style']), remote_pref))
+            if notes or removed or pref is not None:
+                self.store.merge(notes, removed, pref)
+            self.token = token
+        if notes or removed:
+            logger.info(f'{type(self).__name__}::Pulled {len(notes)} changed, {len(removed)} deleted notes')
+            self.syncer.notes_pulled.emit(changed, removed)
+        if pref is not None:
+            self.syncer.preferences_pulled.emit()
+
+    def refresh(self) -> None:
+        """ Pull remote changes now, e.g. when the server reports them. """
+        with self.cond:
+            self.pulled = float('-inf')
+            self.pending = True
+            self.cond.notify_all()
+
+    def disconnect(self) -> None:
+        """ Drop the server connection after an error. """
+        if self.remote is not None:
+            try:
+                self.remote.close()
+            except Exception:
+                pass
+            self.remote = None
+
+    def close(self) -> None:
+        """ Push pending writes if online, stop the syncer thread and close the replica. """
+        with self.cond:
+            self.closing = True
+            self.cond.notify_all()
+        self.syncer.wait()
+        if self.remote is not None:
+            self.remote.close()
+        self.store.close()
@@ -0,0 +1,88 @@
+""" Defines a binary snapshot of notes read with mmap at startup.
+Lets note windows be painted before the storage connector answers. """
+import logging
+import mmap
+import os
+import struct
+
+logger = logging.getLogger(__package__)
+
+class Snapshot:
+    """ A file holding the last known state of all notes.
+
+    The file consists of HEADER, a fixed-width RECORD per note and a text area of UTF-8 encoded
+    fonts and texts, which records point to by offset and length. """
+    MAGIC = b'QSN1'
+    HEADER = struct.Struct('<4sI')              # magic, number of records
+    RECORD = struct.Struct('<q4i16s16s4I')      # id, geometry, bgcolor, fcolor, font and text offsets
+
+    def __init__(self, path: str) -> None:
+        """ Initialize the snapshot.
+
+        Args:
+            path (str): The snapshot file path. """
+        self.path = path
+
+    def read(self) -> list[tuple]:
+        """ Return notes stored in the snapshot, an empty list if it's missing or damaged.
+
+        Returns:
+            list[tuple]: Tuples of id, text, xpos, ypos, width, height, bgcolor, font, fcolor. """
+        try:
+            with open(self.path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                magic, count = self.HEADER.unpack_from(data)
+                if magic != self.MAGIC:
+                    raise ValueError('wrong file format')
+                start = self.HEADER.size + count * self.RECORD.size
+                rows = []
+                for offset in range(self.HEADER.size, start, self.RECORD.size):
+                    (rowid, xpos, ypos, width, height, bgcolor, fcolor,
+                     font_at, font_len, text_at, text_len) = self.RECORD.unpack_from(data, offset)
+                    if start + max(font_at + font_len, text_at + text_len) > len(data):
+                        raise ValueError('truncated text area')
+                    rows.append((
+                        rowid,
+                        data[start + text_at:start + text_at + text_len].decode(),
+                        xpos, ypos, width, height,
+                        bgcolor.rstrip(b'\0').decode(),
+                        data[start + font_at:start + font_at + font_len].decode(),
+                        fcolor.rstrip(b'\0').decode(),
+                    ))
+        except FileNotFoundError:
+            return []
+        except (OSError, ValueError, struct.error) as error:
+            logger.warning(f'Snapshot::Ignoring {self.path}: {error}')
+            return []
+        logger.debug(f'Snapshot::Read {len(rows)} notes')
+        return rows
+
+    def write(self, notes: list[dict]) -> None:
+        """ Replace the snapshot with the given notes.
+
+        Args:
+            notes (list[dict]): Dictionaries of all note parameters. """
+        records, area, size = [], [], 0
+        try:
+            for note in notes:
+                font, text = note['font'].encode(), note['text'].encode()
+                bgcolor, fcolor = note['bgcolor'].encode(), note['fcolor'].encode()
+                if max(len(bgcolor), len(fcolor)) > 16:
+                    raise ValueError(f'color name too long in note {note["id"]}')
+                records.append(self.RECORD.pack(
+                    note['id'], note['xpos'], note['ypos'], note['width'], note['height'],
+                    bgcolor, fcolor,
+                    size, len(font), size + len(font), len(text),
+                ))
+                area += [font, text]
+                size += len(font) + len(text)
+            temp = f'{self.path}.tmp'
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(temp, 'wb') as file:
+                file.write(self.HEADER.pack(self.MAGIC, len(records)))
+                file.writelines(records)
+                file.writelines(area)
+            os.replace(temp, self.path)
+        except (OSError, ValueError, struct.error) as error:
+            logger.warning(f'Snapshot::Could not write {self.path}: {error}')
+            return
+        logger.debug(f'Snapshot::Wrote {len(records)} notes')
@@ -19,20 +19,90 @@ class SQLiteConnector(DataBaseConnector):
             height  INTEGER     NOT NULL,
             bgcolor TEXT        NOT NULL,
             font    TEXT        NOT NULL,
-            fcolor  TEXT        NOT NULL);''',
+            fcolor  TEXT        NOT NULL,
+            body    BLOB        NULL,
+            rev     INTEGER     NOT NULL    DEFAULT 0);''',
+
+        'retrieve': 'SELECT id, text, xpos, ypos, width, height, bgcolor, font, fcolor, body FROM notes;',
+
+        'retrieve_note': '''SELECT id, text, xpos, ypos, width, height, bgcolor, font, fcolor, body
+            FROM notes WHERE id = :id AND (:workspace IS NULL OR workspace = :workspace);''',
+
+        'retrieve_in': '''SELECT id, text, xpos, ypos, width, height, bgcolor, font, fcolor, body
+            FROM notes WHERE workspace = :workspace ORDER BY rev DESC;''',
+
+        'retrieve_meta': 'SELECT id, xpos, ypos, width, height, bgcolor, font, fcolor FROM notes;',
+
+        'retrieve_meta_in': '''SELECT id, xpos, ypos, width, height, bgcolor, font, fcolor
+            FROM notes WHERE workspace = :workspace ORDER BY rev DESC;''',
+
+        'retrieve_bodies': 'SELECT id, text, body FROM notes;',
+
+        'retrieve_body': '''SELECT id, text, body FROM notes
+            WHERE id = :id AND (:workspace IS NULL OR workspace = :workspace);''',
+
+        'retrieve_bodies_in': 'SELECT id, text, body FROM notes WHERE workspace = :workspace;',
 
-        'retrieve': 'SELECT * FROM notes;',
+        'retrieve_workspaces': 'SELECT id, workspace FROM notes;',
 
-        'upsert': '''INSERT INTO notes(id, text, xpos, ypos, width, height, bgcolor, font, fcolor)
-            VALUES(:id, :text, :xpos, :ypos, :width, :height, :bgcolor, :font, :fcolor)
+        'retrieve_workspace': 'SELECT id, workspace FROM notes WHERE id = :id;',
+
+        'upsert': (
+            'UPDATE revision SET value = value + 1 WHERE id = 0;',
+            '''INSERT INTO notes(id, text, xpos, ypos, width, height, bgcolor, font, fcolor, body, rev, workspace)
+            VALUES(:id, :text, :xpos, :ypos, :width, :height, :bgcolor, :font, :fcolor, :body,
+            (SELECT value FROM revision WHERE id = 0), :workspace)
             ON CONFLICT(id) DO UPDATE
             SET text = :text, xpos = :xpos, ypos = :ypos, width = :width, height = :height,
-            bgcolor = :bgcolor, font = :font, fcolor = :fcolor WHERE id = :id;''',
+            bgcolor = :bgcolor, font = :font, fcolor = :fcolor, body = :body, rev = excluded.rev WHERE id = :id;''',
+            'DELETE FROM note_tombstones WHERE id = :id;',
+        ),
+
+        'update': (
+            'UPDATE revision SET value = value + 1 WHERE id = 0;',
+            '''UPDATE notes SET text = :text, body = :body, xpos = :xpos, ypos = :ypos,
+            width = :width, height = :height, rev = (SELECT value FROM revision WHERE id = 0) WHERE id = :id;''',
+        ),
+
+        'update_text': (
+            'UPDATE revision SET value = value + 1 WHERE id = 0;',
+            '''UPDATE notes SET text = :text, body = :body,
+            rev = (SELECT value FROM revision WHERE id = 0) WHERE id = :id;''',
+        ),
+
+        'update_geometry': (
+            'UPDATE revision SET value = value + 1 WHERE id = 0;',
+            '''UPDATE notes SET xpos = :xpos, ypos = :ypos, width = :width, height = :height,
+            rev = (SELECT value FROM revision WHERE id = 0) WHERE id = :id;''',
+        ),
 
-        'update': '''UPDATE notes SET text = :text, xpos = :xpos, ypos = :ypos,
-            width = :width, height = :height WHERE id = :id;''',
+        'update_style': (
+            'UPDATE revision SET value = value + 1 WHERE id = 0;',
+            '''UPDATE notes SET bgcolor = :bgcolor, font = :font, fcolor = :fcolor,
+            rev = (SELECT value FROM revision WHERE id = 0) WHERE id = :id;''',
+        ),
 
-        'delete': 'DELETE FROM notes WHERE id = :id;',
+        'delete': (
+            'UPDATE revision SET value = value + 1 WHERE id = 0;',
+            '''INSERT INTO note_tombstones(id, rev)
+            SELECT id, (SELECT value FROM revision WHERE id = 0) FROM notes WHERE id = :id
+            ON CONFLICT(id) DO UPDATE SET rev = excluded.rev;''',
+            'DELETE FROM notes WHERE id = :id;',
+        ),
+
+        'changes': '''SELECT id, text, xpos, ypos, width, height, bgcolor, font, fcolor, body, rev, 0
+            FROM notes WHERE rev > :rev
+            UNION ALL SELECT id, '', 0, 0, 0, 0, '', '', '', NULL, rev, 1
+            FROM note_tombstones WHERE rev > :rev;''',
+
+        'horizon': 'SELECT value FROM revision WHERE id = 1;',
+
+        # All but the newest tombstones are dropped, tokens older than them are answered with all notes
+        'prune': (
+            '''UPDATE revision SET value = COALESCE((SELECT rev FROM note_tombstones
+            ORDER BY rev DESC LIMIT 1 OFFSET :keep), value) WHERE id = 1;''',
+            'DELETE FROM note_tombstones WHERE rev <= (SELECT value FROM revision WHERE id = 1);',
+        ),
 
         'pref_init': '''CREATE TABLE IF NOT EXISTS preferences (
             id      INTEGER     PRIMARY KEY,
@@ -47,25 +117,240 @@ class SQLiteConnector(DataBaseConnector):
             SET checked = :checked, bgcolor = :bgcolor, font = :font, fcolor = :fcolor WHERE id = 0;''',
 
         'pref_get': 'SELECT checked, bgcolor, font, fcolor FROM preferences WHERE id = 0;',
+
+        'bodies_exist': "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'note_bodies';",
+
+        'bodies_init': (
+            '''CREATE TABLE IF NOT EXISTS note_bodies (
+            id      INTEGER     PRIMARY KEY,
+            text    TEXT        NOT NULL,
+            body    BLOB        NULL);''',
+            'INSERT INTO note_bodies(id, text, body) SELECT id, text, body FROM notes;',
+            "UPDATE notes SET text = '', body = NULL;",
+        ),
+
+        'compress_exist': "SELECT 1 FROM pragma_table_info('notes') WHERE name = 'body';",
+
+        'compress_init': 'ALTER TABLE notes ADD COLUMN body BLOB;',
+
+        'compress_scan': 'SELECT id, text FROM notes WHERE LENGTH(CAST(text AS BLOB)) > :size;',
+
+        'rev_exist': "SELECT 1 FROM pragma_table_info('notes') WHERE name = 'rev';",
+
+        'rev_init': 'ALTER TABLE notes ADD COLUMN rev INTEGER NOT NULL DEFAULT 0;',
+
+        # The workspace column is added to new and old databases alike
+        'workspace_exist': "SELECT 1 FROM pragma_table_info('notes') WHERE name = 'workspace';",
+
+        'workspace_init': (
+            "ALTER TABLE notes ADD COLUMN workspace TEXT NOT NULL DEFAULT 'default';",
+            'CREATE INDEX IF NOT EXISTS notes_workspace ON notes(workspace);',
+        ),
+
+        # Row 0 holds the last revision, row 1 the last one of pruned tombstones
+        'revision_init': (
+            '''CREATE TABLE IF NOT EXISTS revision (
+            id      INTEGER     PRIMARY KEY,
+            value   INTEGER     NOT NULL);''',
+            'INSERT OR IGNORE INTO revision(id, value) VALUES(0, 0);',
+            'INSERT OR IGNORE INTO revision(id, value) VALUES(1, 0);',
+            '''CREATE TABLE IF NOT EXISTS note_tombstones (
+            id      INTEGER     PRIMARY KEY,
+            rev     INTEGER     NOT NULL);''',
+            'CREATE INDEX IF NOT EXISTS notes_rev ON notes(rev);',
+            'CREATE INDEX IF NOT EXISTS note_tombstones_rev ON note_tombstones(rev);',
+        ),
+
+        # The last reserved id, new ids are also above ids saved without reserving them
+        'ids_init': (
+            '''CREATE TABLE IF NOT EXISTS note_ids (
+            id      INTEGER     PRIMARY KEY,
+            value   INTEGER     NOT NULL);''',
+            'INSERT OR IGNORE INTO note_ids(id, value) VALUES(0, -1);',
+        ),
+
+        'new_id': (
+            '''UPDATE note_ids SET value = MAX(value, (SELECT COALESCE(MAX(id), -1) FROM notes),
+            (SELECT COALESCE(MAX(id), -1) FROM note_tombstones)) + 1 WHERE id = 0;''',
+            'SELECT value FROM note_ids WHERE id = 0;',
+        ),
+
+        'search': 'SELECT rowid FROM note_search WHERE note_search MATCH :query;',
+
+        'index_scan': "SELECT id, body FROM notes WHERE body IS NOT NULL AND text = '';",
+
+        'index_text': 'UPDATE notes SET text = :text WHERE id = :id;',
+
+        'search_exist': """SELECT 1 FROM sqlite_master
+            WHERE type = 'trigger' AND name = 'note_search_insert' AND tbl_name = 'notes';""",
+
+        # FTS5 table holding copies of texts, kept in sync by triggers
+        'search_init': (
+            'DROP TABLE IF EXISTS note_search;',
+            'CREATE VIRTUAL TABLE note_search USING fts5(text);',
+            'DROP TRIGGER IF EXISTS note_search_insert;',
+            'DROP TRIGGER IF EXISTS note_search_update;',
+            'DROP TRIGGER IF EXISTS note_search_delete;',
+            '''CREATE TRIGGER note_search_insert AFTER INSERT ON notes BEGIN
+            INSERT INTO note_search(rowid, text) VALUES(new.id, new.text); END;''',
+            '''CREATE TRIGGER note_search_update AFTER UPDATE OF text ON notes BEGIN
+            UPDATE note_search SET text = new.text WHERE rowid = new.id; END;''',
+            '''CREATE TRIGGER note_search_delete AFTER DELETE ON notes BEGIN
+            DELETE FROM note_search WHERE rowid = old.id; END;''',
+            'INSERT INTO note_search(rowid, text) SELECT id, text FROM notes;',
+            'CREATE INDEX IF NOT EXISTS notes_large ON notes(id) WHERE body IS NOT NULL;',
+        ),
+    }
+
+    SQL_SPLIT = {
+        'retrieve': '''SELECT notes.id, COALESCE(note_bodies.text, ''), xpos, ypos, width, height,
+            bgcolor, font, fcolor, note_bodies.body FROM notes LEFT JOIN note_bodies ON note_bodies.id = notes.id;''',
+
+        'retrieve_note': '''SELECT notes.id, COALESCE(note_bodies.text, ''), xpos, ypos, width, height,
+            bgcolor, font, fcolor, note_bodies.body FROM notes LEFT JOIN note_bodies ON note_bodies.id = notes.id
+            WHERE notes.id = :id AND (:workspace IS NULL OR workspace = :workspace);''',
+
+        'retrieve_in': '''SELECT notes.id, COALESCE(note_bodies.text, ''), xpos, ypos, width, height,
+            bgcolor, font, fcolor, note_bodies.body FROM notes LEFT JOIN note_bodies ON note_bodies.id = notes.id
+            WHERE workspace = :workspace ORDER BY notes.rev DESC;''',
+
+        'retrieve_bodies': 'SELECT id, text, body FROM note_bodies;',
+
+        'retrieve_body': '''SELECT note_bodies.id, note_bodies.text, note_bodies.body
+            FROM note_bodies JOIN notes ON notes.id = note_bodies.id
+            WHERE note_bodies.id = :id AND (:workspace IS NULL OR workspace = :workspace);''',
+
+        'retrieve_bodies_in': '''SELECT note_bodies.id, note_bodies.text, note_bodies.body
+            FROM note_bodies JOIN notes ON notes.id = note_bodies.id WHERE workspace = :workspace;''',
+
+        'upsert': (
+            'UPDATE revision SET value = value + 1 WHERE id = 0;',
+            '''INSERT INTO notes(id, text, xpos, ypos, width, height, bgcolor, font, fcolor, rev, workspace)
+            VALUES(:id, '', :xpos, :ypos, :width, :height, :bgcolor, :font, :fcolor,
+            (SELECT value FROM revision WHERE id = 0), :workspace)
+            ON CONFLICT(id) DO UPDATE
+            SET xpos = :xpos, ypos = :ypos, width = :width, height = :height,
+            bgcolor = :bgcolor, font = :font, fcolor = :fcolor, rev = excluded.rev WHERE id = :id;''',
+            '''INSERT INTO note_bodies(id, text, body) VALUES(:id, :text, :body)
+            ON CONFLICT(id) DO UPDATE SET text = :text, body = :body WHERE id = :id;''',
+            'DELETE FROM note_tombstones WHERE id = :id;',
+        ),
+
+        'update': (
+            *SQL['update_geometry'],
+            '''INSERT INTO note_bodies(id, text, body) VALUES(:id, :text, :body)
+            ON CONFLICT(id) DO UPDATE SET text = :text, body = :body WHERE id = :id;''',
+        ),
+
+        'update_text': (
+            'UPDATE revision SET value = value + 1 WHERE id = 0;',
+            '''INSERT INTO note_bodies(id, text, body) VALUES(:id, :text, :body)
+            ON CONFLICT(id) DO UPDATE SET text = :text, body = :body WHERE id = :id;''',
+            'UPDATE notes SET rev = (SELECT value FROM revision WHERE id = 0) WHERE id = :id;',
+        ),
+
+        'delete': (*SQL['delete'], 'DELETE FROM note_bodies WHERE id = :id;'),
+
+        'changes': '''SELECT notes.id, COALESCE(note_bodies.text, ''), xpos, ypos, width, height,
+            bgcolor, font, fcolor, note_bodies.body, rev, 0
+            FROM notes LEFT JOIN note_bodies ON note_bodies.id = notes.id WHERE rev > :rev
+            UNION ALL SELECT id, '', 0, 0, 0, 0, '', '', '', NULL, rev, 1
+            FROM note_tombstones WHERE rev > :rev;''',
+
+        'compress_exist': "SELECT 1 FROM pragma_table_info('note_bodies') WHERE name = 'body';",
+
+        'compress_init': 'ALTER TABLE note_bodies ADD COLUMN body BLOB;',
+
+        'compress_scan': 'SELECT id, text FROM note_bodies WHERE LENGTH(CAST(text AS BLOB)) > :size;',
+
+        'index_scan': "SELECT id, body FROM note_bodies WHERE body IS NOT NULL AND text = '';",
+
+        'index_text': 'UPDATE note_bodies SET text = :text WHERE id = :id;',
+
+        'search_exist': """SELECT 1 FROM sqlite_master
+            WHERE type = 'trigger' AND name = 'note_search_insert' AND tbl_name = 'note_bodies';""",
+
+        'search_init': (
+            'DROP TABLE IF EXISTS note_search;',
+            'CREATE VIRTUAL TABLE note_search USING fts5(text);',
+            'DROP TRIGGER IF EXISTS note_search_insert;',
+            'DROP TRIGGER IF EXISTS note_search_update;',
+            'DROP TRIGGER IF EXISTS note_search_delete;',
+            '''CREATE TRIGGER note_search_insert AFTER INSERT ON note_bodies BEGIN
+            INSERT INTO note_search(rowid, text) VALUES(new.id, new.text); END;''',
+            '''CREATE TRIGGER note_search_update AFTER UPDATE OF text ON note_bodies BEGIN
+            UPDATE note_search SET text = new.text WHERE rowid = new.id; END;''',
+            '''CREATE TRIGGER note_search_delete AFTER DELETE ON note_bodies BEGIN
+            DELETE FROM note_search WHERE rowid = old.id; END;''',
+            'INSERT INTO note_search(rowid, text) SELECT id, text FROM note_bodies;',
+            'CREATE INDEX IF NOT EXISTS note_bodies_large ON note_bodies(id) WHERE body IS NOT NULL;',
+        ),
+    }
+
+    # Performance profiles - PRAGMA settings applied on connection
+    PROFILES = {
+        # Journal mode stored in database file (rollback journal by default), fsync on every commit
+        'safe': {
+            'synchronous': 'FULL',
+            'busy_timeout': 5000,
+        },
+        # Write-ahead log, still durable after power loss
+        'wal': {
+            'journal_mode': 'WAL',
+            'synchronous': 'FULL',
+            'mmap_size': 64 * 1024 * 1024,
+            'cache_size': -8000,    # in KiB
+            'busy_timeout': 5000,
+        },
+        # Write-ahead log, fsync on checkpoints only - last commits may be lost after power loss
+        'fast': {
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            'mmap_size': 64 * 1024 * 1024,
+            'cache_size': -8000,
+            'busy_timeout': 5000,
+        },
     }
 
     @HandleError(sqlite3.Error)
-    def __init__(self, db:str) -> None:
+    def __init__(self, db:str, profile:str='safe', split_bodies:bool=False) -> None:
         """ Initialize the database connection.
 
         Args:
-            db (str): The path of the SQLite database file. """
-        self.conn = sqlite3.connect(db)
+            db (str): The path of the SQLite database file.
+            profile (str, optional): The name of performance profile from PROFILES.
+                Defaults to 'safe'.
+            split_bodies (bool, optional): Keep note texts in separate table. Defaults to False. """
+        # Access from the writer thread is serialized by WriteBehindQueue
+        self.conn = sqlite3.connect(db, check_same_thread=False)
         logger.info(f'SQLiteConnector::Connected to - {db}')
-        self.execute_sql('init')
-        self.execute_sql('pref_init')
+        for pragma, value in self.PROFILES[profile].items():
+            self.conn.execute(f'PRAGMA {pragma} = {value};')
+        logger.debug(f'SQLiteConnector::Using {profile} profile {self.PROFILES[profile]}')
+        self.init_schema(split_bodies)
+
+    @staticmethod
+    def search_terms(words: list[str]) -> str:
+        return ' '.join(f'"{word}"*' for word in words)
 
     @HandleError(sqlite3.Error)
     def execute_sql(self, statement: str, values:dict|int={}) -> sqlite3.Cursor:
-        if statement not in self.SQL:
-            raise ValueError(f"Invalid SQL key argument: {statement}")
+        statements = self.statements(statement)
         if isinstance(values, int):
             values = {'id': values} # convert to dict to pass as statement value
 
         with self.conn as connection:
-            return connection.execute(self.SQL[statement], values)
+            for sql in statements:
+                cursor = connection.execute(sql, values)
+            return cursor
+
+    @HandleError(sqlite3.Error)
+    def execute_many(self, batch: list[tuple[str, list[dict|int]]]) -> bool:
+        batch = [(self.statements(statement), values) for statement, values in batch]
+
+        with self.conn as connection:
+            for statements, values in batch:
+                values = [{'id': value} if isinstance(value, int) else value for value in values]
+                for sql in statements:
+                    connection.executemany(sql, values)
+        return True
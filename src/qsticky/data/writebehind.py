@@ -0,0 +1,278 @@
+""" Defines a write-behind queue that performs storage writes on a worker thread.
+Keeps slow database round trips out of the GUI event loop. """
+import logging
+import threading
+import time
+from collections.abc import Iterator
+
+from PyQt6.QtCore import QThread
+from PyQt6.QtCore import pyqtSignal as Signal
+
+from qsticky.data.abstract import StorageConnector
+
+logger = logging.getLogger(__package__)
+
+class Writer(QThread):
+    """ Worker thread draining the write-behind queue.
+
+    Signals:
+        failed (str): Emitted with the error message when a group of writes fails.
+        written (int): Emitted with the number of writes stored in a group. """
+    failed = Signal(str)
+    written = Signal(int)
+
+    def __init__(self, queue: 'WriteBehindQueue') -> None:
+        super().__init__()
+        self.queue = queue
+
+    def run(self) -> None:
+        """ Write groups of pending changes until the queue is closed. """
+        logger.debug('Writer::Started')
+        while (group := self.queue.take()) is not None:
+            self.queue.write(group)
+        logger.debug('Writer::Stopped')
+
+
+class WriteBehindQueue(StorageConnector):
+    """ Storage connector wrapper deferring writes to a worker thread.
+
+    Pending writes are merged per note id, so only the latest state of a note is sent.
+    Reads are passed to the wrapped connector after pending writes are flushed. Failed writes are
+    retried after a delay doubled by every failure in a row, or at once when flushed.
+
+    Class Attributes:
+        BACKOFF (float): The longest delay in seconds before retrying failed writes. """
+    BACKOFF = 60.0
+
+    def __init__(self, connector: StorageConnector, delay: float = 0.5) -> None:
+        """ Initialize the queue and start the writer thread.
+
+        Args:
+            connector (StorageConnector): The connector performing the actual writes.
+            delay (float, optional): Seconds to collect writes before storing them as a group.
+                Defaults to 0.5. """
+        self.connector = connector
+        self.delay = delay
+        self.lock = threading.Lock()    # serializes access to the wrapped connector
+        self.cond = threading.Condition()
+        self.notes = {}                 # id -> (operation, note)
+        self.preferences = None
+        self.busy = False
+        self.closing = False
+        self.flushing = 0
+        self.retry = False
+        self.failures = 0               # failed writes in a row
+        self.rounds = 0
+        self.writer = Writer(self)
+        self.writer.start()
+
+    def retrieve(self, rowids: list[int]|None = None, workspace: str|None = None) -> list[tuple]:
+        self.flush()
+        with self.lock:
+            return self.connector.retrieve(rowids, workspace)
+
+    def retrieve_meta(self, workspace: str|None = None) -> list[tuple]:
+        self.flush()
+        with self.lock:
+            return self.connector.retrieve_meta(workspace)
+
+    def retrieve_bodies(self, rowids: list[int]|None = None, workspace: str|None = None) -> list[tuple]:
+        self.flush()
+        with self.lock:
+            return self.connector.retrieve_bodies(rowids, workspace)
+
+    def retrieve_workspaces(self, rowids: list[int]|None = None) -> list[tuple]:
+        self.flush()
+        with self.lock:
+            return self.connector.retrieve_workspaces(rowids)
+
+    def iter_notes(self, batch_size: int = 100, workspace: str|None = None) -> Iterator[list[tuple]]:
+        self.flush()
+        batches = self.connector.iter_notes(batch_size, workspace)
+        while True:
+            # Writes may go on between batches
+            with self.lock:
+                if (rows := next(batches, None)) is None:
+                    return
+            yield rows
+
+    def changes_since(self, token: int|None = None) -> tuple[list[tuple], list[int]|None, int]:
+        self.flush()
+        with self.lock:
+            return self.connector.changes_since(token)
+
+    def search(self, query: str) -> list[int]:
+        self.flush()
+        with self.lock:
+            return self.connector.search(query)
+
+    def new_id(self) -> int:
+        # Queued notes have reserved ids, no need to flush them
+        with self.lock:
+            return self.connector.new_id()
+
+    def save(self, note: dict) -> bool:
+        return self.push(note['id'], 'save', dict(note))
+
+    def update(self, note: dict) -> bool:
+        return self.push(note['id'], 'update', dict(note))
+
+    def delete(self, rowid: int) -> bool:
+        return self.push(rowid, 'delete')
+
+    def save_many(self, notes: list[dict]) -> bool:
+        return all([self.save(note) for note in notes])
+
+    def update_many(self, notes: list[dict]) -> bool:
+        return all([self.update(note) for note in notes])
+
+    def delete_many(self, rowids: list[int]) -> bool:
+        return all([self.delete(rowid) for rowid in rowids])
+
+    def get_preferences(self) -> tuple:
+        with self.cond:
+            if (pref := self.preferences) is not None:
+                return (pref['checked'], pref['bgcolor'], pref['font'], pref['fcolor'])
+        with self.lock:
+            return self.connector.get_preferences()
+
+    def save_preferences(self, preferences: dict) -> bool:
+        with self.cond:
+            self.preferences = dict(preferences)
+            self.cond.notify_all()
+        return True
+
+    def push(self, rowid: int, operation: str, note: dict|None = None) -> bool:
+        """ Merge a write operation into the pending writes of a note.
+
+        Args:
+            rowid (int): The Id number of the note.
+            operation (str): One of 'save', 'update' or 'delete'.
+            note (dict, optional): Dictionary of note parameters. Defaults to None.
+
+        Returns:
+            bool: True if operation was queued, False if the queue is closed. """
+        with self.cond:
+            if self.closing:
+                logger.error(f'{type(self).__name__}::Queue closed, dropping {operation} of note {rowid}')
+                return False
+            match self.notes.get(rowid), operation:
+                case (('save' | 'update') as pending, queued), 'update':
+                    self.notes[rowid] = (pending, {**queued, **note})
+                case ('delete', None), 'update':
+                    pass    # updating a deleted note has no effect
+                case _:
+                    self.notes[rowid] = (operation, note)
+            self.cond.notify_all()
+        return True
+
+    def pending(self) -> bool:
+        """ Check if there are writes waiting in the queue. """
+        return bool(self.notes) or self.preferences is not None
+
+    def take(self) -> tuple[dict, dict|None]|None:
+        """ Wait for pending writes and take them from the queue (called by the writer thread).
+
+        Returns:
+            tuple|None: Pending note writes and preferences, None if the queue is closed. """
+        with self.cond:
+            while not self.closing and not self.pending():
+                self.cond.wait()
+            # Collect writes arriving shortly after the first one, unless a flush was requested
+            deadline = time.monotonic() + self.delay
+            while (not self.closing and not self.flushing
+                   and (remaining := deadline - time.monotonic()) > 0):
+                self.cond.wait(remaining)
+            if self.closing:
+                if self.pending():
+                    logger.error(f'{type(self).__name__}::Discarding {len(self.notes)} unsaved notes')
+                return None
+            group = (self.notes, self.preferences)
+            self.notes, self.preferences = {}, None
+            self.busy = True
+            return group
+
+    def write(self, group: tuple[dict, dict|None]) -> None:
+        """ Store a group of writes with the wrapped connector (called by the writer thread).
+
+        Args:
+            group (tuple): Note writes and preferences as returned by take(). """
+        notes, preferences = group
+        operations = {'delete': [], 'save': [], 'update': []}
+        for rowid, (operation, note) in notes.items():
+            operations[operation].append(rowid)
+        done = set()
+        try:
+            with self.lock:
+                self.connector.delete_many(operations['delete'])
+                done.update(operations['delete'])
+                self.connector.save_many([notes[rowid][1] for rowid in operations['save']])
+                done.update(operations['save'])
+                self.connector.update_many([notes[rowid][1] for rowid in operations['update']])
+                done.update(operations['update'])
+                if preferences is not None:
+                    self.connector.save_preferences(preferences)
+                    preferences = None
+        except Exception as error:
+            logger.error(f'{type(self).__name__}::Writing failed: {error}')
+            self.requeue({k: v for k, v in notes.items() if k not in done}, preferences)
+            self.failures += 1
+            self.writer.failed.emit(str(error))
+        else:
+            self.retry = False
+            self.failures = 0
+            self.writer.written.emit(len(notes))
+        finally:
+            with self.cond:
+                self.busy = False
+                self.rounds += 1
+                self.cond.notify_all()
+            if self.retry:
+                backoff = min(self.delay * 2 ** self.failures, self.BACKOFF)
+                logger.info(f'{type(self).__name__}::Retrying in {backoff:.1f}s')
+                with self.cond:
+                    self.cond.wait_for(lambda: self.closing or self.flushing, backoff)
+
+    def requeue(self, notes: dict, preferences: dict|None) -> None:
+        """ Put back failed writes unless they were superseded in the meantime. """
+        with self.cond:
+            for rowid, (operation, note) in notes.items():
+                match operation, self.notes.get(rowid):
+                    case _, None:
+                        self.notes[rowid] = (operation, note)
+                    case 'delete', ('update', _):
+                        self.notes[rowid] = (operation, note)
+                    case ('save' | 'update'), ('update', queued):
+                        self.notes[rowid] = (operation, {**note, **queued})
+            if self.preferences is None:
+                self.preferences = preferences
+            self.retry = self.pending()
+
+    def flush(self, timeout: float|None = None) -> bool:
+        """ Write pending changes now and wait until they are stored.
+
+        Args:
+            timeout (float, optional): Maximum seconds to wait. Defaults to None - no limit.
+
+        Returns:
+            bool: True if no writes are pending, False otherwise. """
+        with self.cond:
+            if not self.pending() and not self.busy:
+                return True
+            goal = self.rounds + 1 + self.busy
+            self.flushing += 1
+            self.cond.notify_all()
+            self.cond.wait_for(lambda: self.rounds >= goal or not (self.pending() or self.busy), timeout)
+            self.flushing -= 1
+            return not (self.pending() or self.busy)
+
+    def close(self) -> None:
+        """ Flush pending writes, stop the writer thread and close the wrapped connector. """
+        logger.info(f'{type(self).__name__}::Flushing pending writes')
+        if not self.flush():
+            logger.error(f'{type(self).__name__}::Some changes could not be saved')
+        with self.cond:
+            self.closing = True
+            self.cond.notify_all()
+        self.writer.wait()
+        self.connector.close()
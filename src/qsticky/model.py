@@ -0,0 +1,93 @@
+""" Define the note records, kept for every note whether it has a window or not. """
+from collections import OrderedDict
+from collections.abc import Iterator
+
+from qsticky.data import COLUMNS
+
+
+class Note:
+    """ Stored state of a note. It has a window while the note is visible or was hidden recently.
+
+    Attributes:
+        id (int): The Id number of note.
+        text (str|None): The note text, None if it's not loaded yet.
+        xpos, ypos, width, height (int): The note window geometry.
+        bgcolor, font, fcolor (str): The note style.
+        widget (NoteWidget|None): The window of note, None if it's freed while the note is hidden. """
+    __slots__ = ('id', *COLUMNS, 'widget')
+
+    def __init__(self, row:tuple) -> None:
+        """ Initialize the note record.
+
+        Args:
+            row (tuple): Tuple of id, text, xpos, ypos, width, height, bgcolor, font, fcolor. """
+        self.id = row[0]
+        self.widget = None
+        self.load(row)
+
+    def load(self, row:tuple) -> None:
+        """ Adopt the stored state of note.
+
+        Args:
+            row (tuple): Tuple of id, text, xpos, ypos, width, height, bgcolor, font, fcolor. """
+        for field, value in zip(COLUMNS, row[1:]):
+            setattr(self, field, value)
+
+    def update(self, note:dict) -> None:
+        """ Set fields present in the dictionary.
+
+        Args:
+            note (dict): Dictionary of note parameters. """
+        for field in COLUMNS:
+            if field in note:
+                setattr(self, field, note[field])
+
+    @property
+    def row(self) -> tuple:
+        """ Tuple of id, text, xpos, ypos, width, height, bgcolor, font, fcolor. """
+        return (self.id, *(getattr(self, field) for field in COLUMNS))
+
+    def as_dict(self) -> dict:
+        """ Convert the note record to a dictionary. """
+        return {'id': self.id, **{field: getattr(self, field) for field in COLUMNS}}
+
+
+class NoteRegistry(dict):
+    """ Dictionary mapping ids to records of notes in the current workspace.
+
+    Attributes:
+        recent (OrderedDict): Records of notes with a window by id, least recently used first. """
+
+    def __init__(self) -> None:
+        """ Initialize an empty registry. """
+        super().__init__()
+        self.recent = OrderedDict()
+
+    def add(self, row:tuple) -> Note:
+        """ Return the record of note, created if it isn't registered yet.
+
+        Args:
+            row (tuple): Tuple of id, text, xpos, ypos, width, height, bgcolor, font, fcolor. """
+        if (note := self.get(row[0])) is None:
+            note = self[row[0]] = Note(row)
+        return note
+
+    def clear(self) -> None:
+        """ Remove all records. """
+        super().clear()
+        self.recent.clear()
+
+    def touch(self, note:Note) -> None:
+        """ Mark the note with a window as the most recently used. """
+        self.recent[note.id] = note
+        self.recent.move_to_end(note.id)
+
+    def release(self, note:Note) -> None:
+        """ Forget the note has a window, after it's freed. """
+        if self.recent.get(note.id) is note:
+            del self.recent[note.id]
+
+    def widgets(self) -> Iterator:
+        """ Yield note windows, least recently used first. """
+        for note in self.recent.values():
+            yield note.widget
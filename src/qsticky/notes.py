@@ -1,13 +1,18 @@
 """ Define the widget class that displays sticky notes. """
 import logging
+import time
+from collections import deque
 
-from PyQt6.QtCore import Qt, QTranslator, QLibraryInfo, QLocale
+from PyQt6.QtCore import Qt, QRect, QTimer, QTranslator, QLibraryInfo, QLocale
 from PyQt6.QtCore import pyqtSignal as Signal
-from PyQt6.QtGui import QAction, QIcon
-from PyQt6.QtWidgets import QApplication, QPlainTextEdit, QSizeGrip
+from PyQt6.QtGui import QAction, QCursor, QIcon
+from PyQt6.QtWidgets import QApplication, QInputDialog, QMenu, QMessageBox, QPlainTextEdit, QSizeGrip
 
 import qsticky.resources
-from qsticky import __version__
+from qsticky import __version__, theme
+from qsticky.asyncqt import EventLoop, spawn
+from qsticky.data import FIELDS, COLUMNS, WORKSPACE
+from qsticky.model import Note, NoteRegistry
 from qsticky.preferences import PreferencesWidget, Font
 
 logger = logging.getLogger(__name__)
@@ -17,31 +22,39 @@ class NoteWidget(QPlainTextEdit):
     """ Note Widget class representing a sticky note.
 
     Class Attributes:
-        all (dict): Dictionary mapping ids to notes
+        all (NoteRegistry): Dictionary mapping ids to note records, visible and recently hidden ones have a window.
         db (data.StorageConnector): Storage tasks helper object.
-        style (string): QSS style sheet string for widgets. """
-    all = {}
+        aio (data.AsyncStorageConnector): Asynchronous storage helper object.
+        actions (dict): Context menu actions shared by all notes, created with the first menu.
+        target (NoteWidget): The note window whose context menu is open, actions apply to it. """
+    all = NoteRegistry()
     db = None
-    style = 'NoteWidget {{background: {}; color: {};}}'
+    aio = None
+    actions = {}
+    target = None
     quit_signal = Signal()
 
-    def __new__(cls, row:tuple, *args, **kwargs):
-        """ Create a new instance of NoteWidget or return an existing one. """
-        return cls.all.setdefault(row[0], super().__new__(cls))
-
-    def __init__(self, row:tuple, *args, **kwargs) -> None:
+    def __init__(self, note:Note, *args, **kwargs) -> None:
         """ Initialize the note window.
 
         Args:
-            row (tuple): Tuple of id, text, xpos, ypos, width, height, bgcolor, font,
-                fcolor. A database record of note. """
-        logger.debug(f"NoteWidget.__init__{row}")
-        self.id = row[0]
-        super().__init__(row[1], *args, **kwargs)
-        self.setGeometry(*row[2:6])
-        self.preference = row[6:]
+            note (Note): The record of note, it keeps the stored state while the window exists. """
+        logger.debug(f"NoteWidget.__init__{note.row}")
+        self.id = note.id
+        self.record = note  # the stored state
+        self.dirty = set()  # names of possibly changed field groups
+        self.loaded = note.text is not None
+        self.hidden = 0.0   # time the window was hidden at
+        super().__init__(note.text or '', *args, **kwargs)
+        self.setReadOnly(not self.loaded)
+        self.setGeometry(note.xpos, note.ypos, note.width, note.height)
+        self.preference = (note.bgcolor, note.font, note.fcolor)
         self.apply(*self.preference)
         self.setup_ui()
+        note.update(self.as_dict() if self.loaded else self.as_dict('geometry', 'style'))
+        note.widget = self
+        self.all.touch(note)
+        self.textChanged.connect(lambda: self.dirty.add('text'))
 
     def setup_ui(self) -> None:
         """ Set up the UI for the note window. """
@@ -53,41 +66,74 @@ class NoteWidget(QPlainTextEdit):
         gripsize = 16
         self.grip = QSizeGrip(self)
         self.grip.resize(gripsize, gripsize)
-        # Actions
+
+    def setup_actions(self) -> None:
+        """ Create the context menu actions shared by all notes. """
+        cls = type(self)
+        app = NoteApplication.instance()
         icons = {
             'new': QIcon(':/icons/new'),
             'hide': QIcon(':/icons/hide'),
             'show': QIcon(':/icons/show'),
+            'search': QIcon.fromTheme('edit-find', QIcon(':/icons/show')),
             'preferences': QIcon(':/icons/prop'),
             'delete': QIcon(':/icons/del')
         }
-        self.actions = {}
-        self.actions['new'] = QAction(self.tr('&New'), self)
-        self.actions['new'].setShortcut('Ctrl+N')
-        self.actions['hide'] = QAction(self.tr('&Hide'), self)
-        self.actions['hide'].setShortcut('Ctrl+H')
-        self.actions['show'] = QAction(self.tr('Sho&w all'), self)
-        self.actions['show'].setShortcut('Ctrl+W')
-        self.actions['preferences'] = QAction(self.tr('Pre&ferences'), self)
-        self.actions['preferences'].setShortcut('Ctrl+P')
-        self.actions['delete'] = QAction(self.tr('&Delete'), self)
-        self.actions['delete'].setShortcut('Ctrl+D')
-        for name, action in self.actions.items():
+        cls.actions['new'] = QAction(self.tr('&New'), app)
+        cls.actions['new'].setShortcut('Ctrl+N')
+        cls.actions['hide'] = QAction(self.tr('&Hide'), app)
+        cls.actions['hide'].setShortcut('Ctrl+H')
+        cls.actions['show'] = QAction(self.tr('Sho&w all'), app)
+        cls.actions['show'].setShortcut('Ctrl+W')
+        cls.actions['search'] = QAction(self.tr('&Search'), app)
+        cls.actions['search'].setShortcut('Ctrl+F')
+        cls.actions['preferences'] = QAction(self.tr('Pre&ferences'), app)
+        cls.actions['preferences'].setShortcut('Ctrl+P')
+        cls.actions['delete'] = QAction(self.tr('&Delete'), app)
+        cls.actions['delete'].setShortcut('Ctrl+D')
+        for name, action in cls.actions.items():
             action.setIcon(icons[name])
-        # Signals
-        self.actions['new'].triggered.connect(self.new_note)
-        self.actions['hide'].triggered.connect(lambda: self.close() and self.quit_signal.emit())
-        self.actions['show'].triggered.connect(self.show_all)
-        self.actions['preferences'].triggered.connect(self.prefs_dialog)
-        self.actions['delete'].triggered.connect(self.delete)
+        # Signals, the actions apply to the note whose context menu is open
+        cls.actions['new'].triggered.connect(cls.new_note)
+        cls.actions['hide'].triggered.connect(lambda: cls.target.hide_note())
+        cls.actions['show'].triggered.connect(cls.show_all)
+        cls.actions['search'].triggered.connect(lambda: cls.target.search_dialog())
+        cls.actions['preferences'].triggered.connect(lambda: cls.target.prefs_dialog())
+        cls.actions['delete'].triggered.connect(lambda: cls.target.delete())
 
     def contextMenuEvent(self, event) -> None:
         """ Add custom actions to default context menu. """
+        if not self.actions:
+            self.setup_actions()
         menu = self.createStandardContextMenu()
         top = menu.actions()[0]     # get the first action
         menu.insertActions(top, self.actions.values())
+        menu.insertMenu(top, self.workspace_menu(menu))
         menu.insertSeparator(top)
-        menu.exec(event.globalPos())
+        NoteWidget.target = self
+        try:
+            menu.exec(event.globalPos())
+        finally:
+            NoteWidget.target = None
+
+    def workspace_menu(self, parent:QMenu) -> QMenu:
+        """ Return the submenu switching between workspaces. """
+        app = NoteApplication.instance()
+        menu = QMenu(self.tr('Wor&kspace'), parent)
+        for name in sorted(app.workspaces | {app.workspace}):
+            action = menu.addAction(name)
+            action.setCheckable(True)
+            action.setChecked(name == app.workspace)
+            action.triggered.connect(lambda checked, name=name: app.switch_workspace(name))
+        menu.addSeparator()
+        menu.addAction(self.tr('&New workspace...')).triggered.connect(self.workspace_dialog)
+        return menu
+
+    def workspace_dialog(self) -> None:
+        """ Ask for a name of new workspace and switch to it. """
+        name, accepted = QInputDialog.getText(self, self.tr('New workspace'), self.tr('Workspace name:'))
+        if accepted and name.strip():
+            NoteApplication.instance().switch_workspace(name.strip())
 
     def mousePressEvent(self, event) -> None:
         """ Drag & drop support - save starting position. """
@@ -100,80 +146,221 @@ class NoteWidget(QPlainTextEdit):
         if event.buttons() == Qt.MouseButton.LeftButton:
             self.move(event.globalPosition().toPoint() - self._dragstart)
 
+    def showEvent(self, event) -> None:
+        """ Count the note as visible, unless the window system only restores it. """
+        super().showEvent(event)
+        if not event.spontaneous():
+            NoteApplication.instance().note_shown()
+
+    def hideEvent(self, event) -> None:
+        """ Count the note as hidden, unless the window system only minimizes it. """
+        super().hideEvent(event)
+        if not event.spontaneous():
+            NoteApplication.instance().note_hidden()
+
+    def moveEvent(self, event) -> None:
+        """ Mark the note geometry as changed. """
+        super().moveEvent(event)
+        self.dirty.add('geometry')
+
     def resizeEvent(self, event) -> None:
         """ Adjust the resizing grip position while resizing. """
         super().resizeEvent(event)
+        self.dirty.add('geometry')
         self.grip.move(self.rect().right() - self.grip.width(),
                        self.rect().bottom() - self.grip.height())
 
+    def focusInEvent(self, event) -> None:
+        """ Keep the note window among the recently used ones. """
+        super().focusInEvent(event)
+        if self.all.get(self.id) is self.record:  # not deleted or switched away
+            self.all.touch(self.record)
+
     def focusOutEvent(self, event) -> None:
         """ Save the note text and position when focus is lost. """
         super().focusOutEvent(event)
-        self.db.update(self.as_dict())
-
-    def as_dict(self) -> dict:
-        """ Convert the note window to a dictionary. """
-        return {
-            'id': self.id,
-            'text': self.toPlainText(),
-            'xpos': self.x(),
-            'ypos': self.y(),
-            'width': self.width(),
-            'height': self.height(),
-            'bgcolor': self.palette().color(self.backgroundRole()).name(),
-            'font': self.font().toString(),
-            'fcolor': self.palette().color(self.foregroundRole()).name(),
-        }
+        if len(note := self.changes('text', 'geometry')) > 1:
+            self.db.update(note)
+            self.mark_saved(note)
+
+    def as_dict(self, *groups:str) -> dict:
+        """ Convert the note window to a dictionary.
+
+        Args:
+            *groups (str): Names of field groups to include (see data.FIELDS). Defaults to all. """
+        groups = groups or FIELDS
+        note = {'id': self.id}
+        if 'text' in groups:
+            note['text'] = self.toPlainText()
+        if 'geometry' in groups:
+            note.update(xpos=self.x(), ypos=self.y(), width=self.width(), height=self.height())
+        if 'style' in groups:
+            note.update(
+                bgcolor=self.palette().color(self.backgroundRole()).name(),
+                font=self.font().toString(),
+                fcolor=self.palette().color(self.foregroundRole()).name(),
+            )
+        return note
+
+    def changes(self, *groups:str) -> dict:
+        """ Return note id and fields of groups that differ from the last saved state.
+
+        Args:
+            *groups (str): Names of field groups to check (see data.FIELDS). Defaults to all. """
+        if not (dirty := self.dirty.intersection(groups or FIELDS)):
+            return {'id': self.id}
+        note = self.as_dict(*dirty)
+        for group in dirty:
+            if all(note[field] == getattr(self.record, field) for field in FIELDS[group]):
+                for field in FIELDS[group]:
+                    del note[field]
+                self.dirty.discard(group)
+        return note
+
+    def load_text(self, text:str) -> None:
+        """ Fill in the text of note created without it and allow editing.
+
+        Args:
+            text (str): The stored text of note. """
+        self.setPlainText(text)
+        self.record.text = text
+        self.dirty.discard('text')
+        self.loaded = True
+        self.setReadOnly(False)
+
+    def reconcile(self, row:tuple) -> None:
+        """ Adopt the stored state of note shown from snapshot, keeping changes made meanwhile.
+
+        Args:
+            row (tuple): Tuple of id, text, xpos, ypos, width, height, bgcolor, font, fcolor. """
+        stored = dict(zip(('id', *COLUMNS), row))
+        local = self.changes()
+        adopted = [group for group, fields in FIELDS.items() if fields[0] not in local]
+        if 'text' in adopted and stored['text'] != self.toPlainText():
+            self.load_text(stored['text'])
+        if 'geometry' in adopted:
+            self.setGeometry(*row[2:6])
+        if 'style' in adopted:
+            self.preference = row[6:]
+            self.apply(*self.preference)
+        self.record.update(stored)
+        self.mark_saved(self.as_dict(*adopted))
+
+    def mark_saved(self, note:dict) -> None:
+        """ Update the saved state snapshot with stored fields.
+
+        Args:
+            note (dict): Dictionary of stored note parameters. """
+        self.record.update(note)
+        self.dirty.difference_update(group for group, fields in FIELDS.items() if fields[0] in note)
 
     def apply(self, bgcolor:str, font:str|Font, fcolor:str) -> None:
         """ Apply the selected color and font to the note window. """
-        self.setStyleSheet(self.style.format(bgcolor, fcolor))
-        if isinstance(font, str):
-            font = Font(font)
-        self.setFont(font)
+        self.setPalette(theme.palette(bgcolor, fcolor))
+        self.setFont(theme.font(font) if isinstance(font, str) else font)
+        self.dirty.add('style')
 
     @classmethod
     def apply_to_all(cls, bgcolor:str, font:str|Font, fcolor:str) -> None:
-        """ Apply the selected color and font to all notes. """
+        """ Apply the selected color and font to all notes. Notes without a window get them when shown. """
         logger.info(f"NoteWidget::Applying settings globally")
-        for note in cls.all.values():
-            note.apply(bgcolor, font, fcolor)
+        for widget in cls.all.widgets():
+            widget.apply(bgcolor, font, fcolor)
 
     @classmethod
     def show_all(cls) -> None:
-        """ Show all hidden note windows. """
-        logger.info("NoteWidget::Show all notes")
-        for note in cls.all.values():
-            if not note.isVisible():
-                note.show()
+        """ Show all hidden notes. """
+        app = NoteApplication.instance()
+        logger.info("NoteWidget::Show all notes, {} of {} visible".format(*app.visibility()))
+        pref = cls.db.get_preferences()
+        for note in list(cls.all.values()):
+            if note.widget is None or note.widget.isHidden():
+                app.show_note(note, pref)
+
+    def search_dialog(self) -> None:
+        """ Ask for words to search and show the notes containing them. """
+        query, accepted = QInputDialog.getText(self, self.tr('Search'), self.tr('Find notes containing:'))
+        if accepted and query.strip():
+            app = NoteApplication.instance()
+            spawn(self.find_notes(query)).failed.connect(
+                lambda error: app.error(self.tr('Searching notes failed.'), error))
+
+    async def find_notes(self, query:str) -> None:
+        """ Search the storage without blocking the GUI and raise the found note windows. """
+        app = NoteApplication.instance()
+        found = [self.all[rowid] for rowid in await app.loop.submit(self.aio.search(query)) if rowid in self.all]
+        logger.info(f"NoteWidget::Found {len(found)} notes")
+        if not found:
+            QMessageBox.information(self, self.tr('Search'), self.tr('No notes found.'))
+            return
+        pref = self.db.get_preferences()
+        widgets = [app.show_note(note, pref) for note in found]
+        for widget in widgets:
+            widget.raise_()
+        widgets[0].activateWindow()
+
+    @classmethod
+    def new_note(cls) -> None:
+        """ Create a new empty note window, once the storage gives it an id. """
+        app = NoteApplication.instance()
+        spawn(cls.create_note()).failed.connect(lambda error: app.error(app.tr('Creating a note failed.'), error))
 
     @classmethod
-    def new_note(cls) -> 'NoteWidget':
-        """ Create a new empty note window. """
+    async def create_note(cls) -> 'NoteWidget':
+        """ Reserve an id in the storage without blocking the GUI and show a new empty note window. """
         logger.info("NoteWidget::Creating new note")
-        new_rowid = 0
-        while new_rowid in cls.all:
-            new_rowid += 1
-        ## Can manipulate new row-id calculation here, like:
-        #new_rowid = 1 + max(cls.all, default=0)
-        note = cls((new_rowid, *DEFAULTS))
-        note.quit_signal.connect(NoteApplication.instance().quit_condition)
-        cls.db.save(note.as_dict())
-        if (pref := cls.db.get_preferences()) and pref[0]:
-            note.apply(*pref[1:])
-        note.show()
+        app = NoteApplication.instance()
+        new_rowid = await app.loop.submit(cls.aio.new_id())
+        note = app.show_note(cls.all.add((new_rowid, *DEFAULTS)), cls.db.get_preferences())
+        cls.db.save({**(record := note.as_dict()), 'workspace': app.workspace})
+        note.mark_saved(record)
         return note
 
     def delete(self) -> None:
         """ Delete note window and database record. """
         logger.info(f"NoteWidget::Deleting note {self.id}")
-        self.all.pop(self.id).close()
+        self.all.pop(self.id)
+        self.dispose()
         self.db.delete(self.id)
         self.quit_signal.emit()
 
+    def hide_note(self) -> None:
+        """ Hide the note, its window is kept for a while to show it again quickly. """
+        if len(note := self.changes('text', 'geometry')) > 1:
+            self.db.update(note)
+            self.mark_saved(note)
+        self.hidden = time.monotonic()
+        self.hide()
+        self.all.touch(self.record)
+        NoteApplication.instance().hibernate()
+        self.quit_signal.emit()
+
+    def hibernate(self) -> None:
+        """ Save changes of text and position and free the note window, keeping the record.
+        A style applied from global preferences isn't the note's own, it's saved with preferences only. """
+        if len(note := self.changes('text', 'geometry')) > 1:
+            self.db.update(note)
+            self.mark_saved(note)
+        self.dispose()
+
+    def dispose(self) -> None:
+        """ Close the note window and free it, keeping the database record. """
+        if self.record.widget is self:
+            self.record.widget = None
+            self.all.release(self.record)
+        self.close()
+        self.deleteLater()
+
     def prefs_dialog(self) -> None:
         """ Open the preferences dialog for the specified note. """
-        if not (global_pref := self.db.get_preferences()):
+        app = NoteApplication.instance()
+        spawn(self.open_preferences()).failed.connect(
+            lambda error: app.error(self.tr('Opening the preferences failed.'), error))
+
+    async def open_preferences(self) -> None:
+        """ Load global preferences without blocking the GUI and show the preferences dialog. """
+        loop = NoteApplication.instance().loop
+        if not (global_pref := await loop.submit(self.aio.get_preferences())):
             global_pref = (1, *DEFAULTS[5:])
         logger.debug(f"NoteWidget.prefs_dialog; {global_pref}")
         self.pref_widget = PreferencesWidget(global_pref, self)
@@ -187,7 +374,9 @@ class NoteWidget(QPlainTextEdit):
             preferences (dict): Global preferences chosen in dialog. """
         logger.info(f"NoteWidget::Saving preferences")
         if not preferences['checked']: # Global not chosen
-            self.db.save(self.as_dict())
+            if len(note := self.changes()) > 1:
+                self.db.update(note)
+                self.mark_saved(note)
             self.preference = (
                 self.palette().color(self.backgroundRole()).name(),
                 self.font().toString(),
@@ -197,7 +386,25 @@ class NoteWidget(QPlainTextEdit):
 
 
 class NoteApplication(QApplication):
-    """ Application class for note management. """
+    """ Application class for note management.
+
+    Class Attributes:
+        BATCH (int): Number of note windows created or destroyed between repaints.
+        HIDDEN (int): Number of windows of hidden notes kept to show them again quickly, the least
+            recently hidden ones hibernate over it.
+        IDLE (float): Seconds after which windows of hidden notes hibernate anyway.
+        progress (Signal): Emitted with numbers of notes shown and read so far, while opening a workspace.
+        opened (Signal): Emitted with the workspace name, after all its notes are shown.
+        first_shown (Signal): Emitted when a note is shown while none was visible.
+        last_hidden (Signal): Emitted when the last visible note is hidden. """
+    BATCH = 50
+    HIDDEN = 10
+    IDLE = 600.0
+    progress = Signal(int, int)
+    opened = Signal(str)
+    first_shown = Signal()
+    last_hidden = Signal()
+
     def __init__(self, *args, **kwargs) -> None:
         """ Initialize the application. """
         super().__init__(*args, **kwargs)
@@ -205,6 +412,28 @@ class NoteApplication(QApplication):
         self.setApplicationVersion(qsticky.__version__)
         self.setQuitOnLastWindowClosed(False)
         self.translation()
+        self.snapshot = None
+        self.restored = set()   # ids of notes shown from snapshot
+        self.workspace = WORKSPACE
+        self.workspaces = set()     # names of workspaces in storage
+        self.queued = (deque(), deque())    # records of notes waiting for windows, on screen first
+        self.reading = False
+        self.preference = None
+        self.shown = 0
+        self.read = 0
+        self.visible = 0    # number of visible note windows
+        self.switching = False  # windows are replaced by the ones of another workspace
+        self.dialogs = set()    # open error dialogs
+        self.failure = None     # dialog about failed writes
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.materialize)
+        self.idle = QTimer(self)
+        self.idle.setSingleShot(True)
+        self.idle.timeout.connect(self.hibernate)
+        self.loop = EventLoop(self)
+        self.loop.start()
+        self.aboutToQuit.connect(self.loop.stop)
+        self.aboutToQuit.connect(self.save_snapshot)
 
     def translation(self) -> None:
         """ Load translations of application's strings. """
@@ -216,26 +445,364 @@ class NoteApplication(QApplication):
         if translator.load(QLocale(), "qsticky", "_", ":/i18n"):
             self.installTranslator(translator)
 
-    def start(self) -> None:
-        """ Show saved notes if found, if not create one. """
+    def restore(self, snapshot) -> None:
+        """ Queue notes from snapshot before connecting to the storage, the ones on screen first.
+        The first BATCH is shown at once, the rest by the timer.
+
+        Args:
+            snapshot (data.Snapshot): Snapshot of notes saved on last exit. """
+        self.snapshot = snapshot
+        area = self.screen_area()
+        for row in snapshot.read():
+            self.queued[0 if area.intersects(QRect(*row[2:6])) else 1].append(NoteWidget.all.add(row))
+            self.restored.add(row[0])
+        if self.restored:
+            logger.info(f"NoteApplication::Restored {len(self.restored)} notes from snapshot")
+            self.reading = True     # until reconciled with the storage
+            self.shown, self.read = 0, len(self.restored)
+            self.materialize()
+            self.timer.start()
+            self.processEvents()    # paint them while the storage is connecting
+
+    def start(self, stored:bool = True) -> None:
+        """ Show saved notes if found, if not create one. Notes are read in background,
+        if it fails the error is shown.
+
+        Args:
+            stored (bool, optional): False if the storage keeps notes in memory only, notes restored
+                from snapshot are kept then and the snapshot isn't overwritten. Defaults to True. """
         logger.info("NoteApplication::Starting ...")
-        if rows := NoteWidget.db.retrieve():
-            for row in rows:
-                note = NoteWidget(row)
-                note.quit_signal.connect(self.quit_condition)
-                note.show()
-            # Check for global preference state
-            if (pref := NoteWidget.db.get_preferences()) and pref[0]:
-                NoteWidget.apply_to_all(*pref[1:])
+        if not stored:
+            self.snapshot = None
+            # Ids of restored notes stay taken
+            NoteWidget.db.save_many([{**NoteWidget.all[rowid].as_dict(), 'workspace': self.workspace}
+                                     for rowid in self.restored])
+            self.restored.clear()
+            self.reading = False
+            self.timer.start()  # shows notes left, then reports the workspace opened
+            task = spawn(self.first_note())
+        elif self.restored:
+            task = spawn(self.reconcile())
         else:
-            note = NoteWidget.new_note()
-            note.quit_signal.connect(self.quit_condition)
+            task = spawn(self.open_workspace(self.workspace))
+        # Exits unless notes restored from snapshot are shown
+        task.failed.connect(lambda error: self.error(self.tr('Reading notes failed.'), error))
+        if stored:  # preferences of the first paint may come from the cache file
+            task.finished.connect(lambda _: spawn(self.check_preferences()))
 
-    def quit_condition(self) -> None:
-        """ Check if any note window is visible, exit otherwise. """
-        for note in NoteWidget.all.values():
-            if note.isVisible():
+    def show_note(self, note:Note, pref:tuple|None = None) -> NoteWidget:
+        """ Show the window of note, created unless it's kept since the note was hidden.
+
+        Args:
+            note (Note): The record of note.
+            pref (tuple|None, optional): Global preferences, applied to a new window if chosen. Defaults to None. """
+        if (widget := note.widget) is None:
+            widget = NoteWidget(note)
+            widget.quit_signal.connect(self.quit_condition)
+            if pref and pref[0]:
+                widget.apply(*pref[1:])
+        elif widget.isHidden():
+            NoteWidget.all.touch(note)
+        widget.show()
+        return widget
+
+    def hibernate(self) -> None:
+        """ Free windows of hidden notes over the HIDDEN limit or hidden for IDLE seconds.
+        Visible notes keep their windows. """
+        hidden = [widget for widget in NoteWidget.all.widgets() if widget.isHidden()]   # least recently hidden first
+        now = time.monotonic()
+        kept = []
+        for index, widget in enumerate(hidden):
+            if index < len(hidden) - self.HIDDEN or now - widget.hidden >= self.IDLE:
+                widget.hibernate()
+            else:
+                kept.append(widget)
+        if len(kept) < len(hidden):
+            logger.debug(f"NoteApplication::Hibernated {len(hidden) - len(kept)} hidden notes")
+        if kept:
+            self.idle.start(int((kept[0].hidden + self.IDLE - now) * 1000) + 1)
+
+    async def reconcile(self) -> None:
+        """ Bring notes restored from snapshot up to date with the storage, read a BATCH at a time. """
+        workspace = self.workspace
+        stored = set()
+        batches = NoteWidget.db.iter_notes(self.BATCH, workspace)
+        try:
+            while rows := await self.loop.submit(NoteWidget.aio.next_batch(batches)):
+                if workspace != self.workspace:     # switched meanwhile
+                    batches.close()
+                    return
+                self.merge(rows, [])
+                stored.update(row[0] for row in rows)
+        except Exception:
+            self.snapshot = None    # restored notes may be outdated, keep the snapshot for the next start
+            raise
+        if workspace != self.workspace:
+            return
+        # Restored notes missing in storage were deleted by another client, or snapshot is outdated
+        self.merge([], self.restored.difference(stored))
+        logger.debug(f"NoteApplication::Reconciled {len(stored)} notes")
+        self.restored.clear()
+        self.reading = False
+        if not self.timer.isActive():
+            self.timer.start()  # reports the workspace opened
+        if (pref := await self.loop.submit(NoteWidget.aio.get_preferences())) and pref[0]:
+            NoteWidget.apply_to_all(*pref[1:])
+        await self.first_note()
+
+    async def load_workspaces(self) -> None:
+        """ Load names of workspaces of stored notes. """
+        rows = await self.loop.submit(NoteWidget.aio.retrieve_workspaces())
+        self.workspaces = {*(workspace for _, workspace in rows), self.workspace}
+
+    async def first_note(self) -> None:
+        """ Load names of workspaces and create a note if the workspace is empty. """
+        await self.load_workspaces()
+        if not NoteWidget.all:
+            try:
+                await NoteWidget.create_note()
+            except Exception as error:  # e.g. no id is available while offline
+                self.error(self.tr('Creating a note failed.'), error)
+
+    def switch_workspace(self, name:str) -> None:
+        """ Replace note windows with the ones of another workspace.
+        Windows are destroyed and created in batches, letting the event loop run in between.
+        Meanwhile first_shown and last_hidden aren't emitted, no note is hidden or shown by the user.
+
+        Args:
+            name (str): The workspace name. """
+        if name == self.workspace:
+            return
+        logger.info(f"NoteApplication::Switching to workspace {name}")
+        widgets = list(NoteWidget.all.widgets())
+        for widget in widgets:
+            if len(changes := widget.changes('text', 'geometry')) > 1:
+                NoteWidget.db.update(changes)
+                widget.mark_saved(changes)
+        NoteWidget.all.clear()
+        self.timer.stop()
+        for queue in self.queued:
+            queue.clear()
+        self.workspace = name
+        self.workspaces.add(name)
+        self.snapshot = None    # it holds notes of the workspace chosen at startup
+        self.restored.clear()
+        self.switching = True
+        self.batched(widgets, NoteWidget.dispose, lambda: self.open_switched(name))
+
+    def open_switched(self, name:str) -> None:
+        """ Open the workspace switched to, once windows of the previous one are destroyed.
+
+        Args:
+            name (str): The workspace name. """
+        if name == self.workspace:  # unless switched again meanwhile
+            spawn(self.open_workspace(name))
+
+    async def open_workspace(self, name:str) -> None:
+        """ Queue notes of the workspace without texts, the ones on screen first and then most recently
+        changed first. Windows are created by the timer, a BATCH per event loop iteration, while
+        texts are loaded in background. """
+        self.reading = True
+        self.shown = self.read = 0
+        self.preference = await self.loop.submit(NoteWidget.aio.get_preferences())
+        area = self.screen_area()
+        rows = await self.loop.submit(NoteWidget.aio.retrieve_meta(name))
+        if name != self.workspace:  # switched again meanwhile
+            return
+        for row in rows:
+            note = NoteWidget.all.add((row[0], None, *row[1:]))
+            self.queued[0 if area.intersects(QRect(*row[1:5])) else 1].append(note)
+        self.read = len(rows)
+        self.reading = False
+        logger.debug(f"NoteApplication::Opening {self.read} notes of workspace {name}")
+        if not rows:
+            self.opened.emit(name)
+            await self.first_note()
+            return
+        if not self.timer.isActive():
+            self.timer.start()
+        bodies = await self.loop.submit(NoteWidget.aio.retrieve_bodies(workspace=name))
+        if name != self.workspace:
+            return
+        self.load_texts(bodies)
+        await self.load_workspaces()
+
+    def screen_area(self) -> QRect:
+        """ Return the available area of the screen with the mouse cursor, its notes are shown first. """
+        screen = self.screenAt(QCursor.pos()) or self.primaryScreen()
+        return screen.availableGeometry() if screen is not None else QRect()
+
+    def load_texts(self, bodies:list) -> None:
+        """ Fill in texts of notes queued or shown without them.
+
+        Args:
+            bodies (list): Tuples of id and text. """
+        for rowid, text in bodies:
+            if (note := NoteWidget.all.get(rowid)) is None:
+                continue
+            if note.widget is not None and not note.widget.loaded:
+                note.widget.load_text(text)
+            elif note.text is None:
+                note.text = text
+        logger.debug(f"NoteApplication::Loaded {len(bodies)} note texts")
+
+    def materialize(self) -> None:
+        """ Show a BATCH of queued notes, stop the timer when none are left. """
+        for _ in range(self.BATCH):
+            if not (queue := self.queued[0] or self.queued[1]):
                 break
-        else:
+            note = queue.popleft()
+            # Unless deleted or shown by search meanwhile
+            if NoteWidget.all.get(note.id) is note and note.widget is None:
+                self.show_note(note, self.preference)
+            self.shown += 1
+        self.progress.emit(self.shown, self.read)
+        if not (self.queued[0] or self.queued[1]):
+            self.timer.stop()
+            if not self.reading:
+                logger.debug(f"NoteApplication::Shown {self.shown} notes")
+                self.opened.emit(self.workspace)
+
+    def batched(self, items:list, action, then=None, start:int=0) -> None:
+        """ Call the action for each item, a BATCH of items per event loop iteration.
+
+        Args:
+            items (list): The items to process.
+            action (callable): Called with each item.
+            then (callable, optional): Called after all items. Defaults to None.
+            start (int, optional): Index of the first item to process. Defaults to 0. """
+        for item in items[start:start + self.BATCH]:
+            action(item)
+        if start + self.BATCH < len(items):
+            QTimer.singleShot(0, lambda: self.batched(items, action, then, start + self.BATCH))
+        elif then is not None:
+            then()
+
+    def merge(self, rows:list, deleted:list) -> None:
+        """ Show the stored state of notes, keeping changes made in windows meanwhile.
+
+        Args:
+            rows (list): Tuples of id, text, xpos, ypos, width, height, bgcolor, font, fcolor.
+            deleted (list): The Id numbers of notes removed from storage. """
+        for rowid in deleted:
+            if (note := NoteWidget.all.pop(rowid, None)) is not None and note.widget is not None:
+                note.widget.dispose()
+        for row in rows:
+            if row[0] not in NoteWidget.all:
+                self.show_note(NoteWidget.all.add(row))
+            elif (note := NoteWidget.all[row[0]]).widget is not None:
+                note.widget.reconcile(row)
+            else:
+                note.load(row)
+
+    def refresh(self, rowids:list, deleted:list) -> None:
+        """ Show notes changed by another client.
+
+        Args:
+            rowids (list): The Id numbers of changed notes.
+            deleted (list): The Id numbers of deleted notes. """
+        spawn(self.load_changes(rowids, deleted))
+
+    async def load_changes(self, rowids:list, deleted:list) -> None:
+        """ Load the changed notes and show them. """
+        workspace = self.workspace
+        rows = await self.loop.submit(NoteWidget.aio.retrieve(rowids, workspace))
+        if workspace != self.workspace:     # switched meanwhile
+            return
+        # Notes changed and deleted since the notification are missing
+        self.merge(rows, [*deleted, *set(rowids).difference(row[0] for row in rows)])
+
+    def refresh_all(self) -> None:
+        """ Show the stored state of all notes, after changes of other clients could be missed. """
+        spawn(self.load_all())
+
+    async def load_all(self) -> None:
+        """ Load all notes and show them. """
+        workspace = self.workspace
+        rows = await self.loop.submit(NoteWidget.aio.retrieve(workspace=workspace))
+        if workspace != self.workspace:     # switched meanwhile
+            return
+        self.merge(rows, set(NoteWidget.all).difference(row[0] for row in rows))
+
+    def refresh_preferences(self) -> None:
+        """ Apply global preferences changed by another client. """
+        NoteWidget.db.invalidate()
+        spawn(self.load_preferences())
+
+    async def check_preferences(self) -> None:
+        """ Read global preferences from the database once notes are shown, apply them if they changed. """
+        if await self.loop.submit(NoteWidget.aio.call('refresh')):
+            await self.load_preferences()
+
+    async def load_preferences(self) -> None:
+        """ Load global preferences and apply them if chosen. """
+        if (pref := await self.loop.submit(NoteWidget.aio.get_preferences())) and pref[0]:
+            NoteWidget.apply_to_all(*pref[1:])
+
+    def save_snapshot(self) -> None:
+        """ Store the state of loaded notes for the next start. """
+        if self.snapshot is not None:
+            self.snapshot.write([(note.widget or note).as_dict() for note in NoteWidget.all.values()
+                                 if note.text is not None])
+
+    def storage_failed(self, message:str) -> None:
+        """ Notify the user about failed background write without blocking the event loop.
+        One dialog shows the last error, until it's closed or writes succeed again.
+
+        Args:
+            message (str): The error message reported by the storage writer. """
+        if self.failure is None:
+            self.failure = QMessageBox(QMessageBox.Icon.Critical, self.tr('Error'), '')
+            self.failure.setAttribute(Qt.WidgetAttribute.WA_DeleteOnClose)
+            self.failure.finished.connect(self.storage_dismissed)
+        self.failure.setText(self.tr('Saving notes failed, changes will be retried.') + f'\n\n{message}')
+        self.failure.show()
+
+    def storage_written(self, count:int) -> None:
+        """ Close the dialog about failed writes, once the storage writer stored changes again.
+
+        Args:
+            count (int): The number of notes written. """
+        if self.failure is not None:
+            self.failure.done(0)
+
+    def storage_dismissed(self) -> None:
+        """ Forget the closed dialog about failed writes. """
+        self.failure = None
+
+    def error(self, message:str, error:Exception) -> None:
+        """ Show the error without blocking the event loop, exit once it's closed if no note is visible.
+
+        Args:
+            message (str): Description of the failed action.
+            error (Exception): The error raised. """
+        box = QMessageBox(QMessageBox.Icon.Critical, self.tr('Error'), f'{message}\n\n{error}')
+        self.dialogs.add(box)   # a window without parent lives as long as it's referenced
+        box.finished.connect(lambda: self.dialogs.discard(box))
+        box.finished.connect(self.quit_condition)
+        box.show()
+
+    def note_shown(self) -> None:
+        """ Count a note window shown. """
+        self.visible += 1
+        if self.visible == 1:
+            if self.switching:  # the first note of the workspace switched to
+                self.switching = False
+            else:
+                self.first_shown.emit()
+
+    def note_hidden(self) -> None:
+        """ Count a note window hidden. """
+        self.visible -= 1
+        if not (self.visible or self.switching):
+            self.last_hidden.emit()
+
+    def visibility(self) -> tuple[int, int]:
+        """ Return the number of visible notes and of all notes in the workspace. """
+        return self.visible, len(NoteWidget.all)
+
+    def quit_condition(self) -> None:
+        """ Check if any note is visible, exit otherwise. """
+        if not self.visible:
             logger.info("NoteApplication::All notes are hidden. Exiting...")
             self.quit()
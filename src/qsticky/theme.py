@@ -0,0 +1,30 @@
+""" Palettes and fonts of note windows, shared by notes with the same style. """
+from functools import cache
+
+from PyQt6.QtGui import QColor, QPalette
+
+from qsticky.preferences import Font
+
+
+@cache
+def palette(bgcolor:str, fcolor:str) -> QPalette:
+    """ Return the palette of note windows with the colors.
+
+    Args:
+        bgcolor (str): The background color, a name or in '#RRGGBB' format.
+        fcolor (str): The text color, a name or in '#RRGGBB' format. """
+    palette = QPalette()
+    for role in (QPalette.ColorRole.Window, QPalette.ColorRole.Base, QPalette.ColorRole.Button):
+        palette.setColor(role, QColor(bgcolor))
+    for role in (QPalette.ColorRole.WindowText, QPalette.ColorRole.Text, QPalette.ColorRole.ButtonText):
+        palette.setColor(role, QColor(fcolor))
+    return palette
+
+
+@cache
+def font(string:str) -> Font:
+    """ Return the font described by the string, parsed once for all notes using it.
+
+    Args:
+        string (str): The font description, as returned by QFont.toString. """
+    return Font(string)
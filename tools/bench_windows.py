@@ -0,0 +1,66 @@
+""" Measure the cost of creating note windows: time, memory and child objects per window.
+
+Run from the repository root, off screen unless a display is chosen:
+    PYTHONPATH=src python tools/bench_windows.py --notes 1000 --runs 3 """
+import argparse
+import gc
+import os
+import resource
+import statistics
+import sys
+import time
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from PyQt6.QtCore import QObject
+
+from qsticky import data
+from qsticky.notes import NoteApplication, NoteWidget
+
+FONT = 'Sans,10,-1,5,400,0,0,0,0,0,0,0,0,0,0,1'
+
+
+def create(first:int, count:int) -> tuple[float, list]:
+    """ Create windows of notes with consecutive ids, return seconds taken and the windows.
+
+    Args:
+        first (int): The Id number of the first note.
+        count (int): The number of notes. """
+    rows = [(rowid, f'note {rowid}', 10, 10, 200, 200, '#ffffff', FONT, '#000000')
+            for rowid in range(first, first + count)]
+    start = time.perf_counter()
+    widgets = [NoteWidget(NoteWidget.all.add(row)) for row in rows]
+    return time.perf_counter() - start, widgets
+
+
+def main() -> int:
+    """ Main function used to run the benchmark. """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--notes', type=int, default=1000, help='windows created per run (default: 1000)')
+    parser.add_argument('--runs', type=int, default=3, help='runs, the median time is reported (default: 3)')
+    args = parser.parse_args()
+
+    app = NoteApplication(sys.argv[:1])
+    NoteWidget.db = data.PreferencesCache(data.NoStorage())
+    NoteWidget.aio = data.ThreadedConnector(NoteWidget.db)
+    create(-1, 1)   # warm up caches of icons, palettes and fonts
+
+    # Maximum RSS only grows, so memory is measured by the first run
+    gc.collect()
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    times = []
+    for run in range(args.runs):
+        seconds, widgets = create(run * args.notes, args.notes)
+        times.append(seconds)
+        if not run:
+            memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+            children = len(widgets[0].findChildren(QObject))
+
+    print(f'{args.notes} notes: {statistics.median(times) * 1e3 / args.notes:.2f} ms per note, '
+          f'max RSS +{memory / args.notes:.1f} KiB per note, {children} child QObjects')
+    app.loop.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())